@@ -0,0 +1,183 @@
+from datetime import datetime
+from typing import Optional
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from .config import settings
+from .database import users, balances
+from .queries import balances_find_one, balances_update_one, balances_delete_one
+
+#Where balances live, set by settings.balance_layout:
+#  collection  the balances collection, one document per user (the original layout)
+#  dual        migration period: writes go to both copies, reads prefer the copy
+#              embedded in the user document and fall back to the collection for
+#              users `python -m app.migrations embed_balances` hasn't reached yet
+#  embedded    only the user document's "balance" field
+#
+#The embedded balance keeps the fields (and _id) of the collection document, so the
+#/balances API and BalanceResponse are unchanged. Embedded, an endpoint's user and
+#balance lookups are one find_one, and a total changes with one conditional update
+#of the user document.
+
+LAYOUT = settings.balance_layout
+
+def _embedded() -> bool:
+    return LAYOUT in ("embedded", "dual")
+
+def _collection() -> bool:
+    return LAYOUT in ("collection", "dual")
+
+def _embedded_projection(projection: Optional[dict]) -> dict:
+    if projection is None:
+        return {"balance": 1}
+    fields = {f"balance.{k}": v for k, v in projection.items() if v}
+    #always enough to tell whether the balance exists and is the one asked for
+    return {**fields, "balance.balance_id": 1, "balance.is_deleted": 1}
+
+def _matches(balance: Optional[dict], balance_id: Optional[int]) -> bool:
+    return balance is not None and not balance.get("is_deleted") and (not balance_id or balance["balance_id"] == balance_id)
+
+
+def new_balance(user_id: int, balance_id: int) -> dict:
+    return {
+        "_id": ObjectId(),
+        "user_id": user_id,
+        "balance_id": balance_id,
+        "total": 0,
+        "created_at": datetime.utcnow(),
+        "updated_at": None,
+        "is_deleted": False
+    }
+
+#call before inserting user_doc; call insert once it is in
+def embed(user_doc: dict, balance: dict):
+    if _embedded():
+        user_doc["balance"] = dict(balance)
+
+def insert(balance: dict):
+    if _collection():
+        balances.insert_one(dict(balance))
+
+
+#(user, balance) for an existing user; either is None when not found. The user
+#document only carries its _id
+def find_with_user(user_id: int, balance_id: int = None, projection: dict = None) -> tuple[Optional[dict], Optional[dict]]:
+    if not _embedded():
+        user = users.find_one({"user_id": user_id, "is_deleted": False}, {"_id": 1})
+        return user, (balances_find_one(user_id, balance_id, projection) if user else None)
+
+    user = users.find_one({"user_id": user_id, "is_deleted": False}, {"_id": 1, **_embedded_projection(projection)})
+    if user is None:
+        return None, None
+
+    balance = user.pop("balance", None)
+    if balance is None and LAYOUT == "dual":
+        return user, balances_find_one(user_id, balance_id, projection)
+    return user, balance if _matches(balance, balance_id) else None
+
+def find(user_id: int, balance_id: int = None, projection: dict = None) -> Optional[dict]:
+    if not _embedded():
+        return balances_find_one(user_id, balance_id, projection)
+    return find_with_user(user_id, balance_id, projection)[1]
+
+#total of a balance by balance_id, deleted or not (for WAL replay)
+def find_total(balance_id: int) -> Optional[float]:
+    if _embedded():
+        user = users.find_one({"balance.balance_id": balance_id}, {"balance.total": 1})
+        if user is not None:
+            return user["balance"]["total"]
+        if LAYOUT == "embedded":
+            return None
+
+    balance = balances.find_one({"balance_id": balance_id}, {"total": 1})
+    return balance["total"] if balance else None
+
+
+def update(user_id: int, data: dict, balance_id: int = None):
+    if _embedded():
+        query = {"user_id": user_id, "balance": {"$exists": True}}
+        if balance_id:
+            query["balance.balance_id"] = balance_id
+        users.update_one(query, {"$set": {f"balance.{k}": v for k, v in data.items()}})
+
+    if _collection():
+        balances_update_one(user_id, data, balance_id)
+
+#sets the total to after if it still is before; returns the updated balance, or None
+#if it changed in the meantime (the caller read a stale total)
+def change_total(balance_id: int, before: float, after: float) -> Optional[dict]:
+    data = {"total": after, "updated_at": datetime.utcnow()}
+    updated = None
+
+    if _embedded():
+        user = users.find_one_and_update(
+            {"balance.balance_id": balance_id, "balance.total": before},
+            {"$set": {f"balance.{k}": v for k, v in data.items()}},
+            projection={"balance": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if user is not None:
+            updated = user["balance"]
+        elif LAYOUT == "embedded" or users.find_one({"balance.balance_id": balance_id}, {"_id": 1}) is not None:
+            return None
+
+    if _collection():
+        #during the dual period the embedded copy, where present, decides; the
+        #collection follows with the same condition
+        balance = balances.find_one_and_update(
+            {"balance_id": balance_id, "total": before},
+            {"$set": data},
+            return_document=ReturnDocument.AFTER
+        )
+        if updated is None:
+            updated = balance
+
+    return updated
+
+#subtracts user_id -> amount from many balances with one bulk write per copy; no
+#check of the totals (tap settlement, see app/taps.py)
+#user_id -> live balance, for the users that have one
+def find_many(user_ids: list[int]) -> dict[int, dict]:
+    found = {}
+    if _embedded():
+        for user in users.find({"user_id": {"$in": user_ids}, "is_deleted": False, "balance.is_deleted": False}, {"user_id": 1, "balance": 1}):
+            found[user["user_id"]] = user["balance"]
+
+    rest = [i for i in user_ids if i not in found]
+    if _collection() and rest:
+        for balance in balances.find({"user_id": {"$in": rest}, "is_deleted": False}):
+            found[balance["user_id"]] = balance
+    return found
+
+#the user_ids that have a live user and balance; debit_many skips the others
+def with_balance(user_ids: list[int]) -> set[int]:
+    found = set()
+    if _embedded():
+        found = {i["user_id"] for i in users.find({"user_id": {"$in": user_ids}, "is_deleted": False, "balance.is_deleted": False}, {"user_id": 1})}
+
+    rest = [i for i in user_ids if i not in found]
+    if _collection() and rest:
+        live = [i["user_id"] for i in users.find({"user_id": {"$in": rest}, "is_deleted": False}, {"user_id": 1})]
+        found.update(i["user_id"] for i in balances.find({"user_id": {"$in": live}, "is_deleted": False}, {"user_id": 1}))
+    return found
+
+def debit_many(amounts: dict[int, float], session=None):
+    now = datetime.utcnow()
+
+    if _embedded():
+        users.bulk_write([
+            UpdateOne({"user_id": user_id, "balance.is_deleted": False}, {"$inc": {"balance.total": -amount}, "$set": {"balance.updated_at": now}})
+            for user_id, amount in amounts.items()
+        ], ordered=False, session=session)
+
+    if _collection():
+        balances.bulk_write([
+            UpdateOne({"user_id": user_id, "is_deleted": False}, {"$inc": {"total": -amount}, "$set": {"updated_at": now}})
+            for user_id, amount in amounts.items()
+        ], ordered=False, session=session)
+
+#hard delete; the user document stays
+def delete(user_id: int):
+    if _embedded():
+        users.update_one({"user_id": user_id}, {"$unset": {"balance": ""}})
+    if _collection():
+        balances_delete_one(user_id)
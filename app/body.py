@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from typing import Literal, Optional
 from .database import db
 from pymongo import ReturnDocument
@@ -14,6 +14,16 @@ def get_next_sequence(name: str):
     )
     return counter["seq"]
 
+#reserves count consecutive IDs in one round trip, returns the first
+def get_next_sequence_block(name: str, count: int):
+    counter = db.counters.find_one_and_update(
+        {"_id": name},
+        {"$inc": {"seq": count}},
+        return_document=ReturnDocument.AFTER,
+        upsert=True
+    )
+    return counter["seq"] - count + 1
+
 
 #users/
 class User(BaseModel):
@@ -43,15 +53,74 @@ class Train(BaseModel):
 class Station(BaseModel):
     name: str
     position: int
+    interchange_group: Optional[str] = None   #stations sharing a group are transfer points between trains
 
 #trains/{train_id}/travels
 class Travel(BaseModel):
     departure_id: int
     arrival_id: int
 
+#trips
+class Trip(BaseModel):
+    train_id: int
+    departs_at: datetime
+    capacity: int = Field(gt=0)
+    stop_minutes: Optional[list[int]] = None    #minutes after departs_at at each station, in position order
+
+#trips/{trip_id}/reservations
+class Reservation(BaseModel):
+    departure_id: int
+    arrival_id: int
+    seats: int = Field(default=1, ge=1, le=9)
+
+#gates/validate
+class GateScans(BaseModel):
+    tokens: list[str] = Field(max_length=1000)     #tickets as scanned, in order
+
+#gates/taps
+class TapEvent(BaseModel):
+    gate_id: str
+    seq: int            #increasing per gate; events up to the gate's last settled seq are skipped
+    user_id: int
+    station_id: int
+    type: Literal["in", "out"]
+    at: datetime
+
+class TapBatch(BaseModel):
+    events: list[TapEvent] = Field(max_length=10000)
+
+#fares/configs
+class LineBaseFare(BaseModel):
+    train_id: int
+    base_fare: float
+
+class ZoneRule(BaseModel):
+    train_id: int
+    from_position: int      #stations from this position on are in zone, up to the next rule of the train
+    zone: int
+
+class PeakBand(BaseModel):
+    name: str
+    start: str = Field(pattern=r"^([01]\d|2[0-3]):[0-5]\d$")     #local "HH:MM"; end before start crosses midnight
+    end: str = Field(pattern=r"^([01]\d|2[0-3]):[0-5]\d$")
+    days: list[int] = [0, 1, 2, 3, 4, 5, 6]                        #Monday is 0
+    multiplier: float
+
+class FareConfig(BaseModel):
+    base_fare: float
+    per_station_rate: float
+    line_base_fares: list[LineBaseFare] = []
+    zones: list[ZoneRule] = []
+    per_zone_rate: float = 0
+    peak_bands: list[PeakBand] = []
+    timezone: str = "UTC"
+    max_fare: Optional[float] = None       #per trip
+    daily_cap: Optional[float] = None      #per user and local day, across payments
+
 #users/{user_id}/payments
 class Payment(BaseModel):
     travel_id: int
+    reservation_id: Optional[int] = None    #a held reservation this payment pays for
 
 
 #Token
@@ -60,7 +129,15 @@ class LoggedInToken(BaseModel):
     access_token: str
     token_type: str
     role: str
+    refresh_token: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 class TokenData(BaseModel):
     id: Optional[int] = None
-    role: Optional[Literal["user", "admin"]] = None
\ No newline at end of file
+    role: Optional[Literal["user", "admin"]] = None
+    jti: Optional[str] = None           #absent on tokens issued before revocation support
+    issued_at: Optional[float] = None
+    expires_at: Optional[int] = None
+    session_id: Optional[int] = None    #the refresh session the token was issued for
\ No newline at end of file
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+from .config import settings
+from .queries import (
+    transactions_update_many, transactions_delete_many, payments_update_many, payments_delete_many, payments_find_tickets,
+    stations_update_many, stations_delete_many, travels_update_many, travels_delete_many, trips_update_many, trips_delete_many
+)
+from .tasks import task
+from . import balance_store, station_index, journey, fare_products, fare_engine, timetable, tickets
+
+#Records that go with a deleted user or train. The delete endpoints remove (or
+#soft delete) the user or train itself right away and queue these as tasks, see
+#app/tasks.py. Every step is an update_many/delete_many by the parent ID, so a
+#retried or re-claimed task just repeats them.
+
+#tickets still valid stop working at the gates; revoking again is harmless
+def revoke_user_tickets(user_id: int):
+    since = datetime.utcnow() - timedelta(hours=settings.ticket_valid_hours)
+    tickets.revoke_many([i["ticket"] for i in payments_find_tickets(user_id, since)])
+
+@task("soft_delete_user_records")
+def soft_delete_user_records(user_id: int):
+    balance_store.update(user_id, {"is_deleted": True})
+    transactions_update_many(user_id, {"is_deleted": True})
+    revoke_user_tickets(user_id)
+    payments_update_many(user_id, {"is_deleted": True})
+
+@task("hard_delete_user_records")
+def hard_delete_user_records(user_id: int):
+    balance_store.delete(user_id)
+    transactions_delete_many(user_id)
+    revoke_user_tickets(user_id)
+    payments_delete_many(user_id)
+
+#this process's caches; the API does it right away, the task again where it runs
+def invalidate_train(train_id: int):
+    station_index.invalidate(train_id)
+    journey.invalidate(train_id)
+    fare_products.invalidate_train(train_id)
+    fare_engine.invalidate(train_id)
+    timetable.invalidate(train_id)
+
+@task("soft_delete_train_records")
+def soft_delete_train_records(train_id: int):
+    stations_update_many(train_id, {"is_deleted": True})
+    travels_update_many(train_id, {"is_deleted": True})
+    trips_update_many(train_id, {"is_deleted": True})
+    invalidate_train(train_id)
+
+@task("hard_delete_train_records")
+def hard_delete_train_records(train_id: int):
+    stations_delete_many(train_id)
+    travels_delete_many(train_id)
+    trips_delete_many(train_id)
+    invalidate_train(train_id)
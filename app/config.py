@@ -1,4 +1,5 @@
 from pydantic_settings import BaseSettings
+from typing import Literal, Optional
 
 class Settings(BaseSettings):
     database_host: str  
@@ -7,6 +8,46 @@ class Settings(BaseSettings):
     secret_key: str         
     algorithm: str          
     token_minutes: int      
+    refresh_token_days: int = 30    #sessions renewed with refresh tokens end after this
+
+    #token buckets per route group, as "<requests>/<second|minute|hour>": per client IP,
+    #and per logged in user on the routes that know the user
+    rate_limits: dict[str, str] = {"login": "10/minute", "refresh": "60/minute", "payments": "120/minute", "transactions": "120/minute", "reservations": "120/minute"}
+    user_rate_limits: dict[str, str] = {"payments": "30/minute", "transactions": "30/minute", "reservations": "30/minute"}
+    rate_limit_backend: Literal["memory", "mongo"] = "memory"   #mongo shares buckets between workers
+
+    #write-ahead log of balance-affecting operations, see app/wal.py
+    wal_dir: str = "wal"
+    wal_segment_bytes: int = 64 * 1024 * 1024
+
+    #"embedded" keeps each balance inside its user document, "dual" is the migration
+    #period between the two, see app/balance_store.py
+    balance_layout: Literal["collection", "dual", "embedded"] = "collection"
+
+    #"buckets" stores transactions as monthly per-user buckets, see app/transaction_buckets.py
+    transaction_layout: Literal["documents", "buckets"] = "documents"
+
+    #transactions and payments older than this many months move to files, see app/tiering.py
+    cold_dir: str = "cold"
+    cold_after_months: int = 13
+
+    #seat counters per trip, see app/reservations.py; more spread the writes of a busy trip
+    seat_shards: int = 16
+    hold_minutes: int = 10      #an unpaid reservation gives its seats back after this
+    minutes_per_position: int = 2   #running time per station position, for trips scheduled without stop times
+
+    #signed tickets for fare gates, see app/tickets.py; the key is base64 of a 32-byte
+    #Ed25519 seed, derived from secret_key when unset
+    ticket_signing_key: Optional[str] = None
+    ticket_valid_hours: int = 24
+
+    #tap-in/tap-out settlement, see app/taps.py
+    tap_penalty_fare: float = 50.0
+    tap_max_journey_minutes: int = 180
+
+    task_workers: int = 2       #background task threads per process, see app/tasks.py
+
+    events_backend: Literal["local", "mongo"] = "local"     #mongo fans events out across workers
     
     class Config:
         env_file = ".env"
@@ -6,11 +6,37 @@ client = MongoClient(f"mongodb://{settings.database_user}:{settings.database_pas
 #create an instance of database trains
 db = client.trains
 
+#station writes, imports, reservations and tap settlement use multi-document
+#transactions, which MongoDB only runs on a replica set (a single node started with
+#--replSet will do)
+def check_replica_set():
+    if not client.admin.command("hello").get("setName"):
+        raise RuntimeError(
+            f"MongoDB at {settings.database_host} is a standalone server; transactions need a replica set. "
+            "Start mongod with --replSet rs0 and run rs.initiate() once"
+        )
+
 #database tables
 users = db.users
 balances = db.balances
 transactions = db.transactions
+transaction_buckets = db.transaction_buckets
 trains = db.trains
 stations = db.stations
 travels = db.travels
-payments = db.payments
\ No newline at end of file
+payments = db.payments
+idempotency_keys = db.idempotency_keys
+rate_limits = db.rate_limits
+events = db.events
+fare_configs = db.fare_configs
+repricing_jobs = db.repricing_jobs
+revoked_tokens = db.revoked_tokens
+sessions = db.sessions
+tasks = db.tasks
+trips = db.trips
+seat_counters = db.seat_counters
+reservations = db.reservations
+open_taps = db.open_taps
+tap_checkpoints = db.tap_checkpoints
+tap_charges = db.tap_charges
+used_tickets = db.used_tickets
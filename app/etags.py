@@ -0,0 +1,87 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Request, Response, status
+
+#Strong ETags and Last-Modified for reference data (trains, stations, travels).
+#A version is (count, sum of ids, newest created_at/updated_at); inserts, updates,
+#soft and hard deletes all move it, and it can be computed from a projection or an
+#aggregate without loading whole documents.
+
+#just enough of a document to compute its version
+def version_projection(id_field: str) -> dict:
+    return {id_field: 1, "created_at": 1, "updated_at": 1}
+
+def docs_version(docs, id_field: str) -> dict:
+    version = {"count": 0, "id_sum": 0, "last_modified": None}
+
+    for i in docs:
+        version["count"] += 1
+        version["id_sum"] += i[id_field]
+
+        modified = i.get("updated_at") or i.get("created_at")
+        if modified and (version["last_modified"] is None or modified > version["last_modified"]):
+            version["last_modified"] = modified
+
+    return version
+
+def list_version(collection, query: dict, id_field: str) -> dict:
+    result = list(collection.aggregate([
+        {"$match": query},
+        {"$group": {
+            "_id": None,
+            "count": {"$sum": 1},
+            "id_sum": {"$sum": f"${id_field}"},
+            "last_created": {"$max": "$created_at"},
+            "last_updated": {"$max": "$updated_at"}
+        }}
+    ]))
+
+    if not result:
+        return {"count": 0, "id_sum": 0, "last_modified": None}
+
+    modified = [i for i in (result[0]["last_created"], result[0]["last_updated"]) if i]
+    return {"count": result[0]["count"], "id_sum": result[0]["id_sum"], "last_modified": max(modified, default=None)}
+
+#a version kept as a counter on a parent document that every write to its children bumps
+def counter_version(counter: int, last_modified: datetime = None) -> dict:
+    return {"count": counter, "id_sum": 0, "last_modified": last_modified}
+
+#role and fields are part of the tag because they change the body
+def make_etag(role: str, version: dict, fields: tuple[str, ...] = None) -> str:
+    last_modified = version["last_modified"].isoformat() if version["last_modified"] else ""
+    digest = hashlib.sha1(f'{role}:{fields}:{version["count"]}:{version["id_sum"]}:{last_modified}'.encode()).hexdigest()
+    return f'"{digest[:20]}"'
+
+
+def _http_date(value: datetime) -> str:
+    return format_datetime(value.replace(tzinfo=timezone.utc, microsecond=0), usegmt=True)
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime = None) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [i.strip() for i in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= since
+
+    return False
+
+def set_headers(response: Response, etag: str, last_modified: datetime = None):
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    if last_modified:
+        response.headers["Last-Modified"] = _http_date(last_modified)
+
+def not_modified_response(etag: str, last_modified: datetime = None) -> Response:
+    response = Response(status_code=status.HTTP_304_NOT_MODIFIED)
+    set_headers(response, etag, last_modified)
+    return response
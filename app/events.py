@@ -0,0 +1,156 @@
+import asyncio
+from datetime import datetime
+from threading import Lock, Thread
+from time import sleep, time
+from pydantic import BaseModel
+from pymongo.errors import PyMongoError
+from .config import settings
+from . import revocation
+
+#Per-user server-sent events for balance, transaction and payment changes.
+#Handlers publish after their writes commit; the backend carries the event to every
+#worker and the broker fans it out to that user's open streams. Each stream is a
+#bounded asyncio.Queue read by one coroutine, so an idle connection costs a queue
+#and a parked task, not a thread. A stream ends when its token expires or is revoked
+#(checked on every heartbeat); the client reconnects with a fresh token.
+
+QUEUE_SIZE = 64         #events buffered per stream; the oldest is dropped past this
+HEARTBEAT = 15          #seconds between keep-alive comments on an idle stream
+EVENT_TTL = 300         #seconds published events are kept for the mongo backend
+
+class Broker:
+    def __init__(self):
+        self.subscribers: dict[int, set[asyncio.Queue]] = {}
+        self.loop = None
+        self.lock = Lock()
+        self.counts = {"published": 0, "delivered": 0, "dropped": 0}
+
+    #called from the event loop
+    def subscribe(self, user_id: int) -> asyncio.Queue:
+        self.loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(QUEUE_SIZE)
+
+        with self.lock:
+            self.subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue):
+        with self.lock:
+            queues = self.subscribers.get(user_id)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self.subscribers[user_id]
+
+    #safe to call from any thread; the message is formatted once and shared by every stream
+    def deliver(self, user_id: int, message: str):
+        with self.lock:
+            self.counts["published"] += 1
+            queues = list(self.subscribers.get(user_id, ()))
+
+        if queues and self.loop is not None:
+            self.loop.call_soon_threadsafe(self._put, queues, message)
+
+    def _put(self, queues: list[asyncio.Queue], message: str):
+        for queue in queues:
+            if queue.full():
+                queue.get_nowait()
+                self.counts["dropped"] += 1
+            queue.put_nowait(message)
+            self.counts["delivered"] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "users": len(self.subscribers),
+                "streams": sum(len(i) for i in self.subscribers.values()),
+                **self.counts
+            }
+
+
+#single worker (and tests): publish straight to the local broker
+class LocalBackend:
+    def __init__(self, broker: Broker):
+        self.broker = broker
+
+    def start(self):
+        pass
+
+    def publish(self, user_id: int, message: str):
+        self.broker.deliver(user_id, message)
+
+#several workers: events go through a TTL'd collection and every worker tails it with a
+#change stream (needs a replica set)
+class MongoChangeStreamBackend:
+    def __init__(self, broker: Broker):
+        from .database import events
+
+        self.broker = broker
+        self.events = events
+        self.events.create_index("created_at", expireAfterSeconds=EVENT_TTL)
+        self.thread = None
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self._watch, daemon=True)
+                self.thread.start()
+
+    def publish(self, user_id: int, message: str):
+        self.events.insert_one({"user_id": user_id, "message": message, "created_at": datetime.utcnow()})
+
+    def _watch(self):
+        resume_token = None
+        while True:
+            try:
+                with self.events.watch([{"$match": {"operationType": "insert"}}], resume_after=resume_token) as stream:
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        self.broker.deliver(change["fullDocument"]["user_id"], change["fullDocument"]["message"])
+            except PyMongoError:
+                sleep(1)
+
+
+broker = Broker()
+
+if settings.events_backend == "mongo":
+    backend = MongoChangeStreamBackend(broker)
+else:
+    backend = LocalBackend(broker)
+
+
+def format_event(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+def publish(user_id: int, event: str, data: BaseModel):
+    try:
+        backend.publish(user_id, format_event(event, data.model_dump_json(by_alias=True)))
+    except PyMongoError:
+        #the write itself already committed; a missed push only delays the client until it reconnects
+        pass
+
+#token is the TokenData the stream was opened with
+async def stream(user_id: int, is_disconnected, token):
+    backend.start()
+    queue = broker.subscribe(user_id)
+
+    try:
+        yield ": connected\n\n"
+        while True:
+            timeout = HEARTBEAT
+            if token.expires_at is not None:
+                timeout = min(timeout, token.expires_at - time())
+                if timeout <= 0:
+                    return
+            try:
+                yield await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                if await is_disconnected():
+                    return
+                #may read revoked_tokens, so off the event loop
+                if await asyncio.to_thread(revocation.is_revoked, token.jti, token.id, token.issued_at):
+                    return
+                yield ": keep-alive\n\n"
+    finally:
+        broker.unsubscribe(user_id, queue)
@@ -0,0 +1,177 @@
+from datetime import datetime, timezone
+from threading import Lock
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import numpy as np
+from .fares import current_config
+from .queries import payments_sum_since
+from . import station_index
+
+#Fare rules (the current fare config, see app/fares.py) compiled per train into a
+#table of fares in cents indexed by [time band, departure, arrival], with stations
+#in position order. A quote is a dict lookup for the station indexes plus one array
+#read. Tables are compiled on first use and recompiled when the config version
+#changes or the train's stations are reloaded.
+#
+#fare = (line base fare + positions apart * per_station_rate + zones apart * per_zone_rate)
+#       * band multiplier, capped at max_fare. Band 0 is off-peak (multiplier 1) and is
+#what travels store as their total; peak bands apply when a fare is charged.
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+OFF_PEAK = 0
+
+class CompiledFares:
+    def __init__(self, train_id: int, stations: list[dict], config: dict):
+        self.train_id = train_id
+        self.version = config["version"]
+
+        stations = sorted(stations, key=lambda i: i["position"])
+        self.index = {station["station_id"]: i for i, station in enumerate(stations)}
+
+        #sorted station_ids and their table indexes, for vectorized lookups
+        self.station_ids = np.array(sorted(self.index), dtype=np.int64)
+        self.table_index = np.array([self.index[i] for i in self.station_ids.tolist()], dtype=np.int64)
+
+        positions = np.array([i["position"] for i in stations], dtype=np.int64)
+        zones = station_zones(train_id, positions, config.get("zones", []))
+
+        base_fare = config["base_fare"]
+        for line in config.get("line_base_fares", []):
+            if line["train_id"] == train_id:
+                base_fare = line["base_fare"]
+
+        off_peak = (
+            base_fare
+            + np.abs(positions[:, None] - positions[None, :]) * config["per_station_rate"]
+            + np.abs(zones[:, None] - zones[None, :]) * config.get("per_zone_rate", 0)
+        )
+
+        multipliers = np.array([1.0] + [i["multiplier"] for i in config.get("peak_bands", [])])
+        fares = off_peak[None, :, :] * multipliers[:, None, None]
+        if config.get("max_fare") is not None:
+            fares = np.minimum(fares, config["max_fare"])
+
+        self.cents = np.rint(fares * 100).astype(np.int32)
+
+    def quote(self, departure_id: int, arrival_id: int, band: int = OFF_PEAK):
+        departure = self.index.get(departure_id)
+        arrival = self.index.get(arrival_id)
+        if departure is None or arrival is None:
+            return None
+        if band >= len(self.cents):
+            band = OFF_PEAK     #bands from a newer config than this table
+        return int(self.cents[band, departure, arrival]) / 100
+
+    #fares for arrays of station_ids; known is False where a station isn't on this train
+    def quote_many(self, departure_ids: np.ndarray, arrival_ids: np.ndarray, band: int = OFF_PEAK):
+        if len(self.station_ids) == 0:
+            return np.zeros(len(departure_ids)), np.zeros(len(departure_ids), dtype=bool)
+
+        departure = np.minimum(np.searchsorted(self.station_ids, departure_ids), len(self.station_ids) - 1)
+        arrival = np.minimum(np.searchsorted(self.station_ids, arrival_ids), len(self.station_ids) - 1)
+        known = (self.station_ids[departure] == departure_ids) & (self.station_ids[arrival] == arrival_ids)
+
+        return self.cents[band, self.table_index[departure], self.table_index[arrival]] / 100, known
+
+#zone rules start a zone at a position and run until the next rule of the same train
+def station_zones(train_id: int, positions: np.ndarray, zone_rules: list[dict]) -> np.ndarray:
+    rules = sorted((i for i in zone_rules if i["train_id"] == train_id), key=lambda i: i["from_position"])
+    if not rules:
+        return np.zeros(len(positions), dtype=np.int64)
+
+    starts = np.array([i["from_position"] for i in rules], dtype=np.int64)
+    zone_numbers = np.array([rules[0]["zone"]] + [i["zone"] for i in rules], dtype=np.int64)
+    return zone_numbers[np.searchsorted(starts, positions, side="right")]
+
+#band index for every minute of the week (Monday 00:00 first); later bands win overlaps
+def band_map(peak_bands: list[dict]) -> np.ndarray:
+    bands = np.full(MINUTES_PER_WEEK, OFF_PEAK, dtype=np.int8)
+
+    for number, band in enumerate(peak_bands, start=1):
+        start = _minutes(band["start"])
+        end = _minutes(band["end"])
+        for day in band.get("days", range(7)):
+            first = day * MINUTES_PER_DAY + start
+            last = day * MINUTES_PER_DAY + end if end > start else (day + 1) * MINUTES_PER_DAY + end
+            minutes = np.arange(first, last) % MINUTES_PER_WEEK
+            bands[minutes] = number
+
+    return bands
+
+def _minutes(value: str) -> int:
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+_compiled: dict[int, tuple[object, CompiledFares]] = {}
+_bands: tuple[int, np.ndarray, ZoneInfo] = None
+_lock = Lock()
+
+
+def compiled(train_id: int) -> CompiledFares:
+    config = current_config()
+    stations = station_index.get(train_id)
+
+    cached = _compiled.get(train_id)
+    if cached is None or cached[0] is not stations or cached[1].version != config["version"]:
+        cached = (stations, CompiledFares(train_id, stations.stations, config))
+        with _lock:
+            _compiled[train_id] = cached
+    return cached[1]
+
+def invalidate(train_id: int):
+    with _lock:
+        _compiled.pop(train_id, None)
+
+#band in effect at a UTC time (naive datetimes are UTC, like everything stored)
+def current_band(at: datetime = None) -> int:
+    global _bands
+
+    config = current_config()
+    if _bands is None or _bands[0] != config["version"]:
+        _bands = (config["version"], band_map(config.get("peak_bands", [])), ZoneInfo(config.get("timezone", "UTC")))
+
+    _, bands, zone = _bands
+    local = (at or datetime.utcnow()).replace(tzinfo=timezone.utc).astimezone(zone)
+    return int(bands[local.weekday() * MINUTES_PER_DAY + local.hour * 60 + local.minute])
+
+#start of the local day containing at, as a naive UTC datetime (for daily caps)
+def local_day_start(at: datetime = None) -> datetime:
+    zone = ZoneInfo(current_config().get("timezone", "UTC"))
+    local = (at or datetime.utcnow()).replace(tzinfo=timezone.utc).astimezone(zone)
+    return local.replace(hour=0, minute=0, second=0, microsecond=0).astimezone(timezone.utc).replace(tzinfo=None)
+
+def band_name(band: int) -> str:
+    if band == OFF_PEAK:
+        return "off_peak"
+    return current_config()["peak_bands"][band - 1]["name"]
+
+#None if either station isn't on the train, after reloading its stations once
+def quote(train_id: int, departure_id: int, arrival_id: int, band: int = OFF_PEAK):
+    fare = compiled(train_id).quote(departure_id, arrival_id, band)
+    if fare is None:
+        station_index.rebuild(train_id)
+        fare = compiled(train_id).quote(departure_id, arrival_id, band)
+    return fare
+
+#what a payment for a travel costs right now: the current band's fare for every seat,
+#within the daily cap. A payment being repriced (replacing) doesn't count toward its own cap
+def fare_due(user_id: int, travel: dict, replacing: int = None, seats: int = 1) -> float:
+    fare = quote(travel["train_id"], travel["departure_id"], travel["arrival_id"], current_band())
+    if fare is None:
+        fare = travel["total"]     #a station of the travel is gone; charge what was quoted
+    fare = round(fare * seats, 2)
+
+    daily_cap = current_config().get("daily_cap")
+    if daily_cap is not None:
+        spent = payments_sum_since(user_id, local_day_start(), replacing)
+        fare = max(0, min(fare, round(daily_cap - spent, 2)))
+
+    return fare
+
+def valid_timezone(name: str) -> bool:
+    try:
+        ZoneInfo(name)
+        return True
+    except (ValueError, ZoneInfoNotFoundError):
+        return False
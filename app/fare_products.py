@@ -0,0 +1,33 @@
+from threading import Lock
+from time import monotonic
+
+#Travels are canonical fare products, one per (train_id, departure_id, arrival_id).
+#Quoted products are kept in memory so repeat quotes skip the database entirely;
+#entries expire after PRODUCT_TTL seconds so other workers' edits are picked up.
+PRODUCT_TTL = 60
+
+_products: dict[tuple[int, int, int], tuple[float, dict]] = {}
+_lock = Lock()
+
+
+def product_key(travel: dict) -> tuple[int, int, int]:
+    return (travel["train_id"], travel["departure_id"], travel["arrival_id"])
+
+def get(train_id: int, departure_id: int, arrival_id: int):
+    cached = _products.get((train_id, departure_id, arrival_id))
+    if cached is None or monotonic() - cached[0] > PRODUCT_TTL:
+        return None
+    return cached[1]
+
+def put(travel: dict):
+    with _lock:
+        _products[product_key(travel)] = (monotonic(), travel)
+
+def invalidate(travel: dict):
+    with _lock:
+        _products.pop(product_key(travel), None)
+
+def invalidate_train(train_id: int):
+    with _lock:
+        for key in [i for i in _products if i[0] == train_id]:
+            del _products[key]
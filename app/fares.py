@@ -0,0 +1,32 @@
+from threading import Lock
+from time import monotonic
+from .queries import fare_configs_find_latest
+
+#Fare parameters are versioned documents in fare_configs (POST /fares/configs); the
+#newest version applies, the defaults below until one is stored. The current
+#version is cached for CONFIG_TTL seconds so other workers' changes are picked up.
+BASE_FARE = 13
+PER_STATION_RATE = 1.3
+CONFIG_TTL = 30
+
+DEFAULT_CONFIG = {"version": 0, "base_fare": BASE_FARE, "per_station_rate": PER_STATION_RATE}
+
+_current: tuple[float, dict] = (0.0, None)
+_lock = Lock()
+
+
+def current_config() -> dict:
+    global _current
+
+    loaded_at, config = _current
+    if config is None or monotonic() - loaded_at > CONFIG_TTL:
+        config = fare_configs_find_latest() or DEFAULT_CONFIG
+        with _lock:
+            _current = (monotonic(), config)
+    return config
+
+def invalidate():
+    global _current
+
+    with _lock:
+        _current = (0.0, None)
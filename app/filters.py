@@ -0,0 +1,43 @@
+from typing import Optional
+from .status_codes import validate_history_filters
+
+#Filtering and sorting for history endpoints. Every supported combination of
+#equality filters and sort field maps to the compound index that serves it;
+#a range filter is only allowed on the sort field, so the index covers both.
+#Anything else is rejected instead of falling back to a collection scan.
+
+TRANSACTION_INDEXES = {
+    (frozenset(), "created_at"): [("user_id", 1), ("balance_id", 1), ("is_deleted", 1), ("created_at", 1)],
+    (frozenset({"type"}), "created_at"): [("user_id", 1), ("balance_id", 1), ("is_deleted", 1), ("type", 1), ("created_at", 1)],
+    (frozenset(), "amount"): [("user_id", 1), ("balance_id", 1), ("is_deleted", 1), ("amount", 1)],
+    (frozenset({"type"}), "amount"): [("user_id", 1), ("balance_id", 1), ("is_deleted", 1), ("type", 1), ("amount", 1)],
+}
+
+PAYMENT_INDEXES = {
+    (frozenset(), "created_at"): [("user_id", 1), ("is_deleted", 1), ("created_at", 1)],
+    (frozenset({"travel_id"}), "created_at"): [("user_id", 1), ("is_deleted", 1), ("travel_id", 1), ("created_at", 1)],
+    (frozenset(), "amount"): [("user_id", 1), ("is_deleted", 1), ("amount", 1)],
+    (frozenset({"travel_id"}), "amount"): [("user_id", 1), ("is_deleted", 1), ("travel_id", 1), ("amount", 1)],
+}
+
+
+def _range(low, high) -> Optional[dict]:
+    condition = {}
+    if low is not None:
+        condition["$gte"] = low
+    if high is not None:
+        condition["$lte"] = high
+    return condition or None
+
+#returns (filters, sort, index hint) for the requested combination
+def history_query(indexes: dict, equality: dict, ranges: dict[str, tuple], sort: str):
+    equality = {field: value for field, value in equality.items() if value is not None}
+    ranges = {field: _range(*bounds) for field, bounds in ranges.items() if _range(*bounds)}
+
+    sort_field = sort.lstrip("-")
+    direction = -1 if sort.startswith("-") else 1
+
+    index = indexes.get((frozenset(equality), sort_field))
+    validate_history_filters(index is not None and set(ranges) <= {sort_field}, sort_field)
+
+    return {**equality, **ranges}, [(sort_field, direction)], index
@@ -0,0 +1,167 @@
+import hashlib
+import json
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Event, Lock
+from time import monotonic, sleep
+from typing import Optional
+from fastapi import HTTPException, status
+from pymongo import errors
+from .database import idempotency_keys
+
+#Idempotency-Key support for POSTs that move money. The first request with a key
+#claims it with a pending document; retries with the same key get the stored
+#response back without running the handler again. Keys expire after KEY_TTL
+#seconds, and completed responses are also kept in a small in-process cache.
+#
+#A pending claim holds a lease; a retry after the lease ran out (the worker died)
+#takes the claim over and runs the handler. Once the handler has changed the balance
+#the claim is marked applied and is never taken over or released, so a failure after
+#that point can't be charged twice.
+KEY_TTL = 24 * 60 * 60
+WAIT_TIMEOUT = 10
+LEASE = timedelta(seconds=30)
+CACHE_SIZE = 10_000
+
+idempotency_keys.create_index("created_at", expireAfterSeconds=KEY_TTL)
+
+_completed: OrderedDict[str, tuple[float, str, dict]] = OrderedDict()
+_in_flight: dict[str, Event] = {}
+_lock = Lock()
+
+
+def fingerprint(data: dict) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+def _cached(key_id: str):
+    with _lock:
+        cached = _completed.get(key_id)
+        if cached and monotonic() - cached[0] > KEY_TTL:
+            del _completed[key_id]
+            return None
+        return cached
+
+def _remember(key_id: str, request_fingerprint: str, response: dict):
+    with _lock:
+        _completed[key_id] = (monotonic(), request_fingerprint, response)
+        _completed.move_to_end(key_id)
+        while len(_completed) > CACHE_SIZE:
+            _completed.popitem(last=False)
+
+def _validate_fingerprint(stored: str, request_fingerprint: str):
+    if stored != request_fingerprint:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Idempotency-Key was already used with a different request"
+        )
+
+
+#Wraps a handler body. `replay` is set when the key was already completed and the
+#handler returns it as-is; otherwise the handler runs, calls applied() right after
+#its balance write and save(result) at the end. Errors before applied() release the
+#key so the client can retry.
+class IdempotencyClaim:
+    def __init__(self, scope: str, key: str, request: dict):
+        self.key_id = f"{scope}:{key}" if key else None
+        self.fingerprint = fingerprint(request)
+        self.replay = None
+        self._event = None
+        self._applied = False
+
+    def __enter__(self):
+        if self.key_id is None:
+            return self
+
+        cached = _cached(self.key_id)
+        if cached:
+            _validate_fingerprint(cached[1], self.fingerprint)
+            self.replay = cached[2]
+            return self
+
+        try:
+            now = datetime.utcnow()
+            idempotency_keys.insert_one({
+                "_id": self.key_id,
+                "fingerprint": self.fingerprint,
+                "status": "pending",
+                "response": None,
+                "lease_until": now + LEASE,
+                "created_at": now
+            })
+        except errors.DuplicateKeyError:
+            self.replay = self._wait()
+            if self.replay is not None:
+                return self
+
+        with _lock:
+            self._event = _in_flight[self.key_id] = Event()
+        return self
+
+    #a pending claim whose lease ran out; only one retry wins it
+    def _take_over(self, stored: dict) -> bool:
+        now = datetime.utcnow()
+        lease_until = stored.get("lease_until") or stored["created_at"] + LEASE
+        if lease_until > now:
+            return False
+
+        return idempotency_keys.find_one_and_update(
+            {"_id": self.key_id, "status": "pending", "lease_until": stored.get("lease_until")},
+            {"$set": {"lease_until": now + LEASE}}
+        ) is not None
+
+    #a concurrent duplicate waits for the first request to finish instead of racing it;
+    #None when it took over an abandoned claim and runs the handler itself
+    def _wait(self) -> Optional[dict]:
+        deadline = monotonic() + WAIT_TIMEOUT
+        delay = 0.01
+
+        while monotonic() < deadline:
+            event = _in_flight.get(self.key_id)
+            if event is not None:
+                event.wait(deadline - monotonic())
+
+            stored = idempotency_keys.find_one({"_id": self.key_id})
+            if stored is None:
+                break
+            _validate_fingerprint(stored["fingerprint"], self.fingerprint)
+
+            if stored["status"] == "completed":
+                _remember(self.key_id, stored["fingerprint"], stored["response"])
+                return stored["response"]
+            if stored["status"] == "pending" and event is None and self._take_over(stored):
+                return None
+
+            sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A request with this Idempotency-Key is still being processed, retry later"
+        )
+
+    #the balance was changed: from here on the claim stays, whatever happens next
+    def applied(self):
+        if self._event is None:
+            return
+
+        idempotency_keys.update_one({"_id": self.key_id}, {"$set": {"status": "applied"}})
+        self._applied = True
+
+    def save(self, response: dict):
+        if self.key_id is None:
+            return
+
+        idempotency_keys.update_one({"_id": self.key_id}, {"$set": {"status": "completed", "response": response}})
+        _remember(self.key_id, self.fingerprint, response)
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._event is None:
+            return False
+
+        if exc_type is not None and not self._applied:
+            idempotency_keys.delete_one({"_id": self.key_id, "status": "pending"})
+
+        with _lock:
+            _in_flight.pop(self.key_id, None)
+        self._event.set()
+        return False
@@ -0,0 +1,233 @@
+from heapq import heappop, heappush
+from threading import Lock
+from time import monotonic
+from .queries import stations_find_all_sorted
+from .fares import current_config
+from . import station_index, fare_engine
+
+#Journey graph over every train's station sequence. Nodes are station_ids, line
+#edges join neighbouring stations of a train and transfer edges join stations that
+#share an interchange_group. Edges are kept per train so a station write only
+#recompiles that train's line, and the whole graph is reloaded after GRAPH_TTL
+#seconds (or when the fare config changes) to pick up writes made by other workers.
+#Fare weights come from the off-peak table fare_engine compiles for the line: boarding
+#costs the line's base fare and each line edge the fare it adds, in cents.
+GRAPH_TTL = 60
+
+class JourneyGraph:
+    def __init__(self, fare_version: int):
+        self.lines: dict[int, list[int]] = {}                   #train_id -> station_ids by position
+        self.edges: dict[int, list[tuple[int, int, int]]] = {}  #station_id -> (neighbour, positions apart, fare cents)
+        self.boarding: dict[int, int] = {}                      #station_id -> line base fare in cents
+        self.station_train: dict[int, int] = {}
+        self.positions: dict[int, int] = {}
+        self.station_group: dict[int, str] = {}
+        self.groups: dict[str, set[int]] = {}
+        self.fare_version = fare_version
+        self.loaded_at = monotonic()
+
+    def remove_train(self, train_id: int):
+        for station_id in self.lines.pop(train_id, []):
+            self.edges.pop(station_id, None)
+            self.boarding.pop(station_id, None)
+            self.station_train.pop(station_id, None)
+            self.positions.pop(station_id, None)
+
+            group = self.station_group.pop(station_id, None)
+            if group is not None:
+                self.groups[group].discard(station_id)
+                if not self.groups[group]:
+                    del self.groups[group]
+
+    def add_train(self, train_id: int, stations: list[dict], fares: fare_engine.CompiledFares):
+        self.lines[train_id] = [i["station_id"] for i in stations]
+        cents = fares.cents[fare_engine.OFF_PEAK]
+
+        for i in stations:
+            self.edges[i["station_id"]] = []
+            index = fares.index[i["station_id"]]
+            self.boarding[i["station_id"]] = int(cents[index, index])
+            self.station_train[i["station_id"]] = train_id
+            self.positions[i["station_id"]] = i["position"]
+
+            group = i.get("interchange_group")
+            if group:
+                self.station_group[i["station_id"]] = group
+                self.groups.setdefault(group, set()).add(i["station_id"])
+
+        for previous, current in zip(stations, stations[1:]):
+            positions = abs(current["position"] - previous["position"])
+            first, second = fares.index[previous["station_id"]], fares.index[current["station_id"]]
+            forward = max(0, int(cents[first, second] - cents[first, first]))
+            backward = max(0, int(cents[second, first] - cents[second, second]))
+            self.edges[previous["station_id"]].append((current["station_id"], positions, forward))
+            self.edges[current["station_id"]].append((previous["station_id"], positions, backward))
+
+    #Dijkstra; fare mode pays the line's base fare on boarding and on every transfer, stops mode counts stations passed
+    #(a max_fare cap isn't seen per edge, so capped legs can look dearer than they are)
+    def shortest_path(self, departure_id: int, arrival_id: int, optimize: str):
+        if departure_id not in self.edges or arrival_id not in self.edges:
+            return None
+
+        start = self.boarding[departure_id] if optimize == "fare" else 0
+        costs = {departure_id: (start, 0)}
+        previous = {departure_id: None}
+        queue = [(start, 0, departure_id)]
+
+        while queue:
+            cost, transfers, station_id = heappop(queue)
+            if station_id == arrival_id:
+                break
+            if (cost, transfers) > costs[station_id]:
+                continue
+
+            for neighbour, positions, fare in self.edges[station_id]:
+                step = fare if optimize == "fare" else 1
+                self._relax(queue, costs, previous, station_id, neighbour, (cost + step, transfers))
+
+            group = self.station_group.get(station_id)
+            if group is not None:
+                for neighbour in self.groups[group]:
+                    if neighbour != station_id:
+                        step = self.boarding[neighbour] if optimize == "fare" else 0
+                        self._relax(queue, costs, previous, station_id, neighbour, (cost + step, transfers + 1))
+
+        if arrival_id not in previous:
+            return None
+
+        path = []
+        station_id = arrival_id
+        while station_id is not None:
+            path.append(station_id)
+            station_id = previous[station_id]
+        return path[::-1]
+
+    @staticmethod
+    def _relax(queue, costs, previous, station_id, neighbour, cost):
+        if neighbour not in costs or cost < costs[neighbour]:
+            costs[neighbour] = cost
+            previous[neighbour] = station_id
+            heappush(queue, (*cost, neighbour))
+
+    #splits a path into one leg per train; plan() prices them
+    def legs(self, path: list[int]) -> list[dict]:
+        legs = []
+        for station_id in path:
+            train_id = self.station_train[station_id]
+            if not legs or legs[-1]["train_id"] != train_id:
+                legs.append({"train_id": train_id, "station_ids": []})
+            legs[-1]["station_ids"].append(station_id)
+
+        for leg in legs:
+            leg["departure_id"] = leg["station_ids"][0]
+            leg["arrival_id"] = leg["station_ids"][-1]
+
+        return legs
+
+
+_graph: JourneyGraph = None
+_dirty: set[int] = set()
+_lock = Lock()
+_reload_lock = Lock()       #one full load at a time
+_reloading: set[int] = None #trains recompiled on the old graph while a load runs
+
+
+def load() -> JourneyGraph:
+    config = current_config()
+    graph = JourneyGraph(config["version"])
+
+    line = []
+    for station in stations_find_all_sorted():
+        if line and line[-1]["train_id"] != station["train_id"]:
+            graph.add_train(line[-1]["train_id"], line, fare_engine.CompiledFares(line[-1]["train_id"], line, config))
+            line = []
+        line.append(station)
+
+    if line:
+        graph.add_train(line[-1]["train_id"], line, fare_engine.CompiledFares(line[-1]["train_id"], line, config))
+
+    return graph
+
+#called after station or train writes; only that train's line is recompiled
+def invalidate(train_id: int):
+    with _lock:
+        _dirty.add(train_id)
+
+def _stale() -> bool:
+    return _graph is None or monotonic() - _graph.loaded_at > GRAPH_TTL or _graph.fare_version != current_config()["version"]
+
+#builds the new graph without holding _lock and swaps it in. Until the first graph
+#exists callers wait for it; later reloads run in one thread while the others keep
+#planning on the old graph
+def _reload():
+    global _graph, _reloading
+
+    if not _reload_lock.acquire(blocking=_graph is None):
+        return
+    try:
+        if not _stale():
+            return
+
+        #trains invalidated from here on may predate what load() reads, so they are
+        #recompiled on the new graph too
+        with _lock:
+            covered = set(_dirty)
+            _dirty.clear()
+            _reloading = set()
+        try:
+            graph = load()
+        except Exception:
+            with _lock:
+                _dirty.update(covered)
+                _reloading = None
+            raise
+
+        with _lock:
+            _graph = graph
+            _dirty.update(_reloading)
+            _reloading = None
+    finally:
+        _reload_lock.release()
+
+#expects _lock to be held
+def _refresh() -> JourneyGraph:
+    while _dirty:
+        train_id = _dirty.pop()
+        if _reloading is not None:
+            _reloading.add(train_id)
+        _graph.remove_train(train_id)
+
+        stations = station_index.ordered(train_id)
+        if stations:
+            _graph.add_train(train_id, stations, fare_engine.CompiledFares(train_id, stations, current_config()))
+
+    return _graph
+
+
+#queries hold the lock too so a recompiling train is never seen half-built
+def plan(departure_id: int, arrival_id: int, optimize: str = "fare"):
+    if _stale():
+        _reload()
+
+    with _lock:
+        graph = _refresh()
+
+        path = graph.shortest_path(departure_id, arrival_id, optimize)
+        if path is None:
+            return None
+
+        legs = graph.legs(path)
+
+    #quoting can reload a train's stations, so it runs without holding _lock
+    for leg in legs:
+        leg["fare"] = fare_engine.quote(leg["train_id"], leg["departure_id"], leg["arrival_id"])
+
+    return {
+        "departure_id": departure_id,
+        "arrival_id": arrival_id,
+        "optimize": optimize,
+        "total": sum(i["fare"] for i in legs),
+        "stops": len(path) - len(legs),
+        "transfers": len(legs) - 1,
+        "legs": legs
+    }
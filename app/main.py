@@ -1,8 +1,30 @@
 from fastapi import FastAPI
-from .routers import users, balances, transactions, trains, stations, travels, payments, login
+from .routers import users, balances, transactions, trains, stations, travels, payments, login, journeys, metrics, events, fares, tasks, trips, gates
+from . import tasks as task_queue, cascades, wal
+from .database import check_replica_set
 
 app = FastAPI()
 
+#fails fast instead of a 500 on the first transactional write
+@app.on_event("startup")
+def require_replica_set():
+    check_replica_set()
+
+#claims this worker's own log directory, see app/wal.py
+@app.on_event("startup")
+def open_write_ahead_log():
+    wal.open_log()
+
+#commit and abort records are buffered until the next group commit
+@app.on_event("shutdown")
+def flush_write_ahead_log():
+    wal.open_log().flush()
+
+#picks up tasks left pending by a previous run too
+@app.on_event("startup")
+def start_task_workers():
+    task_queue.start_workers()
+
 app.include_router(login.router)
 app.include_router(users.router)
 app.include_router(balances.router)
@@ -11,6 +33,13 @@ app.include_router(trains.router)
 app.include_router(stations.router)
 app.include_router(travels.router)
 app.include_router(payments.router)
+app.include_router(journeys.router)
+app.include_router(metrics.router)
+app.include_router(events.router)
+app.include_router(fares.router)
+app.include_router(tasks.router)
+app.include_router(trips.router)
+app.include_router(gates.router)
 
 #IF USING _id FOR PATH instead of table_id
 #from bson import ObjectId
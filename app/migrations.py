@@ -0,0 +1,114 @@
+import sys
+from itertools import groupby
+from .database import travels, payments, users, balances, transactions, transaction_buckets
+from .transaction_buckets import INDEX, bucket_docs
+
+#One-off data migrations, run with `python -m app.migrations <name>`
+
+#collapses duplicate travels into one canonical fare product per (train_id, departure_id, arrival_id),
+#pointing payments of the removed duplicates at the surviving travel
+def dedupe_travels():
+    duplicates = travels.aggregate([
+        {"$match": {"is_deleted": False}},
+        {"$sort": {"travel_id": 1}},
+        {"$group": {
+            "_id": {"train_id": "$train_id", "departure_id": "$departure_id", "arrival_id": "$arrival_id"},
+            "travel_ids": {"$push": "$travel_id"}
+        }},
+        {"$match": {"travel_ids.1": {"$exists": True}}}
+    ], allowDiskUse=True)
+
+    collapsed = 0
+    for group in duplicates:
+        canonical_id, *duplicate_ids = group["travel_ids"]
+
+        payments.update_many({"travel_id": {"$in": duplicate_ids}}, {"$set": {"travel_id": canonical_id}})
+        travels.delete_many({"travel_id": {"$in": duplicate_ids}})
+        collapsed += len(duplicate_ids)
+
+    travels.create_index(
+        [("train_id", 1), ("departure_id", 1), ("arrival_id", 1)],
+        unique=True,
+        partialFilterExpression={"is_deleted": False}
+    )
+
+    print(f"dedupe_travels: removed {collapsed} duplicate travels")
+
+
+#copies every balance into its user document. Run it with BALANCE_LAYOUT=dual on all
+#workers, then switch to BALANCE_LAYOUT=embedded once a run copies nothing and
+#reports no mismatches. Safe to repeat: existing embedded copies are compared, never
+#overwritten, since during the dual period they are the ones written first
+def embed_balances():
+    copied = 0
+    missing = 0
+    mismatched = []
+
+    for balance in balances.find({}).sort("balance_id", 1):
+        user = users.find_one({"user_id": balance["user_id"]}, {"balance": 1})
+        if user is None:
+            missing += 1
+            continue
+
+        if "balance" in user:
+            if user["balance"] != balance:
+                mismatched.append(balance["balance_id"])
+            continue
+
+        result = users.update_one({"_id": user["_id"], "balance": {"$exists": False}}, {"$set": {"balance": balance}})
+        if result.modified_count == 0:
+            continue    #a worker embedded it meanwhile; the next run compares it
+        copied += 1
+
+        #a debit that read the collection before the copy landed may have changed it
+        current = balances.find_one({"_id": balance["_id"]})
+        if current is not None and current != balance:
+            result = users.update_one(
+                {"_id": user["_id"], "balance.total": balance["total"], "balance.updated_at": balance["updated_at"]},
+                {"$set": {"balance": current}}
+            )
+            if result.modified_count == 0:
+                mismatched.append(balance["balance_id"])
+
+    users.create_index("balance.balance_id", unique=True, partialFilterExpression={"balance.balance_id": {"$exists": True}})
+
+    print(f"embed_balances: copied {copied} balances, {missing} without a user")
+    for i in mismatched:
+        print(f"mismatch: balance {i} differs between users and balances, needs manual review")
+
+#rewrites transactions into monthly buckets, per (user_id, balance_id). Run it with
+#writes stopped, then start the API with TRANSACTION_LAYOUT=buckets; re-running
+#rebuilds each user's buckets from the transactions collection, which is kept
+def bucket_transactions():
+    transaction_buckets.create_index(INDEX)
+
+    cursor = transactions.find({}).sort([("user_id", 1), ("balance_id", 1), ("created_at", 1)])
+    users_done = 0
+    buckets_written = 0
+    transactions_moved = 0
+
+    for (user_id, balance_id), group in groupby(cursor, key=lambda i: (i["user_id"], i["balance_id"])):
+        docs = list(group)
+        buckets = bucket_docs(user_id, balance_id, docs)
+
+        transaction_buckets.delete_many({"user_id": user_id, "balance_id": balance_id})
+        transaction_buckets.insert_many(buckets)
+
+        users_done += 1
+        buckets_written += len(buckets)
+        transactions_moved += len(docs)
+
+    print(f"bucket_transactions: {transactions_moved} transactions of {users_done} balances in {buckets_written} buckets")
+
+
+MIGRATIONS = {
+    "dedupe_travels": dedupe_travels,
+    "embed_balances": embed_balances,
+    "bucket_transactions": bucket_transactions
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in MIGRATIONS:
+        sys.exit(f"usage: python -m app.migrations [{'|'.join(MIGRATIONS)}]")
+
+    MIGRATIONS[sys.argv[1]]()
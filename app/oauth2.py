@@ -1,9 +1,11 @@
 from jose import JWTError, jwt
 from fastapi import Depends, status, HTTPException
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
 from fastapi.security import OAuth2PasswordBearer
 from .body import TokenData
 from .config import settings
+from . import revocation
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 
@@ -16,8 +18,10 @@ ACCESS_TOKEN_MINUTES = settings.token_minutes
 def create_token(data: dict):
     to_encode = data.copy()
 
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_MINUTES)
-    to_encode.update({"exp": expire})
+    now = datetime.utcnow()
+    expire = now + timedelta(minutes=ACCESS_TOKEN_MINUTES)
+    #iat with fractions of a second, compared against revocation cutoffs
+    to_encode.update({"exp": expire, "iat": now.replace(tzinfo=timezone.utc).timestamp(), "jti": uuid4().hex})
 
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
@@ -35,8 +39,15 @@ def verify_token(token, credentials_exception):
         
     except JWTError:
         raise credentials_exception
+
+    #no database access unless the revocation filter matches
+    if revocation.is_revoked(payload.get("jti"), id, payload.get("iat")):
+        raise credentials_exception
     
-    return TokenData(id=id, role=role)
+    return TokenData(
+        id=id, role=role, jti=payload.get("jti"), issued_at=payload.get("iat"),
+        expires_at=payload.get("exp"), session_id=payload.get("sid")
+    )
 
 def get_current_user(token = Depends(oauth2_scheme)) -> TokenData:
     credentials_exception = HTTPException(
@@ -0,0 +1,61 @@
+from typing import Optional
+from fastapi import Response
+from pydantic import create_model
+from .singleflight import serialize_list
+from .status_codes import validate_fields
+
+#Mongo projections derived from the response models, so handlers only pull the
+#fields they emit, plus `fields=` sparse fieldsets validated against the caller's
+#response model.
+
+#for lookups that only check a document exists
+EXISTS = {"_id": 1}
+
+_partials: dict[tuple, type] = {}
+
+
+#names as they appear in the JSON body (aliases, e.g. "_id")
+def output_names(model: type) -> list[str]:
+    return [field.alias or name for name, field in model.model_fields.items()]
+
+def parse_fields(model: type, fields: Optional[str]) -> Optional[tuple[str, ...]]:
+    if fields is None:
+        return None
+
+    requested = tuple(dict.fromkeys(i.strip() for i in fields.split(",") if i.strip()))
+    validate_fields(requested, output_names(model))
+    return requested
+
+def projection(model: type, fields: tuple[str, ...] = None) -> dict:
+    names = fields or output_names(model)
+    result = {name: 1 for name in names}
+    if "_id" not in result:
+        result["_id"] = 0
+    return result
+
+#the response model restricted to the requested fields
+def select_model(model: type, fields: tuple[str, ...] = None) -> type:
+    if not fields:
+        return model
+
+    partial = _partials.get((model, fields))
+    if partial is None:
+        definitions = {
+            name: (field.annotation, field)
+            for name, field in model.model_fields.items()
+            if (field.alias or name) in fields
+        }
+        partial = _partials[(model, fields)] = create_model(f"{model.__name__}Fields", __config__=model.model_config, **definitions)
+
+    return partial
+
+#JSON response for a sparse fieldset, which the full response_model can't validate
+def sparse_response(model: type, data, fields: tuple[str, ...]) -> Response:
+    partial = select_model(model, fields)
+
+    if isinstance(data, dict):
+        body = partial(**data).model_dump_json(by_alias=True)
+    else:
+        body = serialize_list(partial, data)
+
+    return Response(content=body, media_type="application/json")
@@ -1,8 +1,15 @@
-from .database import users, balances, transactions, trains, stations, travels, payments
+from .database import users, balances, transactions, trains, stations, travels, payments, fare_configs, repricing_jobs, tasks, trips, seat_counters, reservations, tap_charges
+from pymongo import ReturnDocument
+from datetime import datetime
+from .config import settings
+from . import transaction_buckets
+
+BUCKETS = settings.transaction_layout == "buckets"
 
 #Users.py
-def users_find_one(user_id: int):
-    return users.find_one({"user_id": user_id, "is_deleted": False})
+#never returns the password hash unless a projection asks for it
+def users_find_one(user_id: int, projection: dict = None):
+    return users.find_one({"user_id": user_id, "is_deleted": False}, projection or {"password": 0})
 
 def users_update_one(user_id: int, data: dict):
     return users.update_one({"user_id": user_id}, {"$set": data})
@@ -11,9 +18,13 @@ def users_delete_one(user_id: int):
     return users.delete_one({"user_id": user_id})
 
 def transactions_update_many(user_id: int, data: dict):
+    if BUCKETS:
+        return transaction_buckets.update_many(user_id, data)
     return transactions.update_many({"user_id": user_id}, {"$set": data})
 
 def transactions_delete_many(user_id: int):
+    if BUCKETS:
+        return transaction_buckets.delete_many(user_id)
     return transactions.delete_many({"user_id": user_id})
 
 def payments_delete_many(user_id: int):
@@ -22,13 +33,17 @@ def payments_delete_many(user_id: int):
 def payments_update_many(user_id: int, data: dict):
     return payments.update_many({"user_id": user_id}, {"$set": data})
 
+#tickets of a user's payments made since a time (older ones have expired)
+def payments_find_tickets(user_id: int, since: datetime):
+    return payments.find({"user_id": user_id, "created_at": {"$gte": since}, "ticket": {"$exists": True}}, {"_id": 0, "ticket": 1})
+
 
 #Balances.py
-def balances_find_one(user_id: int, balance_id: int = None):
+def balances_find_one(user_id: int, balance_id: int = None, projection: dict = None):
     if balance_id:
-        return balances.find_one({"user_id": user_id, "balance_id": balance_id, "is_deleted": False})
+        return balances.find_one({"user_id": user_id, "balance_id": balance_id, "is_deleted": False}, projection)
     else:
-        return balances.find_one({"user_id": user_id, "is_deleted": False})
+        return balances.find_one({"user_id": user_id, "is_deleted": False}, projection)
 
 def balances_update_one(user_id: int, data: dict, balance_id: int = None):
     if balance_id:
@@ -41,37 +56,69 @@ def balances_delete_one(user_id: int):
 
 
 #Transaction.py
-def transactions_find_one(user_id: int, balance_id: int, transaction_id: int):
-    return transactions.find_one({"user_id": user_id, "balance_id": balance_id, "transaction_id": transaction_id, "is_deleted": False})
-
-def transactions_find(user_id: int, balance_id: int):
-    return transactions.find({"user_id": user_id, "balance_id": balance_id, "is_deleted": False})
+#settings.transaction_layout picks one document per transaction or monthly buckets
+#(app/transaction_buckets.py); both return the same documents
+def transactions_insert_one(doc: dict) -> dict:
+    if BUCKETS:
+        return transaction_buckets.insert_one(doc)
+    transactions.insert_one(doc)
+    return doc
+
+def transactions_find_one(user_id: int, balance_id: int, transaction_id: int, projection: dict = None):
+    if BUCKETS:
+        return transaction_buckets.find_one({"user_id": user_id, "balance_id": balance_id, "transaction_id": transaction_id}, projection)
+    return transactions.find_one({"user_id": user_id, "balance_id": balance_id, "transaction_id": transaction_id, "is_deleted": False}, projection)
+
+#hint is the documents layout's index; buckets have a single one
+def transactions_find(user_id: int, balance_id: int, projection: dict = None, filters: dict = None, sort: list = None, hint: list = None):
+    if BUCKETS:
+        return transaction_buckets.find(user_id, balance_id, projection, filters, sort)
+
+    cursor = transactions.find({"user_id": user_id, "balance_id": balance_id, "is_deleted": False, **(filters or {})}, projection)
+    if sort:
+        cursor = cursor.sort(sort)
+    if hint:
+        cursor = cursor.hint(hint)
+    return cursor
 
 def transactions_update_one(user_id: int, balance_id: int, transaction_id: int, data: dict):
+    if BUCKETS:
+        return transaction_buckets.update_one({"user_id": user_id, "balance_id": balance_id, "transaction_id": transaction_id}, data)
     return transactions.update_one({"user_id": user_id, "balance_id": balance_id, "transaction_id": transaction_id}, {"$set": data})
 
 def transactions_delete_one(user_id: int, balance_id: int, transaction_id: int):
+    if BUCKETS:
+        return transaction_buckets.delete_one({"user_id": user_id, "balance_id": balance_id, "transaction_id": transaction_id})
     return transactions.delete_one({"user_id": user_id, "balance_id": balance_id, "transaction_id": transaction_id})
 
 
 #Trains.py
-def trains_find_one(train_id: int):
-    return trains.find_one({"train_id": train_id, "is_deleted": False})
+def trains_find(projection: dict = None):
+    return trains.find({"is_deleted": False}, projection)
+
+def trains_find_one(train_id: int, projection: dict = None):
+    return trains.find_one({"train_id": train_id, "is_deleted": False}, projection)
 
 def trains_update_one(train_id: int, data: dict):
     return trains.update_one({"train_id": train_id}, {"$set": data})
 
+#bumped by every transaction that places a station, so two of them on one train
+#write-conflict and the one retried sees the other's station
+#every station write moves it; station list ETags are derived from it
+def trains_bump_stations_version(train_id: int, session=None):
+    return trains.update_one({"train_id": train_id}, {"$inc": {"stations_version": 1}, "$set": {"stations_updated_at": datetime.utcnow()}}, session=session)
+
 def stations_update_many(train_id: int, data: dict):
     return stations.update_many({"train_id": train_id}, {"$set": data})
 
-def travels_update_many(train_id: int, data: dict):
-    return travels.update_many({"train_id": train_id}, {"$set": data})
+def travels_update_many(train_id: int, data: dict, session=None):
+    return travels.update_many({"train_id": train_id}, {"$set": data}, session=session)
 
 def trains_delete_one(train_id: int):
     return trains.delete_one({"train_id": train_id})
 
-def stations_delete_many(train_id: int):
-    return stations.delete_many({"train_id": train_id})
+def stations_delete_many(train_id: int, session=None):
+    return stations.delete_many({"train_id": train_id}, session=session)
 
 def travels_delete_many(train_id: int):
     return travels.delete_many({"train_id": train_id})
@@ -81,22 +128,81 @@ def travels_delete_many(train_id: int):
 def stations_find(train_id: int):
     return stations.find({"train_id": train_id, "is_deleted": False})
 
-def stations_find_one(train_id: int, station_id: int):
-    return stations.find_one({"train_id": train_id, "station_id": station_id, "is_deleted": False})
+def stations_find_sorted(train_id: int):
+    return stations.find({"train_id": train_id, "is_deleted": False}).sort("position", 1)
+
+def stations_find_all_sorted():
+    return stations.find({"is_deleted": False}).sort([("train_id", 1), ("position", 1)])
+
+def stations_insert_many(docs: list[dict], session=None):
+    return stations.insert_many(docs, ordered=False, session=session)
+
+#makes room at a position by moving it and every later station down the line
+def stations_shift_positions(train_id: int, from_position: int, session=None):
+    return stations.update_many(
+        {"train_id": train_id, "position": {"$gte": from_position}, "is_deleted": False},
+        {"$inc": {"position": 1}, "$set": {"updated_at": datetime.utcnow()}},
+        session=session
+    )
+
+def stations_find_positions(train_id: int, session=None):
+    return stations.find({"train_id": train_id, "is_deleted": False}, {"_id": 0, "station_id": 1, "position": 1}, session=session)
+
+def stations_position_taken(train_id: int, position: int, station_id: int = None, session=None) -> bool:
+    query = {"train_id": train_id, "position": position, "is_deleted": False, "station_id": {"$ne": station_id}}
+    return stations.find_one(query, {"_id": 1}, session=session) is not None
 
-def stations_update_one(train_id: int, station_id: int, data: dict):
-    return stations.update_one({"train_id": train_id, "station_id": station_id}, {"$set": data})
+def stations_positions_taken(train_id: int, positions: list[int], session=None) -> set[int]:
+    query = {"train_id": train_id, "position": {"$in": positions}, "is_deleted": False}
+    return {i["position"] for i in stations.find(query, {"_id": 0, "position": 1}, session=session)}
+
+def stations_find_train(station_id: int):
+    return stations.find_one({"station_id": station_id}, {"_id": 0, "train_id": 1})
+
+def stations_find_one(train_id: int, station_id: int, projection: dict = None):
+    return stations.find_one({"train_id": train_id, "station_id": station_id, "is_deleted": False}, projection)
+
+def stations_update_one(train_id: int, station_id: int, data: dict, session=None):
+    return stations.update_one({"train_id": train_id, "station_id": station_id}, {"$set": data}, session=session)
 
 def stations_delete_one(train_id: int, station_id: int):
     return stations.delete_one({"train_id": train_id, "station_id": station_id})
 
 
 #Travels.py
-def travels_find(train_id: int):
-    return travels.find({"train_id": train_id, "is_deleted": False})
+def travels_find(train_id: int, projection: dict = None, session=None):
+    return travels.find({"train_id": train_id, "is_deleted": False}, projection, session=session)
+
+def travels_bulk_write(requests: list, session=None):
+    return travels.bulk_write(requests, ordered=False, session=session)
+
+def travels_find_product(train_id: int, departure_id: int, arrival_id: int):
+    return travels.find_one({"train_id": train_id, "departure_id": departure_id, "arrival_id": arrival_id, "is_deleted": False})
 
-def travels_find_one(train_id: int, travel_id: int):
-    return travels.find_one({"train_id": train_id, "travel_id": travel_id, "is_deleted": False})
+#returns the existing fare product, inserting data only if there is none
+def travels_upsert_product(train_id: int, departure_id: int, arrival_id: int, data: dict):
+    return travels.find_one_and_update(
+        {"train_id": train_id, "departure_id": departure_id, "arrival_id": arrival_id, "is_deleted": False},
+        {"$setOnInsert": data},
+        return_document=ReturnDocument.AFTER,
+        upsert=True
+    )
+
+#one repricing batch: the train's travels after a travel_id, in travel_id order
+def travels_find_after(train_id: int, after_travel_id: int = None, projection: dict = None):
+    query = {"train_id": train_id, "is_deleted": False}
+    if after_travel_id is not None:
+        query["travel_id"] = {"$gt": after_travel_id}
+    return travels.find(query, projection).sort("travel_id", 1)
+
+def travels_train_ids():
+    return sorted(travels.distinct("train_id", {"is_deleted": False}))
+
+def travels_count():
+    return travels.count_documents({"is_deleted": False})
+
+def travels_find_one(train_id: int, travel_id: int, projection: dict = None):
+    return travels.find_one({"train_id": train_id, "travel_id": travel_id, "is_deleted": False}, projection)
 
 def travels_update_one(train_id: int, travel_id: int, data: dict):
     return travels.update_one({"train_id": train_id, "travel_id": travel_id}, {"$set": data})
@@ -106,17 +212,127 @@ def travels_delete_one(train_id: int, travel_id: int):
 
 
 #Payments.py
-def payments_find(user_id: int):
-    return payments.find({"user_id": user_id, "is_deleted": False})
+def payments_find(user_id: int, projection: dict = None, filters: dict = None, sort: list = None, hint: list = None):
+    cursor = payments.find({"user_id": user_id, "is_deleted": False, **(filters or {})}, projection)
+    if sort:
+        cursor = cursor.sort(sort)
+    if hint:
+        cursor = cursor.hint(hint)
+    return cursor
+
+#what a user has paid since a time, tap fares included, for daily fare caps
+def payments_sum_since(user_id: int, since: datetime, exclude_payment_id: int = None) -> float:
+    match = {"user_id": user_id, "is_deleted": False, "created_at": {"$gte": since}}
+    if exclude_payment_id is not None:
+        match["payment_id"] = {"$ne": exclude_payment_id}
+    result = list(payments.aggregate([
+        {"$match": match},
+        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
+    ]))
+    taps = list(tap_charges.aggregate([
+        {"$match": {"user_id": user_id, "type": "fare", "tap_in.at": {"$gte": since}}},
+        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
+    ]))
+    return (result[0]["total"] if result else 0) + (taps[0]["total"] if taps else 0)
+
+#user_id -> what each user paid and was charged in tap fares in [since, until)
+def fares_spent_between(user_ids: list[int], since: datetime, until: datetime) -> dict[int, float]:
+    spent = {}
+    for collection, field, match in ((payments, "created_at", {"is_deleted": False}), (tap_charges, "tap_in.at", {"type": "fare"})):
+        for i in collection.aggregate([
+            {"$match": {"user_id": {"$in": user_ids}, field: {"$gte": since, "$lt": until}, **match}},
+            {"$group": {"_id": "$user_id", "total": {"$sum": "$amount"}}}
+        ]):
+            spent[i["_id"]] = round(spent.get(i["_id"], 0) + i["total"], 2)
+    return spent
 
 def travels_find_by_id(travel_id: int):
     return travels.find_one({"travel_id": travel_id, "is_deleted": False})
 
-def payments_find_one(user_id: int, payment_id: int):
-    return payments.find_one({"user_id": user_id, "payment_id": payment_id, "is_deleted": False})
+def payments_find_one(user_id: int, payment_id: int, projection: dict = None):
+    return payments.find_one({"user_id": user_id, "payment_id": payment_id, "is_deleted": False}, projection)
 
 def payments_update_one(user_id: int, payment_id: int, data: dict):
     return payments.update_one({"user_id": user_id, "payment_id": payment_id}, {"$set": data})
 
 def payments_delete_one(user_id: int, payment_id: int):
-    return payments.delete_one({"user_id": user_id, "payment_id": payment_id})
\ No newline at end of file
+    return payments.delete_one({"user_id": user_id, "payment_id": payment_id})
+
+
+#Fares.py
+def fare_configs_find_latest():
+    return fare_configs.find_one({}, {"_id": 0}, sort=[("version", -1)])
+
+def fare_configs_find_version(version: int):
+    return fare_configs.find_one({"version": version}, {"_id": 0})
+
+def fare_configs_find():
+    return fare_configs.find({}, {"_id": 0}).sort("version", -1)
+
+def repricing_jobs_find_one(job_id: int):
+    return repricing_jobs.find_one({"job_id": job_id}, {"_id": 0})
+
+def repricing_jobs_update_one(job_id: int, update: dict):
+    return repricing_jobs.update_one({"job_id": job_id}, update)
+
+#takes a job that isn't done and isn't held by a live runner
+def repricing_jobs_claim(job_id: int, stale_before: datetime):
+    return repricing_jobs.find_one_and_update(
+        {"job_id": job_id, "status": {"$ne": "done"}, "$or": [{"status": {"$ne": "running"}}, {"updated_at": {"$lt": stale_before}}]},
+        {"$set": {"status": "running", "updated_at": datetime.utcnow(), "error": None}},
+        {"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+#Tasks.py
+def tasks_find_one(task_id: int, projection: dict = None):
+    return tasks.find_one({"task_id": task_id}, projection or {"_id": 0})
+
+def tasks_find_active(dedupe_key: str):
+    return tasks.find_one({"active_key": dedupe_key}, {"_id": 0})
+
+#the next due task, or a running one whose worker stopped renewing its lease
+def tasks_claim(now: datetime, lease_until: datetime, worker: str):
+    return tasks.find_one_and_update(
+        {"$or": [
+            {"status": "pending", "run_at": {"$lte": now}},
+            {"status": "running", "lease_until": {"$lt": now}}
+        ]},
+        {"$set": {"status": "running", "lease_until": lease_until, "worker": worker, "updated_at": now}, "$inc": {"attempts": 1}},
+        {"_id": 0},
+        sort=[("run_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+#only while the worker still holds the task
+def tasks_update_leased(task_id: int, worker: str, update: dict):
+    return tasks.update_one({"task_id": task_id, "status": "running", "worker": worker}, update)
+
+
+#Trips.py
+def trips_find(filters: dict = None, projection: dict = None):
+    return trips.find({"is_deleted": False, **(filters or {})}, projection).sort("departs_at", 1)
+
+def trips_find_one(trip_id: int, projection: dict = None):
+    return trips.find_one({"trip_id": trip_id, "is_deleted": False}, projection)
+
+def trips_update_one(trip_id: int, data: dict):
+    return trips.update_one({"trip_id": trip_id}, {"$set": data})
+
+def trips_update_many(train_id: int, data: dict):
+    return trips.update_many({"train_id": train_id}, {"$set": data})
+
+def trips_delete_many(train_id: int):
+    trip_ids = trips.distinct("trip_id", {"train_id": train_id})
+    seat_counters.delete_many({"trip_id": {"$in": trip_ids}})
+    return trips.delete_many({"train_id": train_id})
+
+def seat_counters_find(trip_id: int):
+    return seat_counters.find({"trip_id": trip_id}, {"_id": 0, "free": 1})
+
+def reservations_find_one(trip_id: int, reservation_id: int):
+    return reservations.find_one({"trip_id": trip_id, "reservation_id": reservation_id}, {"_id": 0})
+
+def reservations_find_by_id(reservation_id: int, projection: dict = None):
+    return reservations.find_one({"reservation_id": reservation_id}, projection)
@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta
+from threading import Lock
+from time import monotonic, time
+from fastapi import Depends, Request
+from pymongo import ReturnDocument
+from .body import TokenData
+from .config import settings
+from .database import rate_limits
+from .oauth2 import get_current_user
+from .status_codes import validate_rate_limit
+
+#Token-bucket rate limiting per route group: settings.rate_limits per client IP and,
+#on authenticated routes, settings.user_rate_limits per user_id. A request takes a
+#token from each of its buckets only when all of them have one.
+PERIODS = {"second": 1, "minute": 60, "hour": 3600}
+
+def parse_limit(limit: str) -> tuple[float, float]:
+    requests, period = limit.split("/")
+    return float(requests), float(requests) / PERIODS[period]
+
+
+#buckets live in this process only; each is dropped once it would be full again
+class MemoryBackend:
+    def __init__(self):
+        self.buckets: dict[str, list[float]] = {}     #key -> [tokens, updated, full again at]
+        self.lock = Lock()
+        self.next_prune = monotonic() + 60
+
+    #takes one token; returns 0 when allowed, otherwise seconds until a token is available
+    def take(self, key: str, capacity: float, rate: float) -> float:
+        return self.take_all([(key, capacity, rate)])
+
+    #takes one token from every (key, capacity, rate) bucket, or from none of them
+    def take_all(self, requests: list[tuple[str, float, float]]) -> float:
+        now = monotonic()
+
+        with self.lock:
+            refilled = []
+            retry_after = 0
+            for key, capacity, rate in requests:
+                bucket = self.buckets.get(key)
+                tokens = capacity if bucket is None else min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                refilled.append((key, capacity, rate, tokens))
+                if tokens < 1:
+                    retry_after = max(retry_after, (1 - tokens) / rate)
+
+            for key, capacity, rate, tokens in refilled:
+                if not retry_after:
+                    tokens -= 1
+                self.buckets[key] = [tokens, now, now + (capacity - tokens) / rate]
+
+            if now >= self.next_prune:
+                self.prune(now)
+
+        return retry_after
+
+    def prune(self, now: float):
+        for key in [k for k, (_, _, full_at) in self.buckets.items() if full_at <= now]:
+            del self.buckets[key]
+        self.next_prune = now + 60
+
+
+#buckets shared by every worker, refilled and taken in one atomic pipeline update
+class MongoBackend:
+    def __init__(self, collection):
+        self.collection = collection
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def take(self, key: str, capacity: float, rate: float) -> float:
+        now = time()
+        refilled = {"$min": [capacity, {"$add": [
+            {"$ifNull": ["$tokens", capacity]},
+            {"$multiply": [{"$subtract": [now, {"$ifNull": ["$updated", now]}]}, rate]}
+        ]}]}
+
+        bucket = self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "updated": now}},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                    "expires_at": datetime.utcnow() + timedelta(seconds=capacity / rate)
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+        if bucket["allowed"]:
+            return 0
+        return (1 - bucket["tokens"]) / rate
+
+    #takes from each bucket in turn and gives the tokens back when a later one refuses
+    def take_all(self, requests: list[tuple[str, float, float]]) -> float:
+        taken = []
+        for key, capacity, rate in requests:
+            retry_after = self.take(key, capacity, rate)
+            if retry_after:
+                for taken_key, taken_capacity in taken:
+                    self.collection.update_one({"_id": taken_key}, [{"$set": {"tokens": {"$min": [taken_capacity, {"$add": ["$tokens", 1]}]}}}])
+                return retry_after
+            taken.append((key, capacity))
+        return 0
+
+
+backend = MongoBackend(rate_limits) if settings.rate_limit_backend == "mongo" else MemoryBackend()
+
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+def _check(group: str, ip: str, user_id: int = None):
+    requests = []
+    if group in settings.rate_limits:
+        requests.append((f"{group}:ip:{ip}", *parse_limit(settings.rate_limits[group])))
+    if user_id is not None and group in settings.user_rate_limits:
+        requests.append((f"{group}:user:{user_id}", *parse_limit(settings.user_rate_limits[group])))
+
+    if requests:
+        validate_rate_limit(backend.take_all(requests))
+
+#router dependency limiting a route group per client IP
+def limit_by_ip(group: str):
+    def dependency(request: Request):
+        _check(group, client_ip(request))
+
+    return dependency
+
+#router dependency limiting a route group per client IP and per logged in user
+def limit_by_user(group: str):
+    def dependency(request: Request, current_user: TokenData = Depends(get_current_user)):
+        _check(group, client_ip(request), current_user.id)
+
+    return dependency
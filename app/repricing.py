@@ -0,0 +1,170 @@
+import sys
+from datetime import datetime, timedelta
+from threading import Thread
+from time import monotonic
+import numpy as np
+from pymongo import UpdateOne
+from .body import get_next_sequence
+from .database import repricing_jobs
+from .fares import DEFAULT_CONFIG, current_config
+from .fare_engine import CompiledFares
+from .queries import (
+    stations_find_positions, travels_find, travels_bulk_write, travels_find_after, travels_train_ids, travels_count,
+    fare_configs_find_version, repricing_jobs_find_one, repricing_jobs_update_one, repricing_jobs_claim
+)
+from . import station_index, fare_products
+
+#Recomputes stored travel totals (the off-peak fare, see app/fare_engine.py):
+#reprice_train for one train after its station positions change, and a resumable job
+#that reprices every travel against a fare config version (`python -m app.repricing
+#run|resume <job_id>` or POST /fares/repricing). The job streams each train's travels
+#in travel_id order, looks up a batch of fares at once in the train's compiled table
+#and writes only the changed ones; after every batch it checkpoints (train_id, last
+#travel_id) so an interrupted job resumes where it stopped.
+
+BATCH_SIZE = 5000
+LEASE = 60      #seconds without a checkpoint before a running job may be taken over
+
+TRAVEL_PROJECTION = {"_id": 0, "travel_id": 1, "departure_id": 1, "arrival_id": 1, "total": 1}
+
+
+#UpdateOnes for the travels in batch whose stored total differs from the compiled fare
+def repricing_updates(fares: CompiledFares, batch: list[dict]) -> list[UpdateOne]:
+    if not batch:
+        return []
+
+    departure_ids = np.fromiter((i["departure_id"] for i in batch), dtype=np.int64, count=len(batch))
+    arrival_ids = np.fromiter((i["arrival_id"] for i in batch), dtype=np.int64, count=len(batch))
+    totals = np.fromiter((i["total"] for i in batch), dtype=np.float64, count=len(batch))
+
+    new_totals, known = fares.quote_many(departure_ids, arrival_ids)
+    changed = known & (new_totals != totals)
+
+    now = datetime.utcnow()
+    return [
+        UpdateOne({"travel_id": batch[i]["travel_id"]}, {"$set": {"total": float(new_totals[i]), "updated_at": now}})
+        for i in np.flatnonzero(changed).tolist()
+    ]
+
+#returns how many travels were repriced
+def reprice_train(train_id: int, session=None) -> int:
+    fares = CompiledFares(train_id, list(stations_find_positions(train_id, session)), current_config())
+    travel_docs = list(travels_find(train_id, TRAVEL_PROJECTION, session))
+
+    updates = repricing_updates(fares, travel_docs)
+    if updates:
+        travels_bulk_write(updates, session)
+    return len(updates)
+
+def _batches(cursor):
+    batch = []
+    for travel in cursor:
+        batch.append(travel)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def create_job(config: dict = None) -> dict:
+    config = config or current_config()
+    job = {
+        "job_id": get_next_sequence("repricing_job_id"),
+        "config_version": config["version"],
+        "status": "pending",
+        "train_id": None,
+        "last_travel_id": None,
+        "total": travels_count(),
+        "processed": 0,
+        "repriced": 0,
+        "travels_per_second": None,
+        "error": None,
+        "created_at": datetime.utcnow(),
+        "updated_at": None,
+        "finished_at": None
+    }
+    repricing_jobs.insert_one(dict(job))
+    return job
+
+#runs (or resumes) a job until it is done; returns None if another runner holds it
+def run_job(job_id: int, report=None):
+    job = repricing_jobs_claim(job_id, datetime.utcnow() - timedelta(seconds=LEASE))
+    if job is None:
+        return None
+
+    started = monotonic()
+    processed = 0
+
+    try:
+        config = fare_configs_find_version(job["config_version"]) if job["config_version"] else DEFAULT_CONFIG
+        if config is None:
+            raise LookupError(f'Fare config version {job["config_version"]} not found')
+
+        for train_id in travels_train_ids():
+            if job["train_id"] is not None and train_id < job["train_id"]:
+                continue
+            after = job["last_travel_id"] if train_id == job["train_id"] else None
+            fares = CompiledFares(train_id, station_index.get(train_id).stations, config)
+
+            for batch in _batches(travels_find_after(train_id, after, TRAVEL_PROJECTION).batch_size(BATCH_SIZE)):
+                updates = repricing_updates(fares, batch)
+                now = datetime.utcnow()
+                if updates:
+                    travels_bulk_write(updates)
+
+                processed += len(batch)
+                job["train_id"], job["last_travel_id"] = train_id, batch[-1]["travel_id"]
+                job["processed"] += len(batch)
+                job["repriced"] += len(updates)
+                job["travels_per_second"] = round(processed / max(monotonic() - started, 1e-9))
+
+                repricing_jobs_update_one(job_id, {"$set": {
+                    "train_id": train_id,
+                    "last_travel_id": job["last_travel_id"],
+                    "processed": job["processed"],
+                    "repriced": job["repriced"],
+                    "travels_per_second": job["travels_per_second"],
+                    "updated_at": now
+                }})
+                if report:
+                    report(job)
+
+            fare_products.invalidate_train(train_id)
+
+    except Exception as error:
+        repricing_jobs_update_one(job_id, {"$set": {"status": "failed", "error": str(error), "updated_at": datetime.utcnow()}})
+        raise
+
+    now = datetime.utcnow()
+    repricing_jobs_update_one(job_id, {"$set": {"status": "done", "updated_at": now, "finished_at": now}})
+    return repricing_jobs_find_one(job_id)
+
+
+#for the API: runs the job in a daemon thread, failures are recorded on the job
+def start_job(job_id: int):
+    def run():
+        try:
+            run_job(job_id)
+        except Exception:
+            pass
+
+    Thread(target=run, daemon=True).start()
+
+
+def _print_progress(job: dict):
+    done = f'{job["processed"] / job["total"]:.1%}' if job["total"] else "-"
+    print(f'job {job["job_id"]}: {job["processed"]}/{job["total"]} ({done}), {job["repriced"]} repriced, {job["travels_per_second"]} travels/s')
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2 and sys.argv[1] == "run":
+        job_id = create_job()["job_id"]
+    elif len(sys.argv) == 3 and sys.argv[1] == "resume":
+        job_id = int(sys.argv[2])
+    else:
+        sys.exit("usage: python -m app.repricing run | resume <job_id>")
+
+    result = run_job(job_id, _print_progress)
+    if result is None:
+        sys.exit(f"job {job_id} is done or held by another runner")
+    print(f'job {job_id} done: {result["processed"]} travels, {result["repriced"]} repriced')
@@ -0,0 +1,216 @@
+import random
+from datetime import datetime, timedelta
+from typing import Optional
+from pymongo import ReturnDocument
+from .body import get_next_sequence
+from .config import settings
+from .database import client, trips, seat_counters, reservations, payments
+from .queries import seat_counters_find
+from .status_codes import validate_reservation_held
+from .tasks import task, enqueue
+from . import station_index, timetable
+
+#Seat inventory of scheduled trips. A trip keeps its train's station IDs in position
+#order ("stops"); segment i is the ride from stops[i] to stops[i + 1]. The trip's
+#capacity is split over `shards` seat_counters documents, each holding the seats it
+#still has free per segment. A reservation takes its seats from one shard with one
+#update that checks and decrements every segment it rides:
+#
+#  {"trip_id": 7, "shard": 3, "free.2": {"$gte": 1}, "free.3": {"$gte": 1}}
+#  {"$inc": {"free.2": -1, "free.3": -1}}
+#
+#A shard never goes below zero, so the trip can't be oversold, and concurrent
+#reservations on a busy trip land on SEAT_SHARDS documents instead of queueing on
+#one. A shard without the seats sends the reservation on to the others in random
+#order; near sell-out a multi-seat reservation can fail while the seats are still
+#free in total across shards.
+#
+#A reservation is "held" for HOLD_MINUTES; a payment claims it ("paying") and marks
+#it "paid". An expire_reservation task gives the seats of an unpaid hold back.
+
+PAYING_TIMEOUT = 300    #seconds a claimed reservation waits for its payment before it can expire
+
+def _shard_sizes(capacity: int, shards: int) -> list[int]:
+    return [capacity // shards + (1 if i < capacity % shards else 0) for i in range(shards)]
+
+def create_trip(train_id: int, departs_at: datetime, capacity: int, stop_minutes: list[int] = None, shards: int = None) -> dict:
+    stations = station_index.ordered(train_id)
+    stops = [i["station_id"] for i in stations]
+    shards = max(1, min(shards or settings.seat_shards, capacity))
+
+    if stop_minutes is None:
+        times = timetable.stop_times({"train_id": train_id, "stops": stops, "departs_at": departs_at}, stations)
+    else:
+        times = [departs_at + timedelta(minutes=i) for i in stop_minutes]
+
+    trip = {
+        "trip_id": get_next_sequence("trip_id"),
+        "train_id": train_id,
+        "departs_at": departs_at,
+        "capacity": capacity,
+        "stops": stops,
+        "stop_times": times,
+        "shards": shards,
+        "created_at": datetime.utcnow(),
+        "updated_at": None,
+        "is_deleted": False
+    }
+    #counters first: a trip is never visible without its seats
+    seat_counters.insert_many(seat_counter_docs(trip["trip_id"], capacity, shards, len(stops) - 1))
+    trips.insert_one(trip)
+    timetable.add_trip(trip)
+    return trip
+
+#free seats per segment, summed over the shards
+def available(trip: dict) -> list[int]:
+    free = [0] * (len(trip["stops"]) - 1)
+    for counter in seat_counters_find(trip["trip_id"]):
+        free = [a + b for a, b in zip(free, counter["free"])]
+    return free
+
+#(first, last) segments ridden, None unless both stops are on the trip in this order
+def segments(trip: dict, departure_id: int, arrival_id: int) -> Optional[tuple[int, int]]:
+    stops = trip["stops"]
+    if departure_id not in stops or arrival_id not in stops:
+        return None
+    first, last = stops.index(departure_id), stops.index(arrival_id)
+    return (first, last) if first < last else None
+
+def seat_counter_docs(trip_id: int, capacity: int, shards: int, segment_count: int) -> list[dict]:
+    return [
+        {"trip_id": trip_id, "shard": i, "free": [size] * segment_count}
+        for i, size in enumerate(_shard_sizes(capacity, shards))
+    ]
+
+#takes seats on segments first..last - 1 from one shard; returns the shard, None if none had them
+def take_seats(trip_id: int, shards: int, first: int, last: int, seats: int, counters=seat_counters) -> Optional[int]:
+    decrement = {"$inc": {f"free.{i}": -seats for i in range(first, last)}}
+    order = list(range(shards))
+    random.shuffle(order)
+
+    for shard in order:
+        query = {"trip_id": trip_id, "shard": shard}
+        query.update({f"free.{i}": {"$gte": seats} for i in range(first, last)})
+        if counters.update_one(query, decrement).modified_count == 1:
+            return shard
+    return None
+
+def _give_back(reservation: dict, session=None):
+    seat_counters.update_one(
+        {"trip_id": reservation["trip_id"], "shard": reservation["shard"]},
+        {"$inc": {f"free.{i}": reservation["seats"] for i in range(reservation["first_segment"], reservation["last_segment"])}},
+        session=session
+    )
+
+#the held reservation, or None when no shard has the seats
+def reserve(trip: dict, user_id: int, departure_id: int, arrival_id: int, seats: int, first: int, last: int) -> Optional[dict]:
+    shard = take_seats(trip["trip_id"], trip["shards"], first, last, seats)
+    if shard is None:
+        return None
+
+    now = datetime.utcnow()
+    reservation = {
+        "reservation_id": get_next_sequence("reservation_id"),
+        "trip_id": trip["trip_id"],
+        "train_id": trip["train_id"],
+        "user_id": user_id,
+        "departure_id": departure_id,
+        "arrival_id": arrival_id,
+        "seats": seats,
+        "shard": shard,
+        "first_segment": first,
+        "last_segment": last,
+        "status": "held",
+        "expires_at": now + timedelta(minutes=settings.hold_minutes),
+        "payment_id": None,
+        "created_at": now,
+        "updated_at": None
+    }
+    #the seats are taken before the reservation exists; a failed insert hands them back
+    #(a process dying right in between leaks them until the trip departs)
+    try:
+        reservations.insert_one(dict(reservation))
+    except Exception:
+        _give_back(reservation)
+        raise
+
+    enqueue("expire_reservation", {"reservation_id": reservation["reservation_id"]}, created_by=user_id, delay=settings.hold_minutes * 60)
+    return reservation
+
+#moves a reservation from one of from_statuses to status and frees its seats, in one
+#transaction so a retried task can't free them twice; None if it wasn't in from_statuses
+def release(reservation_id: int, from_statuses: list[str], status: str) -> Optional[dict]:
+    def move(session):
+        reservation = reservations.find_one_and_update(
+            {"reservation_id": reservation_id, "status": {"$in": from_statuses}},
+            {"$set": {"status": status, "updated_at": datetime.utcnow()}},
+            {"_id": 0},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if reservation is not None:
+            _give_back(reservation, session)
+        return reservation
+
+    with client.start_session() as session:
+        return session.with_transaction(move)
+
+def cancel(reservation_id: int) -> Optional[dict]:
+    return release(reservation_id, ["held"], "cancelled")
+
+@task("expire_reservation")
+def expire_reservation(reservation_id: int):
+    reservation = reservations.find_one({"reservation_id": reservation_id}, {"status": 1, "updated_at": 1})
+    if reservation is not None and reservation["status"] == "paying":
+        #a payment replayed from the WAL doesn't mark its reservation paid
+        payment = payments.find_one({"reservation_id": reservation_id, "is_deleted": False}, {"payment_id": 1})
+        if payment is not None:
+            reservations.update_one({"reservation_id": reservation_id}, {"$set": {"status": "paid", "payment_id": payment["payment_id"]}})
+            return
+        if reservation["updated_at"] > datetime.utcnow() - timedelta(seconds=PAYING_TIMEOUT):
+            raise RuntimeError("Payment in progress")     #retried with backoff
+        release(reservation_id, ["paying"], "expired")     #the paying process died
+        return
+    release(reservation_id, ["held"], "expired")
+
+
+#Wraps the part of create_payment that pays for a reservation. Entering claims the
+#held reservation (so it can't expire or be cancelled meanwhile); paid() marks it paid.
+#Leaving with an error puts it back on hold, or expires it if the hold ran out.
+class ReservationClaim:
+    def __init__(self, reservation_id: Optional[int], user_id: int):
+        self.reservation_id = reservation_id
+        self.user_id = user_id
+        self.reservation = None
+
+    def __enter__(self):
+        if self.reservation_id is None:
+            return self
+
+        now = datetime.utcnow()
+        self.reservation = reservations.find_one_and_update(
+            {"reservation_id": self.reservation_id, "user_id": self.user_id, "status": "held", "expires_at": {"$gt": now}},
+            {"$set": {"status": "paying", "updated_at": now}},
+            {"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        validate_reservation_held(self.reservation, self.reservation_id)
+        return self
+
+    def paid(self, payment_id: int):
+        if self.reservation is None:
+            return
+        reservations.update_one(
+            {"reservation_id": self.reservation_id, "status": "paying"},
+            {"$set": {"status": "paid", "payment_id": payment_id, "updated_at": datetime.utcnow()}}
+        )
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.reservation is None or exc_type is None:
+            return False
+
+        if datetime.utcnow() >= self.reservation["expires_at"]:
+            release(self.reservation_id, ["paying"], "expired")
+        else:
+            reservations.update_one({"reservation_id": self.reservation_id, "status": "paying"}, {"$set": {"status": "held"}})
+        return False
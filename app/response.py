@@ -3,6 +3,7 @@ from typing import Annotated, Any, Callable, Literal, Optional
 from pydantic import BaseModel, ConfigDict, Field, EmailStr
 from pydantic_core import core_schema
 from datetime import datetime
+from .body import LineBaseFare, ZoneRule, PeakBand
 
 class _ObjectIdPydanticAnnotation:
     # Based on https://docs.pydantic.dev/latest/usage/types/custom/#handling-third-party-types.
@@ -83,6 +84,7 @@ class StationResponse(BaseModel):
     station_id: int
     name: str
     position: int
+    interchange_group: Optional[str] = None
 
 class TravelResponse(BaseModel):
     model_config = ConfigDict(populate_by_name=True)
@@ -102,6 +104,8 @@ class PaymentResponse(BaseModel):
     travel_id: int
     payment_id: int
     amount: float
+    reservation_id: Optional[int] = None
+    ticket: Optional[str] = None        #signed ticket for the gates, see GET /gates/key
 
 
 class PaymentBalanceResponse(BaseModel):
@@ -109,6 +113,166 @@ class PaymentBalanceResponse(BaseModel):
     balance: BalanceResponse
 
 
+#TRIPS GET
+class TripResponse(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
+    id: PydanticObjectId = Field(alias="_id")
+    trip_id: int
+    train_id: int
+    departs_at: datetime
+    capacity: int
+    stops: list[int]                    #station IDs in order; segment i runs from stops[i] to stops[i + 1]
+    stop_times: Optional[list[datetime]] = None
+    available: Optional[list[int]] = None   #free seats per segment, on single trip reads
+
+class DepartureResponse(BaseModel):
+    trip_id: int
+    train_id: int
+    departure_id: int
+    arrival_id: int
+    departs_at: datetime
+    arrives_at: datetime
+
+class ReservationResponse(BaseModel):
+    reservation_id: int
+    trip_id: int
+    train_id: int
+    user_id: int
+    departure_id: int
+    arrival_id: int
+    seats: int
+    status: Literal["held", "paying", "paid", "cancelled", "expired"]
+    expires_at: datetime
+    payment_id: Optional[int] = None
+    created_at: datetime
+
+
+#GATES
+class TicketKeyResponse(BaseModel):
+    algorithm: Literal["Ed25519"]
+    key_id: str             #hex, also bytes 1-4 of every ticket
+    public_key: str         #raw 32 bytes, base64url
+    ticket_valid_hours: int
+
+class GateScanResponse(BaseModel):
+    valid: bool
+    reason: Optional[Literal["malformed", "unknown_key", "bad_signature", "not_yet_valid", "expired", "already_used", "revoked"]] = None
+    payment_id: Optional[int] = None
+    travel_id: Optional[int] = None
+
+class GateValidationResponse(BaseModel):
+    accepted: int
+    rejected: int
+    results: list[GateScanResponse]
+
+
+class TapBatchResponse(BaseModel):
+    received: int
+    duplicates: int     #already settled in an earlier batch
+    rejected: int       #unknown stations, or users without a balance
+    fares: int
+    penalties: int
+    amount: float       #charged in total
+
+
+#JOURNEYS GET
+class JourneyLegResponse(BaseModel):
+    train_id: int
+    departure_id: int
+    arrival_id: int
+    station_ids: list[int]
+    fare: float
+
+class JourneyResponse(BaseModel):
+    departure_id: int
+    arrival_id: int
+    optimize: Literal["fare", "stops"]
+    total: float
+    stops: int
+    transfers: int
+    legs: list[JourneyLegResponse]
+
+
+#FARES
+class FareConfigResponse(BaseModel):
+    version: int
+    base_fare: float
+    per_station_rate: float
+    line_base_fares: list[LineBaseFare] = []
+    zones: list[ZoneRule] = []
+    per_zone_rate: float = 0
+    peak_bands: list[PeakBand] = []
+    timezone: str = "UTC"
+    max_fare: Optional[float] = None
+    daily_cap: Optional[float] = None
+    created_at: Optional[datetime] = None
+
+class FareQuoteResponse(BaseModel):
+    train_id: int
+    departure_id: int
+    arrival_id: int
+    band: str
+    fare: float
+    config_version: int
+
+class RepricingJobResponse(BaseModel):
+    job_id: int
+    config_version: int
+    status: Literal["pending", "running", "done", "failed"]
+    train_id: Optional[int] = None
+    last_travel_id: Optional[int] = None
+    total: int
+    processed: int
+    repriced: int
+    travels_per_second: Optional[int] = None
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+
+#STATIONS IMPORT POST
+class StationImportErrorResponse(BaseModel):
+    row: int
+    detail: str
+
+class StationImportResponse(BaseModel):
+    mode: Literal["append", "replace"]
+    inserted: int
+    errors: list[StationImportErrorResponse]
+
+
+#LOGIN SESSIONS GET
+class SessionResponse(BaseModel):
+    session_id: int
+    user_agent: Optional[str] = None
+    created_at: datetime
+    last_used_at: datetime
+    expires_at: datetime
+    current: bool = False
+
+
+#TASKS GET
+class TaskResponse(BaseModel):
+    task_id: int
+    name: str
+    args: dict[str, Any]
+    status: Literal["pending", "running", "done", "dead"]
+    attempts: int
+    max_attempts: int
+    run_at: datetime
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+#cascade deletes
+class TaskAcceptedResponse(BaseModel):
+    detail: str
+    task_id: int
+
+
 #ADMIN RESPONSES
 class UserAdminResponse(UserResponse):
     created_at: datetime
@@ -144,6 +308,11 @@ class TravelAdminResponse(TravelResponse):
     updated_at: Optional[datetime] = None
     is_deleted: bool
 
+class TripAdminResponse(TripResponse):
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+    is_deleted: bool
+
 class PaymentAdminResponse(PaymentResponse):
     created_at: datetime
     updated_at: Optional[datetime] = None
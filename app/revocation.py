@@ -0,0 +1,172 @@
+import hashlib
+import math
+from datetime import datetime, timedelta
+from threading import Lock
+from time import monotonic, time
+from .config import settings
+from .database import revoked_tokens
+
+#Revoked access tokens. Single tokens (logout) are keyed by their jti; revoking every
+#session of a user (logout-all, deleted users) stores a cutoff and revokes the user's
+#tokens issued before it. Entries live in a TTL-indexed collection until the tokens
+#they cover would have expired anyway.
+#
+#Each process mirrors the collection into a Bloom filter plus exact maps, synced
+#incrementally every SYNC_INTERVAL seconds, so checking a token is a couple of hashes
+#with no database access unless the filter matches.
+
+SYNC_INTERVAL = 1           #seconds; revocations from other workers apply within this
+SYNC_OVERLAP = 30           #seconds re-read before the newest revoked_at seen; an entry
+                            #committed late or stamped by a slower clock is still picked up
+BLOOM_CAPACITY = 100_000    #entries before the filter is rebuilt larger
+BLOOM_ERROR_RATE = 0.01
+
+TOKEN_LIFETIME = timedelta(minutes=settings.token_minutes)
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+class RevocationList:
+    def __init__(self, capacity: int = BLOOM_CAPACITY):
+        self.tokens: dict[str, datetime] = {}              #jti -> expires_at
+        self.users: dict[int, tuple[float, datetime]] = {} #user_id -> (revoked before iat, expires_at)
+        self.filter = BloomFilter(capacity, BLOOM_ERROR_RATE)
+        self.lock = Lock()
+
+    def add(self, entry: dict):
+        with self.lock:
+            if entry["kind"] == "token":
+                if entry["key"] in self.tokens:
+                    return
+                self.tokens[entry["key"]] = entry["expires_at"]
+                self.filter.add(f'token:{entry["key"]}')
+            else:
+                user_id = int(entry["key"])
+                cutoff = max(entry["revoked_before"], self.users.get(user_id, (0, None))[0])
+                self.users[user_id] = (cutoff, entry["expires_at"])
+                self.filter.add(f"user:{user_id}")
+
+            if len(self.tokens) + len(self.users) > self.filter.capacity:
+                self._rebuild(self.filter.capacity * 2)
+
+    #drops expired entries; the filter can't forget keys, so it is rebuilt
+    def prune(self, now: datetime):
+        with self.lock:
+            expired_tokens = [k for k, expires_at in self.tokens.items() if expires_at <= now]
+            expired_users = [k for k, (_, expires_at) in self.users.items() if expires_at <= now]
+            if not expired_tokens and not expired_users:
+                return
+
+            for i in expired_tokens:
+                del self.tokens[i]
+            for i in expired_users:
+                del self.users[i]
+            self._rebuild(self.filter.capacity)
+
+    def _rebuild(self, capacity: int):
+        bloom = BloomFilter(capacity, BLOOM_ERROR_RATE)
+        for jti in self.tokens:
+            bloom.add(f"token:{jti}")
+        for user_id in self.users:
+            bloom.add(f"user:{user_id}")
+        self.filter = bloom
+
+    #True/False when the local mirror knows, None when only the filter matched
+    def check(self, jti: str, user_id: int, issued_at: float):
+        token_hit = jti is not None and f"token:{jti}" in self.filter
+        user_hit = f"user:{user_id}" in self.filter
+        if not token_hit and not user_hit:
+            return False
+
+        if token_hit and jti in self.tokens:
+            return True
+        if user_hit and user_id in self.users and (issued_at is None or issued_at < self.users[user_id][0]):
+            return True
+
+        if (token_hit and jti not in self.tokens) or (user_hit and user_id not in self.users):
+            return None
+        return False
+
+
+revoked = RevocationList()
+_synced_until: datetime = None      #newest revoked_at seen
+_next_sync = 0.0
+_sync_lock = Lock()
+
+
+def _token_expiry(expires_at: int) -> datetime:
+    return datetime.utcfromtimestamp(expires_at)
+
+#pulls entries revoked since the last sync, re-reading SYNC_OVERLAP seconds before it
+#(entries already mirrored are skipped); one thread syncs while the others go on
+def sync():
+    global _synced_until, _next_sync
+
+    if monotonic() < _next_sync or not _sync_lock.acquire(blocking=False):
+        return
+    try:
+        now = datetime.utcnow()
+        query = {"expires_at": {"$gt": now}}
+        if _synced_until is not None:
+            query["revoked_at"] = {"$gte": _synced_until - timedelta(seconds=SYNC_OVERLAP)}
+
+        for entry in revoked_tokens.find(query, {"_id": 0}).sort("revoked_at", 1):
+            revoked.add(entry)
+            if _synced_until is None or entry["revoked_at"] > _synced_until:
+                _synced_until = entry["revoked_at"]
+
+        revoked.prune(now)
+        _next_sync = monotonic() + SYNC_INTERVAL
+    finally:
+        _sync_lock.release()
+
+def is_revoked(jti: str, user_id: int, issued_at: float) -> bool:
+    sync()
+
+    result = revoked.check(jti, user_id, issued_at)
+    if result is not None:
+        return result
+
+    #filter hit the mirror can't confirm: a false positive, or an entry not synced yet
+    query = [{"kind": "user", "key": str(user_id), "revoked_before": {"$gt": issued_at or 0}}]
+    if jti is not None:
+        query.append({"kind": "token", "key": jti})
+    return revoked_tokens.find_one({"$or": query, "expires_at": {"$gt": datetime.utcnow()}}, {"_id": 1}) is not None
+
+
+def _store(entry: dict):
+    revoked_tokens.insert_one(dict(entry))
+    revoked.add(entry)
+
+def revoke_token(jti: str, expires_at: int):
+    _store({"kind": "token", "key": jti, "revoked_at": datetime.utcnow(), "expires_at": _token_expiry(expires_at)})
+
+#every token of the user issued up to now; iat carries fractions of a second, so a
+#login right after this keeps its token
+def revoke_user(user_id: int):
+    now = datetime.utcnow()
+    _store({
+        "kind": "user",
+        "key": str(user_id),
+        "revoked_before": time(),
+        "revoked_at": now,
+        "expires_at": now + TOKEN_LIFETIME + timedelta(seconds=1)
+    })
@@ -3,10 +3,12 @@ from ..response import BalanceResponse, BalanceAdminResponse
 from ..updates import BalancePut
 from ..status_codes import validate_user_exists, validate_logged_in_user, validate_required_roles
 from datetime import datetime
-from ..queries import balances, balances_find_one, users_find_one, balances_delete_one, balances_update_one
-from typing import Union
+from ..queries import balances, users
+from typing import Optional, Union
 from ..oauth2 import get_current_user
 from ..body import TokenData
+from ..projections import EXISTS, parse_fields, projection, sparse_response
+from .. import events, balance_store
 
 router = APIRouter(
     prefix="/users/{user_id}/balances",
@@ -14,22 +16,26 @@ router = APIRouter(
 )
 
 balances.create_index("balance_id", unique=True)
+users.create_index("balance.balance_id", unique=True, partialFilterExpression={"balance.balance_id": {"$exists": True}})
 
 @router.get("/", response_model=Union[BalanceResponse, BalanceAdminResponse])
-def get_balance(user_id: int, current_user: TokenData = Depends(get_current_user)):
+def get_balance(user_id: int, fields: Optional[str] = None, current_user: TokenData = Depends(get_current_user)):
     validate_required_roles(current_user.role, ["user", "admin"])
     if current_user.role == "user":
         validate_logged_in_user(current_user.id, user_id)
 
-    user = users_find_one(user_id)
-    validate_user_exists(user, user_id)
-
-    balance = balances_find_one(user_id)
-
     if current_user.role == "user":
-        return BalanceResponse(**balance)
+        model = BalanceResponse
     else:
-        return BalanceAdminResponse(**balance)
+        model = BalanceAdminResponse
+    fields = parse_fields(model, fields)
+
+    user, balance = balance_store.find_with_user(user_id, projection=projection(model, fields))
+    validate_user_exists(user, user_id)
+
+    if fields:
+        return sparse_response(model, balance, fields)
+    return model(**balance)
 
 
 @router.put("/", response_model=BalanceAdminResponse)
@@ -37,14 +43,16 @@ def put_balance(user_id: int, balance: BalancePut, current_user: TokenData = Dep
     try:
         validate_required_roles(current_user.role, ["admin"])
  
-        user = users_find_one(user_id)
+        user, _ = balance_store.find_with_user(user_id, projection=EXISTS)
         validate_user_exists(user, user_id)
 
         put_data = balance.dict()
         put_data["updated_at"] = datetime.utcnow()
 
-        balances_update_one(user_id, put_data)
-        balance = balances_find_one(user_id)
+        balance_store.update(user_id, put_data)
+        balance = balance_store.find(user_id)
+        if balance:
+            events.publish(user_id, "balance", BalanceResponse(**balance))
 
         return balance
     
@@ -59,10 +67,10 @@ def hard_delete_balance(user_id: int, current_user: TokenData = Depends(get_curr
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        user = users_find_one(user_id)
+        user, _ = balance_store.find_with_user(user_id, projection=EXISTS)
         validate_user_exists(user, user_id)
 
-        balances_delete_one(user_id)
+        balance_store.delete(user_id)
 
         return
 
@@ -79,10 +87,10 @@ def soft_delete_balance(user_id: int, current_user: TokenData = Depends(get_curr
         if current_user.role == "user":
             validate_logged_in_user(current_user.id, user_id)
 
-        user = users_find_one(user_id)
+        user, _ = balance_store.find_with_user(user_id, projection=EXISTS)
         validate_user_exists(user, user_id)
 
-        balances_update_one(user_id, {"is_deleted": True})
+        balance_store.update(user_id, {"is_deleted": True})
         
         return {"detail": "User's balance softly deleted"}
     
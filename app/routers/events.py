@@ -0,0 +1,29 @@
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
+from ..body import TokenData
+from ..status_codes import validate_logged_in_user, validate_required_roles, validate_user_exists
+from ..queries import users_find_one
+from ..oauth2 import get_current_user
+from ..projections import EXISTS
+from .. import events
+
+router = APIRouter(
+    prefix="/users/{user_id}/events",
+    tags=["Events"]
+)
+
+#server-sent events: balance, transaction and payment changes as they commit
+@router.get("/")
+def get_events(user_id: int, request: Request, current_user: TokenData = Depends(get_current_user)):
+    validate_required_roles(current_user.role, ["user", "admin"])
+    if current_user.role == "user":
+        validate_logged_in_user(current_user.id, user_id)
+
+    user = users_find_one(user_id, EXISTS)
+    validate_user_exists(user, user_id)
+
+    return StreamingResponse(
+        events.stream(user_id, request.is_disconnected, current_user),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -0,0 +1,102 @@
+from fastapi import APIRouter, status, HTTPException, Depends
+from ..body import FareConfig, get_next_sequence, TokenData
+from ..response import FareConfigResponse, RepricingJobResponse
+from ..queries import fare_configs, repricing_jobs, fare_configs_find, repricing_jobs_find_one
+from ..status_codes import validate_required_roles, validate_fare_timezone, validate_repricing_job_exists, validate_repricing_job_resumable
+from typing import List
+from datetime import datetime
+from ..oauth2 import get_current_user
+from .. import fares, fare_engine, repricing
+
+router = APIRouter(
+    prefix="/fares",
+    tags=["Fares"]
+)
+
+fare_configs.create_index("version", unique=True)
+repricing_jobs.create_index("job_id", unique=True)
+
+@router.get("/config", response_model=FareConfigResponse)
+def get_fare_config(current_user: TokenData = Depends(get_current_user)):
+    validate_required_roles(current_user.role, ["user", "admin"])
+
+    return fares.current_config()
+
+#newest version first
+@router.get("/configs", response_model=List[FareConfigResponse])
+def get_fare_configs(current_user: TokenData = Depends(get_current_user)):
+    validate_required_roles(current_user.role, ["admin"])
+
+    return list(fare_configs_find())
+
+#applies to new quotes and payments right away (fare tables recompile on the new version);
+#stored travel totals change when a repricing job runs
+@router.post("/configs", status_code=status.HTTP_201_CREATED, response_model=FareConfigResponse)
+def create_fare_config(config: FareConfig, current_user: TokenData = Depends(get_current_user)):
+    try:
+        validate_required_roles(current_user.role, ["admin"])
+        validate_fare_timezone(fare_engine.valid_timezone(config.timezone), config.timezone)
+
+        config_data = {
+            "version": get_next_sequence("fare_config_version"),
+            **config.dict(),
+            "created_at": datetime.utcnow()
+        }
+
+        fare_configs.insert_one(dict(config_data))
+        fares.invalidate()
+
+        return config_data
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
+#reprices every travel against the current fare config in the background
+@router.post("/repricing", status_code=status.HTTP_202_ACCEPTED, response_model=RepricingJobResponse)
+def create_repricing_job(current_user: TokenData = Depends(get_current_user)):
+    try:
+        validate_required_roles(current_user.role, ["admin"])
+
+        fares.invalidate()
+        job = repricing.create_job()
+        repricing.start_job(job["job_id"])
+
+        return job
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
+@router.get("/repricing/{job_id}", response_model=RepricingJobResponse)
+def get_repricing_job(job_id: int, current_user: TokenData = Depends(get_current_user)):
+    validate_required_roles(current_user.role, ["admin"])
+
+    job = repricing_jobs_find_one(job_id)
+    validate_repricing_job_exists(job, job_id)
+
+    return job
+
+#continues from the last checkpoint of a failed or interrupted job
+@router.post("/repricing/{job_id}/resume", status_code=status.HTTP_202_ACCEPTED, response_model=RepricingJobResponse)
+def resume_repricing_job(job_id: int, current_user: TokenData = Depends(get_current_user)):
+    try:
+        validate_required_roles(current_user.role, ["admin"])
+
+        job = repricing_jobs_find_one(job_id)
+        validate_repricing_job_exists(job, job_id)
+        validate_repricing_job_resumable(job)
+
+        repricing.start_job(job_id)
+
+        return job
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
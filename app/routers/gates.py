@@ -0,0 +1,57 @@
+from fastapi import APIRouter, status, HTTPException, Depends
+from ..body import GateScans, TapBatch, TokenData
+from ..response import TicketKeyResponse, GateValidationResponse, TapBatchResponse
+from ..config import settings
+from ..status_codes import validate_required_roles
+from ..oauth2 import get_current_user
+from ..database import tap_charges, used_tickets
+from .. import tickets, taps
+
+router = APIRouter(
+    prefix="/gates",
+    tags=["Gates"]
+)
+
+tap_charges.create_index([("user_id", 1), ("created_at", 1)])
+used_tickets.create_index("expires_at", expireAfterSeconds=0)
+
+#public, so gates can verify tickets offline
+@router.get("/key", response_model=TicketKeyResponse)
+def get_ticket_key():
+    return {
+        "algorithm": "Ed25519",
+        "key_id": tickets.key_id.hex(),
+        "public_key": tickets.b64encode(tickets.public_key_bytes),
+        "ticket_valid_hours": settings.ticket_valid_hours
+    }
+
+#checks a batch of scans in order; a ticket is accepted once
+@router.post("/validate", response_model=GateValidationResponse)
+def validate_scans(scans: GateScans, current_user: TokenData = Depends(get_current_user)):
+    try:
+        validate_required_roles(current_user.role, ["admin"])
+
+        results = tickets.validate_batch(scans.tokens)
+        accepted = sum(1 for i in results if i["valid"])
+
+        return {"accepted": accepted, "rejected": len(results) - accepted, "results": results}
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
+#tap-in/tap-out events from card gates, paired and settled in one go, see app/taps.py
+@router.post("/taps", response_model=TapBatchResponse)
+def ingest_taps(batch: TapBatch, current_user: TokenData = Depends(get_current_user)):
+    try:
+        validate_required_roles(current_user.role, ["admin"])
+
+        return taps.ingest([i.dict() for i in batch.events])
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
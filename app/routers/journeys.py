@@ -0,0 +1,25 @@
+from fastapi import APIRouter, status, HTTPException, Depends
+from ..body import TokenData
+from ..response import JourneyResponse
+from ..status_codes import validate_required_roles, validate_journey_exists
+from typing import Literal
+from ..oauth2 import get_current_user
+from .. import journey
+
+router = APIRouter(
+    prefix="/journeys",
+    tags=["Journeys"]
+)
+
+#route between any two stations, transferring between trains at interchange groups
+@router.get("/", response_model=JourneyResponse)
+def get_journey(departure_id: int, arrival_id: int, optimize: Literal["fare", "stops"] = "fare", current_user: TokenData = Depends(get_current_user)):
+    validate_required_roles(current_user.role, ["user", "admin"])
+
+    if departure_id == arrival_id:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Departure and arrival stations must be different")
+
+    planned_journey = journey.plan(departure_id, arrival_id, optimize)
+    validate_journey_exists(planned_journey, departure_id, arrival_id)
+
+    return planned_journey
@@ -1,17 +1,42 @@
-from fastapi import APIRouter, status, HTTPException, Depends
+from fastapi import APIRouter, status, HTTPException, Depends, Request
 from ..queries import users
-from ..body import LoggedInToken
+from ..database import revoked_tokens, sessions
+from ..body import LoggedInToken, TokenData, RefreshRequest
+from ..response import SessionResponse
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
 from ..utils import verify
-from ..oauth2 import create_token
+from ..oauth2 import create_token, get_current_user
+from .. import revocation, sessions as login_sessions
+from ..rate_limit import limit_by_ip
 
 router = APIRouter(
     prefix="/login",
     tags=["Login"]
 )
 
-@router.post("/", response_model=LoggedInToken)
-def user_login(credentials: OAuth2PasswordRequestForm = Depends()):
+revoked_tokens.create_index("expires_at", expireAfterSeconds=0)
+revoked_tokens.create_index("revoked_at")
+revoked_tokens.create_index([("kind", 1), ("key", 1)])
+
+sessions.create_index("token_hash", unique=True)
+sessions.create_index("previous_hashes")
+sessions.create_index("session_id", unique=True)
+sessions.create_index([("user_id", 1), ("session_id", -1)])
+sessions.create_index("expires_at", expireAfterSeconds=0)
+
+def _tokens(session: dict, refresh_token: str) -> dict:
+    access_token = create_token(data={"user_id": session["user_id"], "role": session["role"], "sid": session["session_id"]})
+
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "user_id": session["user_id"],
+        "role": session["role"],
+        "refresh_token": refresh_token
+    }
+
+@router.post("/", response_model=LoggedInToken, dependencies=[Depends(limit_by_ip("login"))])
+def user_login(request: Request, credentials: OAuth2PasswordRequestForm = Depends()):
     user = users.find_one({"email": credentials.username})
 
     if not user:
@@ -22,6 +47,89 @@ def user_login(credentials: OAuth2PasswordRequestForm = Depends()):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail="Invalid credentials.")
     
-    access_token = create_token(data={"user_id": user["user_id"], "role": user["role"]})
+    session, refresh_token = login_sessions.create(user["user_id"], user["role"], request.headers.get("user-agent"))
+
+    return _tokens(session, refresh_token)
+
+#new access and refresh tokens for a refresh token, which can't be used again
+@router.post("/refresh", response_model=LoggedInToken, dependencies=[Depends(limit_by_ip("refresh"))])
+def refresh(body: RefreshRequest):
+    try:
+        session, refresh_token = login_sessions.rotate(body.refresh_token)
+        if session is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                                detail="Invalid refresh token.")
+
+        return _tokens(session, refresh_token)
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
+#active sessions of the current user
+@router.get("/sessions", response_model=list[SessionResponse])
+def get_sessions(current_user: TokenData = Depends(get_current_user)):
+    try:
+        return [
+            {**session, "current": session["session_id"] == current_user.session_id}
+            for session in login_sessions.list_sessions(current_user.id)
+        ]
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
+#ends a session: its refresh token stops working, issued access tokens run out
+@router.delete("/sessions/{session_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_session(session_id: int, current_user: TokenData = Depends(get_current_user)):
+    try:
+        if not login_sessions.revoke(current_user.id, session_id):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"Session with session_id: {session_id} was not found.")
+
+        return
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
+#revokes the token used for this request and its session
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+def logout(current_user: TokenData = Depends(get_current_user)):
+    try:
+        if current_user.session_id is not None:
+            login_sessions.revoke(current_user.id, current_user.session_id)
+
+        if current_user.jti is not None:
+            revocation.revoke_token(current_user.jti, current_user.expires_at)
+        else:
+            revocation.revoke_user(current_user.id)
+
+        return
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
+#revokes every token and session of the current user so far
+@router.post("/logout-all", status_code=status.HTTP_204_NO_CONTENT)
+def logout_all(current_user: TokenData = Depends(get_current_user)):
+    try:
+        login_sessions.revoke_user(current_user.id)
+        revocation.revoke_user(current_user.id)
+
+        return
+
+    except HTTPException:
+        raise
 
-    return {"access_token": access_token, "token_type": "bearer", "user_id": user["user_id"], "role": user["role"]}
\ No newline at end of file
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
@@ -0,0 +1,19 @@
+from fastapi import APIRouter, Depends
+from ..body import TokenData
+from ..status_codes import validate_required_roles
+from ..oauth2 import get_current_user
+from .. import singleflight, events
+
+router = APIRouter(
+    prefix="/metrics",
+    tags=["Metrics"]
+)
+
+@router.get("/")
+def get_metrics(current_user: TokenData = Depends(get_current_user)):
+    validate_required_roles(current_user.role, ["admin"])
+
+    return {
+        "singleflight": singleflight.reads.stats(),
+        "events": events.broker.stats()
+    }
@@ -1,78 +1,139 @@
-from fastapi import APIRouter, status, HTTPException, Depends
-from ..queries import payments_delete_one, payments_update_one, payments_find, payments_find_one, payments, travels_find_by_id, users_find_one, balances, balances_find_one, balances_update_one
+from fastapi import APIRouter, status, HTTPException, Depends, Header, Response
+from ..queries import payments_delete_one, payments_update_one, payments_find, payments_find_one, payments, travels_find_by_id, users_find_one, reservations_find_by_id
 from ..body import get_next_sequence, Payment, TokenData
 from ..updates import PaymentPut
-from ..response import PaymentResponse, PaymentAdminResponse, PaymentBalanceResponse, PaymentBalanceAdminResponse 
-from ..status_codes import validate_logged_in_user, validate_required_roles, validate_payment_exists, validate_user_exists, validate_balance_exists, validate_travel_exists
-from typing import List, Union
+from ..response import BalanceResponse, PaymentResponse, PaymentAdminResponse, PaymentBalanceResponse, PaymentBalanceAdminResponse 
+from ..status_codes import validate_logged_in_user, validate_required_roles, validate_payment_exists, validate_user_exists, validate_balance_exists, validate_balance_unchanged, validate_travel_exists, validate_reservation_travel
+from typing import List, Literal, Optional, Union
 from datetime import datetime
 from ..oauth2 import get_current_user
+from ..idempotency import IdempotencyClaim
+from ..rate_limit import limit_by_user
+from ..projections import EXISTS, parse_fields, projection, sparse_response
+from ..filters import PAYMENT_INDEXES, history_query
+from .. import wal, events, fare_engine, balance_store, tiering, reservations, tickets
 
 router = APIRouter(
     prefix="/users/{user_id}/payments",
-    tags=["Payments"]
+    tags=["Payments"],
+    dependencies=[Depends(limit_by_user("payments"))]
 )
 
 payments.create_index("payment_id", unique=True)
+for index in PAYMENT_INDEXES.values():
+    payments.create_index(index)
+payments.create_index("reservation_id", partialFilterExpression={"reservation_id": {"$gt": 0}})
 
 @router.get("/", response_model=List[Union[PaymentResponse, PaymentAdminResponse]])
-def get_payments(user_id: int, current_user: TokenData = Depends(get_current_user)):
+def get_payments(
+    user_id: int,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    travel_id: Optional[int] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    sort: Literal["created_at", "-created_at", "amount", "-amount"] = "created_at",
+    fields: Optional[str] = None,
+    current_user: TokenData = Depends(get_current_user)
+):
     validate_required_roles(current_user.role, ["user", "admin"])
     if current_user.role == "user":
         validate_logged_in_user(current_user.id, user_id)
 
-    existing_payments = payments_find(user_id)
-    
     if current_user.role == "user":
-        return [PaymentResponse(**i) for i in existing_payments]
+        model = PaymentResponse
     else:
-        return [PaymentAdminResponse(**i) for i in existing_payments]
+        model = PaymentAdminResponse
+    fields = parse_fields(model, fields)
+
+    filters, sort_by, index = history_query(
+        PAYMENT_INDEXES,
+        {"travel_id": travel_id},
+        {"created_at": (created_from, created_to), "amount": (min_amount, max_amount)},
+        sort
+    )
+
+    #months past the retention cutoff are read from cold storage
+    existing_payments = tiering.with_cold(
+        "payments", user_id,
+        lambda fields_projection: payments_find(user_id, fields_projection, filters, sort_by, index),
+        filters, sort_by, projection(model, fields)
+    )
+
+    if fields:
+        return sparse_response(model, existing_payments, fields)
+    return [model(**i) for i in existing_payments]
 
 @router.post("/", response_model=PaymentBalanceResponse, status_code=status.HTTP_201_CREATED)
-def create_payment(user_id: int, payment: Payment, current_user: TokenData = Depends(get_current_user)):
+def create_payment(user_id: int, payment: Payment, response: Response, idempotency_key: Optional[str] = Header(None, max_length=255), current_user: TokenData = Depends(get_current_user)):
     try:
         validate_required_roles(current_user.role, ["user"])
         validate_logged_in_user(current_user.id, user_id)
 
-        user = users_find_one(user_id)
-        validate_user_exists(user, user_id)
-
-        balance = balances_find_one(user_id)
-        validate_balance_exists(balance, user_id)
-
-        travel = travels_find_by_id(payment.travel_id)
-        validate_travel_exists(travel, payment.travel_id)
-
-        user_balance_total = balance["total"]
-        travel_total = travel["total"]
-
-        if user_balance_total - travel_total < 0:
-            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Total balance not sufficient")
-        else:
-            new_balance = user_balance_total - travel_total
-
-        balances_update_one(user_id, {"total": new_balance})
-
-        updated_balance = balances_find_one(user_id)
-
-        payment_id = get_next_sequence("payment_id")
-        payment_data = {
-            "user_id": user_id,
-            "payment_id": payment_id,
-            **payment.dict(),
-            "amount": travel_total,
-            "created_at": datetime.utcnow(),
-            "updated_at": None,
-            "is_deleted": False
-        }
-
-        result = payments.insert_one(payment_data)
-        created_payment = payments.find_one({"_id": result.inserted_id})
-
-        return {
-            "payment": created_payment,
-            "balance": updated_balance
-        }
+        with IdempotencyClaim(f"payments:{user_id}", idempotency_key, payment.dict()) as claim:
+            if claim.replay is not None:
+                response.headers["Idempotent-Replayed"] = "true"
+                return claim.replay
+
+            user, balance = balance_store.find_with_user(user_id)
+            validate_user_exists(user, user_id)
+            validate_balance_exists(balance, user_id)
+
+            travel = travels_find_by_id(payment.travel_id)
+            validate_travel_exists(travel, payment.travel_id)
+
+            #a reservation stays claimed while it is paid for, see app/reservations.py
+            with reservations.ReservationClaim(payment.reservation_id, user_id) as reservation_claim:
+                seats = 1
+                if reservation_claim.reservation is not None:
+                    validate_reservation_travel(reservation_claim.reservation, travel)
+                    seats = reservation_claim.reservation["seats"]
+
+                user_balance_total = balance["total"]
+                travel_total = fare_engine.fare_due(user_id, travel, seats=seats)
+
+                if user_balance_total - travel_total < 0:
+                    raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Total balance not sufficient")
+                else:
+                    new_balance = user_balance_total - travel_total
+
+                payment_id = get_next_sequence("payment_id")
+                payment_data = {
+                    "user_id": user_id,
+                    "payment_id": payment_id,
+                    **payment.dict(),
+                    "amount": travel_total,
+                    "created_at": datetime.utcnow(),
+                    "updated_at": None,
+                    "is_deleted": False
+                }
+                payment_data["ticket"] = tickets.issue(payment_data)
+
+                #logged before either write so a half-applied payment can be replayed
+                op_id = wal.begin("payments", {"payment_id": payment_id}, {"balance_id": balance["balance_id"]}, user_balance_total, new_balance, insert=payment_data)
+
+                #only if the total is still the one checked above
+                updated_balance = balance_store.change_total(balance["balance_id"], user_balance_total, new_balance)
+                if updated_balance is None:
+                    wal.abort(op_id)
+                validate_balance_unchanged(updated_balance)
+                claim.applied()
+
+                result = payments.insert_one(payment_data)
+                created_payment = payments.find_one({"_id": result.inserted_id})
+                reservation_claim.paid(payment_id)
+
+                wal.commit(op_id)
+                events.publish(user_id, "payment", PaymentResponse(**created_payment))
+                events.publish(user_id, "balance", BalanceResponse(**updated_balance))
+
+                response_data = {
+                    "payment": created_payment,
+                    "balance": updated_balance
+                }
+                claim.save(response_data)
+
+                return response_data
     
     except HTTPException:
         raise 
@@ -81,64 +142,83 @@ def create_payment(user_id: int, payment: Payment, current_user: TokenData = Dep
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
     
 @router.get("/{payment_id}", response_model=Union[PaymentResponse, PaymentAdminResponse])
-def get_payment(user_id: int, payment_id: int, current_user: TokenData = Depends(get_current_user)):
+def get_payment(user_id: int, payment_id: int, fields: Optional[str] = None, current_user: TokenData = Depends(get_current_user)):
     validate_required_roles(current_user.role, ["user", "admin"])
     if current_user.role == "user":
         validate_logged_in_user(current_user.id, user_id)
 
-    user = users_find_one(user_id)
+    if current_user.role == "user":
+        model = PaymentResponse
+    else:
+        model = PaymentAdminResponse
+    fields = parse_fields(model, fields)
+
+    user = users_find_one(user_id, EXISTS)
     validate_user_exists(user, user_id)
 
-    payment = payments_find_one(user_id, payment_id)
+    payment = payments_find_one(user_id, payment_id, projection(model, fields))
+    if payment is None:
+        payment = tiering.find_one("payments", user_id, payment_id, projection=projection(model, fields))
     validate_payment_exists(payment, payment_id)
 
-    if current_user.role == "user":
-        return PaymentResponse(**payment)
-    else:
-        return PaymentAdminResponse(**payment)
+    if fields:
+        return sparse_response(model, payment, fields)
+    return model(**payment)
 
 @router.put("/{payment_id}", response_model=PaymentBalanceAdminResponse)
 def put_payment(user_id: int, payment_id: int, payment: PaymentPut, current_user: TokenData = Depends(get_current_user)):
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        user = users_find_one(user_id)
+        user, existing_balance = balance_store.find_with_user(user_id)
         validate_user_exists(user, user_id)
 
         existing_payment = payments_find_one(user_id, payment_id)
         validate_payment_exists(existing_payment, payment_id)
 
-        existing_balance = balances_find_one(user_id)
         validate_balance_exists(existing_balance, user_id)
 
-        # Revert previous travel total to balance (refund)
-        previous_travel = travels_find_by_id(existing_payment["travel_id"])
-
-        validate_travel_exists(previous_travel, existing_payment["travel_id"])
-
-        reverted_balance_total = existing_balance["total"] + previous_travel["total"]
+        # Revert what was charged to balance (refund)
+        reverted_balance_total = existing_balance["total"] + existing_payment["amount"]
 
         # Fetch and validate new travel
         new_travel = travels_find_by_id(payment.travel_id)
         validate_travel_exists(new_travel, payment.travel_id)
 
-        new_travel_total = new_travel["total"]
+        #priced like create_payment, for the seats of the payment's reservation
+        seats = 1
+        if existing_payment.get("reservation_id"):
+            reservation = reservations_find_by_id(existing_payment["reservation_id"], {"seats": 1})
+            seats = reservation["seats"] if reservation else 1
+        new_travel_total = fare_engine.fare_due(user_id, new_travel, payment_id, seats)
 
         if reverted_balance_total < new_travel_total:
             raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Total balance not sufficient for updated travel")
 
         updated_balance_total = reverted_balance_total - new_travel_total
         
-        balances_update_one(user_id, {"total": updated_balance_total})
-        updated_balance = balances_find_one(user_id)
-
         updated_data = {
             "travel_id": payment.travel_id,
+            "amount": new_travel_total,
             "updated_at": datetime.utcnow()
         }
+        #a ticket names the travel; the old one is revoked below
+        updated_data["ticket"] = tickets.issue({**existing_payment, **updated_data})
+
+        op_id = wal.begin("payments", {"payment_id": payment_id}, {"balance_id": existing_balance["balance_id"]}, existing_balance["total"], updated_balance_total, update=updated_data)
+
+        updated_balance = balance_store.change_total(existing_balance["balance_id"], existing_balance["total"], updated_balance_total)
+        if updated_balance is None:
+            wal.abort(op_id)
+        validate_balance_unchanged(updated_balance)
 
         payments_update_one(user_id, payment_id, updated_data)
         updated_payment = payments_find_one(user_id, payment_id)
+        tickets.revoke(existing_payment.get("ticket"))
+
+        wal.commit(op_id)
+        events.publish(user_id, "payment", PaymentResponse(**updated_payment))
+        events.publish(user_id, "balance", BalanceResponse(**updated_balance))
 
         return {
             "payment": updated_payment,
@@ -156,13 +236,14 @@ def hard_delete_payment(user_id: int, payment_id: int, current_user: TokenData =
     try:
         validate_required_roles(current_user.role, ["admin"])
         
-        user = users_find_one(user_id)
+        user = users_find_one(user_id, EXISTS)
         validate_user_exists(user, user_id)
 
         existing_payment = payments_find_one(user_id, payment_id)
         validate_payment_exists(existing_payment, payment_id)
 
         payments_delete_one(user_id, payment_id)
+        tickets.revoke(existing_payment.get("ticket"))
 
         return
 
@@ -179,13 +260,14 @@ def soft_delete_payment(user_id: int, payment_id: int, current_user: TokenData =
         if current_user.role == "user":
             validate_logged_in_user(current_user.id, user_id)
 
-        user = users_find_one(user_id)
+        user = users_find_one(user_id, EXISTS)
         validate_user_exists(user, user_id)
 
         existing_payment = payments_find_one(user_id, payment_id)
         validate_payment_exists(existing_payment, payment_id)
 
         payments_update_one(user_id, payment_id, {"is_deleted": True})
+        tickets.revoke(existing_payment.get("ticket"))
 
         return {"detail": f"Payment with id {payment_id} softly deleted"}
 
@@ -1,12 +1,19 @@
-from fastapi import status, APIRouter, HTTPException, Depends
+from fastapi import status, APIRouter, HTTPException, Depends, Query, Request, Response, UploadFile
 from ..body import Station, get_next_sequence, TokenData
 from ..updates import StationPatch, StationPut
-from ..response import StationAdminResponse, StationResponse
-from ..queries import stations, stations_find_one, trains_find_one, stations_update_one, stations_delete_one, stations_find
-from ..status_codes import validate_station_exists, validate_train_exists, validate_required_roles
-from typing import List, Union
+from ..response import StationAdminResponse, StationResponse, StationImportResponse
+from ..queries import (
+    stations, stations_find_one, trains_find_one, stations_update_one, stations_delete_one, stations_shift_positions, stations_position_taken,
+    trains_bump_stations_version
+)
+from ..database import client
+from ..status_codes import validate_station_exists, validate_train_exists, validate_required_roles, validate_station_position_available, validate_import_format
+from typing import List, Literal, Optional, Union
 from datetime import datetime
 from ..oauth2 import get_current_user
+from .. import station_index, journey, timetable, singleflight, etags, fare_products, station_import, repricing, cascades
+from ..singleflight import serialize_list
+from ..projections import EXISTS, parse_fields, projection, select_model, sparse_response
 
 router = APIRouter(
     prefix="/trains/{train_id}/stations",
@@ -14,27 +21,139 @@ router = APIRouter(
 )
 
 stations.create_index("station_id", unique=True)
+stations.create_index([("train_id", 1), ("position", 1)])
+
+#checks that no other station holds the position and writes, in one transaction that
+#bumps the train's stations_version: concurrent writers on a train conflict, and the
+#retried one checks again after the other has committed
+def _write_at_position(train_id: int, position: int, station_id: int, write):
+    def check_and_write(session):
+        trains_bump_stations_version(train_id, session)
+        validate_station_position_available(stations_position_taken(train_id, position, station_id, session), position)
+        write(session)
+
+    with client.start_session() as session:
+        session.with_transaction(check_and_write)
 
+#ordered by position
 @router.get("/", response_model=List[Union[StationResponse, StationAdminResponse]])
-def get_stations(train_id: int, current_user: TokenData = Depends(get_current_user)):
+def get_stations(train_id: int, request: Request, fields: Optional[str] = None, current_user: TokenData = Depends(get_current_user)):
     validate_required_roles(current_user.role, ["user", "admin"])
 
-    existing_train = trains_find_one(train_id)
+    if current_user.role == "user":
+        model = StationResponse
+    else:
+        model = StationAdminResponse
+    fields = parse_fields(model, fields)
+
+    existing_train = trains_find_one(train_id, {"_id": 0, "stations_version": 1, "stations_updated_at": 1})
     validate_train_exists(existing_train, train_id)
 
-    existing_stations = stations_find(train_id)
+    #every station write bumps stations_version, on any worker
+    stations_version = existing_train.get("stations_version", 0)
+    version = etags.counter_version(stations_version, existing_train.get("stations_updated_at"))
+    etag = etags.make_etag(current_user.role, version, fields)
+    if etags.is_not_modified(request, etag, version["last_modified"]):
+        return etags.not_modified_response(etag, version["last_modified"])
+
+    #concurrent identical reads share one query and one serialized body
+    def read():
+        existing_stations = station_index.ordered(train_id, stations_version)
+        return serialize_list(select_model(model, fields), existing_stations)
+
+    body = singleflight.reads.do(("stations", train_id, stations_version, current_user.role, fields), read)
+
+    response = Response(content=body, media_type="application/json")
+    etags.set_headers(response, etag, version["last_modified"])
+    return response
+
+#stations from one station to another (inclusive), in the direction of travel
+@router.get("/between", response_model=List[Union[StationResponse, StationAdminResponse]])
+def get_stations_between(train_id: int, from_id: int, to_id: int, fields: Optional[str] = None, current_user: TokenData = Depends(get_current_user)):
+    validate_required_roles(current_user.role, ["user", "admin"])
 
     if current_user.role == "user":
-        return [StationResponse(**i) for i in existing_stations]
+        model = StationResponse
     else:
-        return [StationAdminResponse(**i) for i in existing_stations]
+        model = StationAdminResponse
+    fields = parse_fields(model, fields)
+
+    existing_train = trains_find_one(train_id, EXISTS)
+    validate_train_exists(existing_train, train_id)
+
+    from_station = station_index.find(train_id, from_id)
+    validate_station_exists(from_station, from_id)
+
+    to_station = station_index.find(train_id, to_id)
+    validate_station_exists(to_station, to_id)
+
+    existing_stations = station_index.between(train_id, from_station["position"], to_station["position"])
+
+    if fields:
+        return sparse_response(model, existing_stations, fields)
+    return [model(**i) for i in existing_stations]
+
+#closest stations to a position, nearest first
+@router.get("/nearest", response_model=List[Union[StationResponse, StationAdminResponse]])
+def get_nearest_stations(train_id: int, position: int, limit: int = Query(1, ge=1, le=100), fields: Optional[str] = None, current_user: TokenData = Depends(get_current_user)):
+    validate_required_roles(current_user.role, ["user", "admin"])
+
+    if current_user.role == "user":
+        model = StationResponse
+    else:
+        model = StationAdminResponse
+    fields = parse_fields(model, fields)
+
+    existing_train = trains_find_one(train_id, EXISTS)
+    validate_train_exists(existing_train, train_id)
+
+    existing_stations = station_index.nearest(train_id, position, limit)
+
+    if fields:
+        return sparse_response(model, existing_stations, fields)
+    return [model(**i) for i in existing_stations]
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=StationAdminResponse)
 def create_station(train_id: int, station: Station, current_user: TokenData = Depends(get_current_user)):
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        existing_train = trains_find_one(train_id)
+        existing_train = trains_find_one(train_id, EXISTS)
+        validate_train_exists(existing_train, train_id)
+
+        station_id = get_next_sequence("station_id")
+        station_data = {
+            "train_id": train_id,
+            "station_id": station_id,
+            **station.dict(),
+            "created_at": datetime.utcnow(),
+            "updated_at": None,
+            "is_deleted": False
+        }
+
+        _write_at_position(train_id, station.position, station_id, lambda session: stations.insert_one(station_data, session=session))
+        created_station = stations_find_one(train_id, station_id)
+
+        station_index.rebuild(train_id)
+        journey.invalidate(train_id)
+        timetable.invalidate(train_id)
+
+        return created_station
+
+    except HTTPException:
+        raise 
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
+#inserts mid-line: later stations move down one position and the train's fares are
+#recomputed, all in one transaction so readers never see a half-shifted line
+@router.post("/insert", status_code=status.HTTP_201_CREATED, response_model=StationAdminResponse)
+def insert_station(train_id: int, station: Station, current_user: TokenData = Depends(get_current_user)):
+    try:
+        validate_required_roles(current_user.role, ["admin"])
+
+        existing_train = trains_find_one(train_id, EXISTS)
         validate_train_exists(existing_train, train_id)
 
         station_id = get_next_sequence("station_id")
@@ -47,8 +166,21 @@ def create_station(train_id: int, station: Station, current_user: TokenData = De
             "is_deleted": False
         }
 
-        result = stations.insert_one(station_data)
-        created_station = stations.find_one({"_id": result.inserted_id})
+        def shift_and_insert(session):
+            trains_bump_stations_version(train_id, session)
+            stations_shift_positions(train_id, station.position, session)
+            stations.insert_one(station_data, session=session)
+            repricing.reprice_train(train_id, session)
+
+        with client.start_session() as session:
+            session.with_transaction(shift_and_insert)
+
+        created_station = stations_find_one(train_id, station_id)
+
+        station_index.rebuild(train_id)
+        journey.invalidate(train_id)
+        timetable.invalidate(train_id)
+        fare_products.invalidate_train(train_id)
 
         return created_station
 
@@ -58,27 +190,80 @@ def create_station(train_id: int, station: Station, current_user: TokenData = De
     except Exception:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
 
+#one request for a whole line; append adds to the train's stations, replace swaps them atomically
+@router.post("/import", response_model=StationImportResponse)
+def import_stations(
+    train_id: int,
+    file: UploadFile,
+    mode: Literal["append", "replace"] = "append",
+    file_format: Optional[Literal["csv", "ndjson"]] = Query(None, alias="format"),
+    current_user: TokenData = Depends(get_current_user)
+):
+    try:
+        validate_required_roles(current_user.role, ["admin"])
+
+        existing_train = trains_find_one(train_id, EXISTS)
+        validate_train_exists(existing_train, train_id)
+
+        file_format = file_format or station_import.detect_format(file.filename)
+        validate_import_format(file_format)
+
+        if mode == "append":
+            existing = station_index.rebuild(train_id)
+            positions = set(existing.positions)
+            names = {i["name"].casefold() for i in existing.stations}
+        else:
+            positions, names = set(), set()
+
+        result = station_import.import_stations(train_id, file.file, file_format, mode, positions, names)
+
+        cascades.invalidate_train(train_id)
+
+        return result
+
+    except HTTPException:
+        raise 
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
 @router.get("/{station_id}", response_model=Union[StationResponse, StationAdminResponse])
-def get_station(train_id: int, station_id: int, current_user: TokenData = Depends(get_current_user)):
+def get_station(train_id: int, station_id: int, request: Request, response: Response, fields: Optional[str] = None, current_user: TokenData = Depends(get_current_user)):
     validate_required_roles(current_user.role, ["user", "admin"])
 
-    existing_train = trains_find_one(train_id)
+    if current_user.role == "user":
+        model = StationResponse
+    else:
+        model = StationAdminResponse
+    fields = parse_fields(model, fields)
+
+    existing_train = trains_find_one(train_id, EXISTS)
     validate_train_exists(existing_train, train_id)
 
-    existing_station = stations_find_one(train_id, station_id)
+    existing_station = stations_find_one(train_id, station_id, etags.version_projection("station_id"))
     validate_station_exists(existing_station, station_id)
 
-    if current_user.role == "user":
-        return StationResponse(**existing_station)
-    else:
-        return StationAdminResponse(**existing_station)
+    version = etags.docs_version([existing_station], "station_id")
+    etag = etags.make_etag(current_user.role, version, fields)
+    if etags.is_not_modified(request, etag, version["last_modified"]):
+        return etags.not_modified_response(etag, version["last_modified"])
+    etags.set_headers(response, etag, version["last_modified"])
+
+    existing_station = stations_find_one(train_id, station_id, projection(model, fields))
+    validate_station_exists(existing_station, station_id)
+
+    if fields:
+        sparse = sparse_response(model, existing_station, fields)
+        etags.set_headers(sparse, etag, version["last_modified"])
+        return sparse
+    return model(**existing_station)
 
 @router.put("/{station_id}", response_model=StationAdminResponse)
 def put_station(train_id: int, station_id: int, station: StationPut, current_user: TokenData = Depends(get_current_user)):
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        existing_train = trains_find_one(train_id)
+        existing_train = trains_find_one(train_id, EXISTS)
         validate_train_exists(existing_train, train_id)
 
         existing_station = stations_find_one(train_id, station_id)
@@ -87,9 +272,17 @@ def put_station(train_id: int, station_id: int, station: StationPut, current_use
         station_data = station.dict()
         station_data["updated_at"] = datetime.utcnow()
 
-        stations_update_one(train_id, station_id, station_data)
+        _write_at_position(train_id, station.position, station_id, lambda session: stations_update_one(train_id, station_id, station_data, session))
         updated_station = stations_find_one(train_id, station_id)
 
+        if station_data.get("position", existing_station["position"]) != existing_station["position"]:
+            repricing.reprice_train(train_id)
+            fare_products.invalidate_train(train_id)
+
+        station_index.rebuild(train_id)
+        journey.invalidate(train_id)
+        timetable.invalidate(train_id)
+
         return updated_station
 
     except HTTPException:
@@ -104,7 +297,7 @@ def patch_station(train_id: int, station_id: int, station: StationPatch, current
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        existing_train = trains_find_one(train_id)
+        existing_train = trains_find_one(train_id, EXISTS)
         validate_train_exists(existing_train, train_id)
 
         existing_station = stations_find_one(train_id, station_id)
@@ -113,9 +306,21 @@ def patch_station(train_id: int, station_id: int, station: StationPatch, current
         station_data = station.dict(exclude_unset=True)
         station_data["updated_at"] = datetime.utcnow()
 
-        stations_update_one(train_id, station_id, station_data)
+        if "position" in station_data:
+            _write_at_position(train_id, station_data["position"], station_id, lambda session: stations_update_one(train_id, station_id, station_data, session))
+        else:
+            stations_update_one(train_id, station_id, station_data)
+            trains_bump_stations_version(train_id)
         updated_station = stations_find_one(train_id, station_id)
 
+        if station_data.get("position", existing_station["position"]) != existing_station["position"]:
+            repricing.reprice_train(train_id)
+            fare_products.invalidate_train(train_id)
+
+        station_index.rebuild(train_id)
+        journey.invalidate(train_id)
+        timetable.invalidate(train_id)
+
         return updated_station
 
     except HTTPException:
@@ -129,13 +334,17 @@ def hard_delete_station(train_id: int, station_id: int, current_user: TokenData
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        existing_train = trains_find_one(train_id)
+        existing_train = trains_find_one(train_id, EXISTS)
         validate_train_exists(existing_train, train_id)
 
         existing_station = stations_find_one(train_id, station_id)
         validate_station_exists(existing_station, station_id)
 
         stations_delete_one(train_id, station_id)
+        trains_bump_stations_version(train_id)
+        station_index.rebuild(train_id)
+        journey.invalidate(train_id)
+        timetable.invalidate(train_id)
 
         return
     
@@ -150,13 +359,17 @@ def soft_delete_station(train_id: int, station_id: int, current_user: TokenData
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        existing_train = trains_find_one(train_id)
+        existing_train = trains_find_one(train_id, EXISTS)
         validate_train_exists(existing_train, train_id)
 
         existing_station = stations_find_one(train_id, station_id)
         validate_station_exists(existing_station, station_id)
 
         stations_update_one(train_id, station_id, {"is_deleted": True})
+        trains_bump_stations_version(train_id)
+        station_index.rebuild(train_id)
+        journey.invalidate(train_id)
+        timetable.invalidate(train_id)
 
         return {"detail": f"Station with id {station_id} softly deleted"}
     
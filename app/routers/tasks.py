@@ -0,0 +1,49 @@
+from fastapi import APIRouter, status, HTTPException, Depends
+from ..body import TokenData
+from ..response import TaskResponse
+from ..queries import tasks, tasks_find_one
+from ..status_codes import validate_required_roles, validate_logged_in_user, validate_task_exists, validate_task_dead
+from ..oauth2 import get_current_user
+from .. import tasks as queue
+
+router = APIRouter(
+    prefix="/tasks",
+    tags=["Tasks"]
+)
+
+tasks.create_index("task_id", unique=True)
+tasks.create_index("active_key", unique=True, sparse=True)
+tasks.create_index([("status", 1), ("run_at", 1)])
+tasks.create_index([("status", 1), ("lease_until", 1)])
+
+#users see the tasks their own requests queued
+@router.get("/{task_id}", response_model=TaskResponse)
+def get_task(task_id: int, current_user: TokenData = Depends(get_current_user)):
+    validate_required_roles(current_user.role, ["user", "admin"])
+
+    task = tasks_find_one(task_id)
+    validate_task_exists(task, task_id)
+    if current_user.role == "user":
+        validate_logged_in_user(current_user.id, task["created_by"])
+
+    return task
+
+#requeues a dead-lettered task
+@router.post("/{task_id}/retry", status_code=status.HTTP_202_ACCEPTED, response_model=TaskResponse)
+def retry_task(task_id: int, current_user: TokenData = Depends(get_current_user)):
+    try:
+        validate_required_roles(current_user.role, ["admin"])
+
+        task = tasks_find_one(task_id)
+        validate_task_exists(task, task_id)
+
+        retried = queue.retry(task_id)
+        validate_task_dead(retried)
+
+        return retried
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
@@ -1,12 +1,15 @@
-from fastapi import APIRouter, status, HTTPException, Depends
+from fastapi import APIRouter, status, HTTPException, Depends, Request, Response
 from ..body import Train, get_next_sequence, TokenData
 from ..updates import TrainPut
-from ..response import TrainResponse, TrainAdminResponse
-from typing import List, Union
+from ..response import TrainResponse, TrainAdminResponse, TaskAcceptedResponse
+from typing import List, Optional, Union
 from datetime import datetime
-from ..queries import trains, trains_find_one, trains_update_one, trains_delete_one, stations_delete_many, stations_update_many, travels_delete_many, travels_update_many
+from ..queries import trains, trains_find, trains_find_one, trains_update_one, trains_delete_one
 from ..status_codes import validate_train_exists, validate_required_roles
 from ..oauth2 import get_current_user
+from .. import singleflight, etags, tasks, cascades
+from ..singleflight import serialize_list
+from ..projections import EXISTS, parse_fields, projection, select_model, sparse_response
 
 router = APIRouter(
     prefix="/trains",
@@ -16,15 +19,30 @@ router = APIRouter(
 trains.create_index("train_id", unique=True)
 
 @router.get("/", response_model=List[Union[TrainResponse, TrainAdminResponse]])
-def get_trains(current_user: TokenData = Depends(get_current_user)):
+def get_trains(request: Request, fields: Optional[str] = None, current_user: TokenData = Depends(get_current_user)):
     validate_required_roles(current_user.role, ["user", "admin"])
-    
-    existing_trains = trains.find({"is_deleted": False})
 
     if current_user.role == "user":
-        return [TrainResponse(**i) for i in existing_trains]
+        model = TrainResponse
     else:
-        return [TrainAdminResponse(**i) for i in existing_trains]
+        model = TrainAdminResponse
+    fields = parse_fields(model, fields)
+
+    version = etags.list_version(trains, {"is_deleted": False}, "train_id")
+    etag = etags.make_etag(current_user.role, version, fields)
+    if etags.is_not_modified(request, etag, version["last_modified"]):
+        return etags.not_modified_response(etag, version["last_modified"])
+
+    #concurrent identical reads share one query and one serialized body
+    def read():
+        existing_trains = trains_find(projection(model, fields))
+        return serialize_list(select_model(model, fields), existing_trains)
+
+    body = singleflight.reads.do(("trains", current_user.role, fields), read)
+
+    response = Response(content=body, media_type="application/json")
+    etags.set_headers(response, etag, version["last_modified"])
+    return response
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=TrainAdminResponse)
 def create_trains(train: Train, current_user: TokenData = Depends(get_current_user)):
@@ -52,23 +70,39 @@ def create_trains(train: Train, current_user: TokenData = Depends(get_current_us
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
 
 @router.get("/{train_id}", response_model=Union[TrainResponse, TrainAdminResponse])
-def get_train(train_id: int, current_user: TokenData = Depends(get_current_user)):
+def get_train(train_id: int, request: Request, response: Response, fields: Optional[str] = None, current_user: TokenData = Depends(get_current_user)):
     validate_required_roles(current_user.role, ["user", "admin"])
 
-    train = trains_find_one(train_id)
-    validate_train_exists(train, train_id)
-
     if current_user.role == "user":
-        return TrainResponse(**train)
+        model = TrainResponse
     else:
-        return TrainAdminResponse(**train)
+        model = TrainAdminResponse
+    fields = parse_fields(model, fields)
+
+    train = trains_find_one(train_id, etags.version_projection("train_id"))
+    validate_train_exists(train, train_id)
+
+    version = etags.docs_version([train], "train_id")
+    etag = etags.make_etag(current_user.role, version, fields)
+    if etags.is_not_modified(request, etag, version["last_modified"]):
+        return etags.not_modified_response(etag, version["last_modified"])
+    etags.set_headers(response, etag, version["last_modified"])
+
+    train = trains_find_one(train_id, projection(model, fields))
+    validate_train_exists(train, train_id)
+
+    if fields:
+        sparse = sparse_response(model, train, fields)
+        etags.set_headers(sparse, etag, version["last_modified"])
+        return sparse
+    return model(**train)
 
 @router.put("/{train_id}", response_model=TrainAdminResponse)
 def put_train(train_id: int, train: TrainPut, current_user: TokenData = Depends(get_current_user)):
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        existing_train = trains_find_one(train_id)
+        existing_train = trains_find_one(train_id, EXISTS)
         validate_train_exists(existing_train, train_id)
 
         train_data = train.dict()
@@ -85,19 +119,20 @@ def put_train(train_id: int, train: TrainPut, current_user: TokenData = Depends(
     except Exception:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
 
-@router.delete("/{train_id}", status_code=status.HTTP_204_NO_CONTENT)
+#the train is gone right away; its stations and travels follow in a task
+@router.delete("/{train_id}", status_code=status.HTTP_202_ACCEPTED, response_model=TaskAcceptedResponse)
 def hard_delete_train(train_id: int, current_user: TokenData = Depends(get_current_user)):
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        existing_train = trains_find_one(train_id)
+        existing_train = trains_find_one(train_id, EXISTS)
         validate_train_exists(existing_train, train_id)
 
         trains_delete_one(train_id)
-        stations_delete_many(train_id)
-        travels_delete_many(train_id)
+        cascades.invalidate_train(train_id)
+        task = tasks.enqueue("hard_delete_train_records", {"train_id": train_id}, f"hard_delete_train:{train_id}", current_user.id)
 
-        return 
+        return {"detail": f"Train with id {train_id} deleted, related records are being deleted", "task_id": task["task_id"]}
     
     except HTTPException:
         raise
@@ -105,19 +140,19 @@ def hard_delete_train(train_id: int, current_user: TokenData = Depends(get_curre
     except Exception:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
 
-@router.delete("/{train_id}/delete", status_code=status.HTTP_200_OK)
+@router.delete("/{train_id}/delete", status_code=status.HTTP_202_ACCEPTED, response_model=TaskAcceptedResponse)
 def soft_delete_train(train_id: int, current_user: TokenData = Depends(get_current_user)):
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        existing_train = trains_find_one(train_id)
+        existing_train = trains_find_one(train_id, EXISTS)
         validate_train_exists(existing_train, train_id)
 
         trains_update_one(train_id, {"is_deleted": True})
-        stations_update_many(train_id, {"is_deleted": True})
-        travels_update_many(train_id, {"is_deleted": True})
+        cascades.invalidate_train(train_id)
+        task = tasks.enqueue("soft_delete_train_records", {"train_id": train_id}, f"soft_delete_train:{train_id}", current_user.id)
 
-        return {"detail": f"Train with id {train_id} and related records softly deleted"}
+        return {"detail": f"Train with id {train_id} softly deleted, related records are being deleted", "task_id": task["task_id"]}
     
     except HTTPException:
         raise
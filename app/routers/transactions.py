@@ -1,82 +1,134 @@
-from ..response import TransactionResponse, TransactionBalanceResponse, TransactionBalanceAdminResponse, TransactionAdminResponse
+from ..response import BalanceResponse, TransactionResponse, TransactionBalanceResponse, TransactionBalanceAdminResponse, TransactionAdminResponse
 from ..body import Transaction, get_next_sequence, TokenData
-from fastapi import APIRouter, status, HTTPException, Depends
-from ..status_codes import validate_logged_in_user, validate_required_roles, validate_balance_exists, validate_user_exists, validate_transaction_exists
-from ..queries import transactions, balances_update_one, transactions_delete_one, transactions_update_one, transactions_find, users_find_one, balances_find_one, transactions_find_one
+from fastapi import APIRouter, status, HTTPException, Depends, Header, Query, Response
+from ..status_codes import validate_logged_in_user, validate_required_roles, validate_balance_exists, validate_balance_unchanged, validate_user_exists, validate_transaction_exists
+from ..queries import transactions, transactions_insert_one, transactions_delete_one, transactions_update_one, transactions_find, transactions_find_one
 from datetime import datetime
-from typing import List, Union
+from typing import List, Literal, Optional, Union
 from ..updates import TransactionPatch, TransactionPut
 from ..oauth2 import get_current_user
+from ..idempotency import IdempotencyClaim
+from ..rate_limit import limit_by_user
+from ..projections import EXISTS, parse_fields, projection, sparse_response
+from ..filters import TRANSACTION_INDEXES, history_query
+from ..database import transaction_buckets
+from .. import wal, events, balance_store, tiering, transaction_buckets as buckets
 
 router = APIRouter(
     prefix="/users/{user_id}/balances/{balance_id}/transactions",
-    tags=["Transactions"]
+    tags=["Transactions"],
+    dependencies=[Depends(limit_by_user("transactions"))]
 )
 
 transactions.create_index("transaction_id", unique=True)
+for index in TRANSACTION_INDEXES.values():
+    transactions.create_index(index)
+transaction_buckets.create_index(buckets.INDEX)
 
 @router.get("/", response_model=List[Union[TransactionResponse, TransactionAdminResponse]])
-def get_transactions(user_id: int, balance_id: int, current_user: TokenData = Depends(get_current_user)):
+def get_transactions(
+    user_id: int,
+    balance_id: int,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    transaction_type: Optional[Literal["withdraw", "deposit"]] = Query(None, alias="type"),
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+    sort: Literal["created_at", "-created_at", "amount", "-amount"] = "created_at",
+    fields: Optional[str] = None,
+    current_user: TokenData = Depends(get_current_user)
+):
     validate_required_roles(current_user.role, ["user", "admin"])
     if current_user.role == "user":
         validate_logged_in_user(current_user.id, user_id)
 
-    user = users_find_one(user_id)
-    validate_user_exists(user, user_id)
+    if current_user.role == "user":
+        model = TransactionResponse
+    else:
+        model = TransactionAdminResponse
+    fields = parse_fields(model, fields)
+
+    filters, sort_by, index = history_query(
+        TRANSACTION_INDEXES,
+        {"type": transaction_type},
+        {"created_at": (created_from, created_to), "amount": (min_amount, max_amount)},
+        sort
+    )
 
-    balance = balances_find_one(user_id, balance_id)
+    user, balance = balance_store.find_with_user(user_id, balance_id, EXISTS)
+    validate_user_exists(user, user_id)
     validate_balance_exists(balance, balance_id)
 
-    existing_transactions = transactions_find(user_id, balance_id)
-    
-    if current_user.role == "user":
-        return [TransactionResponse(**t) for t in existing_transactions]
-    else:
-        return [TransactionAdminResponse(**t) for t in existing_transactions]
+    #months past the retention cutoff are read from cold storage
+    existing_transactions = tiering.with_cold(
+        "transactions", user_id,
+        lambda fields_projection: transactions_find(user_id, balance_id, fields_projection, filters, sort_by, index),
+        {"balance_id": balance_id, **filters}, sort_by, projection(model, fields)
+    )
+
+    if fields:
+        return sparse_response(model, existing_transactions, fields)
+    return [model(**t) for t in existing_transactions]
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=TransactionBalanceResponse)
-def create_transaction(user_id: int, balance_id: int, transaction: Transaction, current_user: TokenData = Depends(get_current_user)):
+def create_transaction(user_id: int, balance_id: int, transaction: Transaction, response: Response, idempotency_key: Optional[str] = Header(None, max_length=255), current_user: TokenData = Depends(get_current_user)):
     try:
         validate_required_roles(current_user.role, ["user"])
         validate_logged_in_user(current_user.id, user_id)
 
-        user = users_find_one(user_id)
-        validate_user_exists(user, user_id)
+        with IdempotencyClaim(f"transactions:{user_id}:{balance_id}", idempotency_key, transaction.dict()) as claim:
+            if claim.replay is not None:
+                response.headers["Idempotent-Replayed"] = "true"
+                return claim.replay
 
-        balance = balances_find_one(user_id, balance_id)
-        validate_balance_exists(balance, balance_id)
+            user, balance = balance_store.find_with_user(user_id, balance_id)
+            validate_user_exists(user, user_id)
+            validate_balance_exists(balance, balance_id)
 
-        transaction_id = get_next_sequence("transaction_id")
-        doc = {
-            "user_id": user_id, 
-            "balance_id": balance_id, 
-            "transaction_id": transaction_id, 
-            **transaction.dict(),
-            "created_at": datetime.utcnow(),
-            "updated_at": None,
-            "is_deleted": False
-        }
-        
-        result = transactions.insert_one(doc)
-        created_transaction = transactions.find_one({"_id": result.inserted_id})
-          
-        total_balance = balance["total"]
+            total_balance = balance["total"]
 
-        if transaction.type == "deposit":
-            new_balance =  total_balance + transaction.amount
-        else:
-            if total_balance - transaction.amount < 0:
-                raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Total balance not sufficient")
+            if transaction.type == "deposit":
+                new_balance =  total_balance + transaction.amount
             else:
-                new_balance = total_balance - transaction.amount
-                
-        balances_update_one(user_id=user_id, balance_id=balance_id, data={"total": new_balance})
-        updated_balance = balances_find_one(user_id, balance_id)
+                if total_balance - transaction.amount < 0:
+                    raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Total balance not sufficient")
+                else:
+                    new_balance = total_balance - transaction.amount
+
+            transaction_id = get_next_sequence("transaction_id")
+            doc = {
+                "user_id": user_id, 
+                "balance_id": balance_id, 
+                "transaction_id": transaction_id, 
+                **transaction.dict(),
+                "created_at": datetime.utcnow(),
+                "updated_at": None,
+                "is_deleted": False
+            }
+
+            #logged before either write so a half-applied transaction can be replayed
+            op_id = wal.begin("transactions", {"user_id": user_id, "balance_id": balance_id, "transaction_id": transaction_id}, {"balance_id": balance_id}, total_balance, new_balance, insert=doc)
+
+            #only if the total is still the one checked above
+            updated_balance = balance_store.change_total(balance_id, total_balance, new_balance)
+            if updated_balance is None:
+                wal.abort(op_id)
+            validate_balance_unchanged(updated_balance)
+            claim.applied()
+
+            created_transaction = transactions_insert_one(doc)
+
+            wal.commit(op_id)
+            events.publish(user_id, "transaction", TransactionResponse(**created_transaction))
+            events.publish(user_id, "balance", BalanceResponse(**updated_balance))
         
-        return {
-            "transaction": created_transaction,
-            "balance": updated_balance
-        }
+            response_data = {
+                "transaction": created_transaction,
+                "balance": updated_balance
+            }
+            claim.save(response_data)
+
+            return response_data
 
     except HTTPException:
         raise 
@@ -86,24 +138,29 @@ def create_transaction(user_id: int, balance_id: int, transaction: Transaction,
 
 
 @router.get("/{transaction_id}", response_model=Union[TransactionResponse, TransactionAdminResponse])
-def get_transactions(user_id: int, balance_id: int, transaction_id: int, current_user: TokenData = Depends(get_current_user)):
+def get_transactions(user_id: int, balance_id: int, transaction_id: int, fields: Optional[str] = None, current_user: TokenData = Depends(get_current_user)):
     validate_required_roles(current_user.role, ["user", "admin"])
     if current_user.role == "user":
         validate_logged_in_user(current_user.id, user_id)
 
-    user = users_find_one(user_id)
-    validate_user_exists(user, user_id)
+    if current_user.role == "user":
+        model = TransactionResponse
+    else:
+        model = TransactionAdminResponse
+    fields = parse_fields(model, fields)
 
-    balance = balances_find_one(user_id, balance_id)
+    user, balance = balance_store.find_with_user(user_id, balance_id, EXISTS)
+    validate_user_exists(user, user_id)
     validate_balance_exists(balance, balance_id)
 
-    existing_transaction = transactions_find_one(user_id, balance_id, transaction_id)
+    existing_transaction = transactions_find_one(user_id, balance_id, transaction_id, projection(model, fields))
+    if existing_transaction is None:
+        existing_transaction = tiering.find_one("transactions", user_id, transaction_id, {"balance_id": balance_id}, projection(model, fields))
     validate_transaction_exists(existing_transaction, transaction_id)
 
-    if current_user.role == "user":
-        return TransactionResponse(**existing_transaction)
-    else:
-        return TransactionAdminResponse(**existing_transaction)
+    if fields:
+        return sparse_response(model, existing_transaction, fields)
+    return model(**existing_transaction)
 
 
 @router.put("/{transaction_id}", response_model=TransactionBalanceAdminResponse)
@@ -111,14 +168,13 @@ def put_transaction(user_id: int, balance_id: int, transaction_id: int, transact
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        user = users_find_one(user_id)
+        user, balance = balance_store.find_with_user(user_id, balance_id)
         validate_user_exists(user, user_id)
-
-        balance = balances_find_one(user_id, balance_id)
         validate_balance_exists(balance, balance_id)
 
         existing_transaction = transactions_find_one(user_id, balance_id, transaction_id)
         validate_transaction_exists(existing_transaction, transaction_id)
+        previous_total = balance["total"]
 
         #reset balance before the transaction
         if existing_transaction["type"] == "withdraw":
@@ -136,11 +192,17 @@ def put_transaction(user_id: int, balance_id: int, transaction_id: int, transact
         put_data = transaction.dict()
         put_data["updated_at"] = datetime.utcnow()
 
+        op_id = wal.begin("transactions", {"user_id": user_id, "balance_id": balance_id, "transaction_id": transaction_id}, {"balance_id": balance_id}, previous_total, balance["total"], update=put_data)
+
+        updated_balance = balance_store.change_total(balance_id, previous_total, balance["total"])
+        if updated_balance is None:
+            wal.abort(op_id)
+        validate_balance_unchanged(updated_balance)
+
         transactions_update_one(user_id, balance_id, transaction_id, put_data)
         updated_transaction = transactions_find_one(user_id, balance_id, transaction_id)
 
-        balances_update_one(user_id=user_id, balance_id=balance_id, data={"total": balance["total"], "updated_at": datetime.utcnow()})
-        updated_balance = balances_find_one(user_id, balance_id)
+        wal.commit(op_id)
 
         return {
             "transaction": updated_transaction,
@@ -159,10 +221,8 @@ def put_transaction(user_id: int, balance_id: int, transaction_id: int, transact
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        user = users_find_one(user_id)
+        user, balance = balance_store.find_with_user(user_id, balance_id)
         validate_user_exists(user, user_id)
-
-        balance = balances_find_one(user_id, balance_id)
         validate_balance_exists(balance, balance_id)
 
         existing_transaction = transactions_find_one(user_id, balance_id, transaction_id)
@@ -170,6 +230,7 @@ def put_transaction(user_id: int, balance_id: int, transaction_id: int, transact
 
         patch_data = transaction.dict(exclude_unset=True)
         patch_data["updated_at"] = datetime.utcnow()
+        previous_total = balance["total"]
 
         #reset balance before the transaction
         if "type" in patch_data:
@@ -188,11 +249,17 @@ def put_transaction(user_id: int, balance_id: int, transaction_id: int, transact
         else:
             balance["total"] += new_amount
 
+        op_id = wal.begin("transactions", {"user_id": user_id, "balance_id": balance_id, "transaction_id": transaction_id}, {"balance_id": balance_id}, previous_total, balance["total"], update=patch_data)
+
+        updated_balance = balance_store.change_total(balance_id, previous_total, balance["total"])
+        if updated_balance is None:
+            wal.abort(op_id)
+        validate_balance_unchanged(updated_balance)
+
         transactions_update_one(user_id, balance_id, transaction_id, patch_data)
         updated_transaction = transactions_find_one(user_id, balance_id, transaction_id)
 
-        balances_update_one(user_id=user_id, balance_id=balance_id, data={"total": balance["total"], "updated_at": datetime.utcnow()})
-        updated_balance = balances_find_one(user_id, balance_id)
+        wal.commit(op_id)
 
         return {
             "transaction": updated_transaction,
@@ -211,10 +278,8 @@ def hard_delete_transaction(user_id: int, balance_id: int, transaction_id: int,
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        user = users_find_one(user_id)
+        user, balance = balance_store.find_with_user(user_id, balance_id)
         validate_user_exists(user, user_id)
-
-        balance = balances_find_one(user_id, balance_id)
         validate_balance_exists(balance, balance_id)
 
         existing_transaction = transactions_find_one(user_id, balance_id, transaction_id)
@@ -237,10 +302,8 @@ def soft_delete_transaction(user_id: int, balance_id: int, transaction_id: int,
         if current_user.role == "user":
             validate_logged_in_user(current_user.id, user_id)
 
-        user = users_find_one(user_id)
+        user, balance = balance_store.find_with_user(user_id, balance_id)
         validate_user_exists(user, user_id)
-
-        balance = balances_find_one(user_id, balance_id)
         validate_balance_exists(balance, balance_id)
 
         existing_transaction = transactions_find_one(user_id, balance_id, transaction_id)
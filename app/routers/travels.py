@@ -1,68 +1,114 @@
-from fastapi import APIRouter, Depends, status, HTTPException
+import logging
+from fastapi import APIRouter, Depends, status, HTTPException, Request, Response
+from pymongo import errors
 from ..body import Travel, get_next_sequence, TokenData
 from ..updates import TravelPut, TravelPatch
-from ..response import TravelAdminResponse, TravelResponse
-from ..queries import travels_find_one, travels, stations, trains_find_one, stations_find_one, travels_delete_one, travels_update_one, travels_find
+from ..response import TravelAdminResponse, TravelResponse, FareQuoteResponse
+from ..queries import travels_find_one, travels, stations, trains_find_one, stations_find_one, travels_delete_one, travels_update_one, travels_find, travels_find_product, travels_upsert_product
 from ..status_codes import validate_logged_in_user, validate_required_roles, validate_travel_exists, validate_station_exists, validate_train_exists
-from typing import List, Union
-from datetime import datetime
+from typing import List, Optional, Union
+from datetime import datetime, timezone
 from ..oauth2 import get_current_user
+from .. import fare_products, fare_engine, station_index, singleflight, etags
+from ..singleflight import serialize_list
+from ..projections import EXISTS, parse_fields, projection, select_model, sparse_response
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/trains/{train_id}/travels",
     tags=["Travels"]
 )
 
-BASE_FARE = 13
-PER_STATION_RATE = 1.3
-
 travels.create_index("travel_id", unique=True)
+travels.create_index([("train_id", 1), ("travel_id", 1)])     #repricing job walks each train in travel_id order
+
+#one canonical fare product per station pair; fails on databases that still hold
+#duplicates, which `python -m app.migrations dedupe_travels` collapses. The app still
+#starts without it, so the migration can run against the live API
+try:
+    travels.create_index(
+        [("train_id", 1), ("departure_id", 1), ("arrival_id", 1)],
+        unique=True,
+        partialFilterExpression={"is_deleted": False}
+    )
+except errors.OperationFailure as e:
+    logger.warning("unique travel index not built, run `python -m app.migrations dedupe_travels`: %s", e)
 
 @router.get("/", response_model=List[Union[TravelResponse, TravelAdminResponse]])
-def get_travels(train_id: int, current_user: TokenData = Depends(get_current_user)):
+def get_travels(train_id: int, request: Request, fields: Optional[str] = None, current_user: TokenData = Depends(get_current_user)):
     validate_required_roles(current_user.role, ["user", "admin"])
 
-    existing_train = trains_find_one(train_id)
-    validate_train_exists(existing_train, train_id)
-    
-    travel = travels_find(train_id)
-
     if current_user.role == "user":
-        return [TravelResponse(**i) for i in travel]
+        model = TravelResponse
     else:
-        return [TravelAdminResponse(**i) for i in travel]
+        model = TravelAdminResponse
+    fields = parse_fields(model, fields)
+
+    version = etags.list_version(travels, {"train_id": train_id, "is_deleted": False}, "travel_id")
+    etag = etags.make_etag(current_user.role, version, fields)
+    if etags.is_not_modified(request, etag, version["last_modified"]):
+        return etags.not_modified_response(etag, version["last_modified"])
+
+    #concurrent identical reads share one query and one serialized body
+    def read():
+        existing_train = trains_find_one(train_id, EXISTS)
+        validate_train_exists(existing_train, train_id)
+
+        travel = travels_find(train_id, projection(model, fields))
+        return serialize_list(select_model(model, fields), travel)
+
+    body = singleflight.reads.do(("travels", train_id, current_user.role, fields), read)
+
+    response = Response(content=body, media_type="application/json")
+    etags.set_headers(response, etag, version["last_modified"])
+    return response
     
+#returns the canonical fare product for the station pair, creating it (201) only if it doesn't exist yet (200)
 @router.post("/", response_model=TravelResponse, status_code=status.HTTP_201_CREATED)
-def create_travels(train_id: int, travel: Travel, current_user: TokenData = Depends(get_current_user)):
+def create_travels(train_id: int, travel: Travel, response: Response, current_user: TokenData = Depends(get_current_user)):
     try:
         validate_required_roles(current_user.role, ["user"])
         
-        existing_train = trains_find_one(train_id)
+        existing_train = trains_find_one(train_id, EXISTS)
         validate_train_exists(existing_train, train_id)
 
-        departure_station = stations_find_one(train_id, travel.departure_id)
+        existing_travel = fare_products.get(train_id, travel.departure_id, travel.arrival_id)
+        if not existing_travel:
+            existing_travel = travels_find_product(train_id, travel.departure_id, travel.arrival_id)
+
+        if existing_travel:
+            fare_products.put(existing_travel)
+            response.status_code = status.HTTP_200_OK
+            return existing_travel
+
+        departure_station = station_index.find(train_id, travel.departure_id)
         validate_station_exists(departure_station, travel.departure_id)
 
-        arrival_station = stations_find_one(train_id, travel.arrival_id)
+        arrival_station = station_index.find(train_id, travel.arrival_id)
         validate_station_exists(arrival_station, travel.arrival_id)
 
-        #fare calculation
-        number_of_positions = abs(departure_station["position"] - arrival_station["position"])
-        total_fare = BASE_FARE + (number_of_positions * PER_STATION_RATE)
+        #off-peak fare from the compiled fare table
+        total_fare = fare_engine.quote(train_id, travel.departure_id, travel.arrival_id)
         
         travel_id = get_next_sequence("travel_id")
         travel_data = {
-            "train_id": train_id,
             "travel_id": travel_id,
-            **travel.dict(),
             "total": total_fare,
             "created_at": datetime.utcnow(),
-            "updated_at": None,
-            "is_deleted": False
+            "updated_at": None
         }
 
-        result = travels.insert_one(travel_data)
-        created_travel = travels.find_one({"_id": result.inserted_id})
+        try:
+            created_travel = travels_upsert_product(train_id, travel.departure_id, travel.arrival_id, travel_data)
+        except errors.DuplicateKeyError:
+            #a concurrent quote created the product first
+            created_travel = travels_find_product(train_id, travel.departure_id, travel.arrival_id)
+
+        if created_travel["travel_id"] != travel_id:
+            response.status_code = status.HTTP_200_OK
+
+        fare_products.put(created_travel)
 
         return created_travel
         
@@ -72,27 +118,67 @@ def create_travels(train_id: int, travel: Travel, current_user: TokenData = Depe
     except Exception:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
 
-@router.get("/{travel_id}", response_model=Union[TravelResponse, TravelAdminResponse])
-def get_travel(train_id: int, travel_id: int, current_user: TokenData = Depends(get_current_user)):
+#fare for a station pair at a time (now by default), including any peak multiplier
+@router.get("/quote", response_model=FareQuoteResponse)
+def get_fare_quote(train_id: int, departure_id: int, arrival_id: int, at: Optional[datetime] = None, current_user: TokenData = Depends(get_current_user)):
     validate_required_roles(current_user.role, ["user", "admin"])
 
-    existing_train = trains_find_one(train_id)
+    existing_train = trains_find_one(train_id, EXISTS)
     validate_train_exists(existing_train, train_id)
 
-    existing_travel = travels_find_one(train_id, travel_id)
-    validate_travel_exists(existing_travel, travel_id)
+    validate_station_exists(station_index.find(train_id, departure_id), departure_id)
+    validate_station_exists(station_index.find(train_id, arrival_id), arrival_id)
+
+    if at is not None and at.tzinfo is not None:
+        at = at.astimezone(timezone.utc).replace(tzinfo=None)
+    band = fare_engine.current_band(at)
+
+    return {
+        "train_id": train_id,
+        "departure_id": departure_id,
+        "arrival_id": arrival_id,
+        "band": fare_engine.band_name(band),
+        "fare": fare_engine.quote(train_id, departure_id, arrival_id, band),
+        "config_version": fare_engine.compiled(train_id).version
+    }
+
+@router.get("/{travel_id}", response_model=Union[TravelResponse, TravelAdminResponse])
+def get_travel(train_id: int, travel_id: int, request: Request, response: Response, fields: Optional[str] = None, current_user: TokenData = Depends(get_current_user)):
+    validate_required_roles(current_user.role, ["user", "admin"])
 
     if current_user.role == "user":
-        return TravelResponse(**existing_travel)
+        model = TravelResponse
     else:
-        return TravelAdminResponse(**existing_travel)
+        model = TravelAdminResponse
+    fields = parse_fields(model, fields)
+
+    existing_train = trains_find_one(train_id, EXISTS)
+    validate_train_exists(existing_train, train_id)
+
+    existing_travel = travels_find_one(train_id, travel_id, etags.version_projection("travel_id"))
+    validate_travel_exists(existing_travel, travel_id)
+
+    version = etags.docs_version([existing_travel], "travel_id")
+    etag = etags.make_etag(current_user.role, version, fields)
+    if etags.is_not_modified(request, etag, version["last_modified"]):
+        return etags.not_modified_response(etag, version["last_modified"])
+    etags.set_headers(response, etag, version["last_modified"])
+
+    existing_travel = travels_find_one(train_id, travel_id, projection(model, fields))
+    validate_travel_exists(existing_travel, travel_id)
+
+    if fields:
+        sparse = sparse_response(model, existing_travel, fields)
+        etags.set_headers(sparse, etag, version["last_modified"])
+        return sparse
+    return model(**existing_travel)
 
 @router.put("/{travel_id}", response_model=TravelAdminResponse)
 def put_travel(train_id: int, travel_id: int, travel: TravelPut, current_user: TokenData = Depends(get_current_user)):
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        existing_train = trains_find_one(train_id)
+        existing_train = trains_find_one(train_id, EXISTS)
         validate_train_exists(existing_train, train_id)
 
         existing_travel = travels_find_one(train_id, travel_id)
@@ -103,8 +189,7 @@ def put_travel(train_id: int, travel_id: int, travel: TravelPut, current_user: T
         validate_station_exists(departure_station, travel.departure_id)
         validate_station_exists(arrival_station, travel.arrival_id)
 
-        number_of_positions = abs(departure_station["position"] - arrival_station["position"])
-        total_fare = BASE_FARE + (number_of_positions * PER_STATION_RATE)
+        total_fare = fare_engine.quote(train_id, travel.departure_id, travel.arrival_id)
 
         travel_data = {
             **travel.dict(),
@@ -115,11 +200,16 @@ def put_travel(train_id: int, travel_id: int, travel: TravelPut, current_user: T
         travels_update_one(train_id, travel_id, travel_data)
         updated_travel = travels.find_one({"train_id": train_id, "travel_id": travel_id})
 
+        fare_products.invalidate(existing_travel)
+
         return updated_travel
     
     except HTTPException:
         raise
 
+    except errors.DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A travel for these stations already exists")
+
     except Exception:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
 
@@ -128,7 +218,7 @@ def patch_travel(train_id: int, travel_id: int, travel: TravelPatch, current_use
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        existing_train = trains_find_one(train_id)
+        existing_train = trains_find_one(train_id, EXISTS)
         validate_train_exists(existing_train, train_id)
 
         existing_travel = travels_find_one(train_id, travel_id)
@@ -146,8 +236,7 @@ def patch_travel(train_id: int, travel_id: int, travel: TravelPatch, current_use
             validate_station_exists(departure_station, dep_id)
             validate_station_exists(arrival_station, arr_id)
 
-            number_of_positions = abs(departure_station["position"] - arrival_station["position"])
-            total_fare = BASE_FARE + (number_of_positions * PER_STATION_RATE)
+            total_fare = fare_engine.quote(train_id, dep_id, arr_id)
         else:
             total_fare = existing_travel["total"]
 
@@ -160,11 +249,16 @@ def patch_travel(train_id: int, travel_id: int, travel: TravelPatch, current_use
         travels_update_one(train_id, travel_id, travel_data)
         updated_travel = travels_find_one(train_id, travel_id)
 
+        fare_products.invalidate(existing_travel)
+
         return updated_travel
     
     except HTTPException:
         raise
 
+    except errors.DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A travel for these stations already exists")
+
     except Exception:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
 
@@ -173,13 +267,14 @@ def hard_delete_travel(train_id: int, travel_id: int, current_user: TokenData =
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        existing_train = trains_find_one(train_id)
+        existing_train = trains_find_one(train_id, EXISTS)
         validate_train_exists(existing_train, train_id)
 
         existing_travel = travels_find_one(train_id, travel_id)
         validate_travel_exists(existing_travel, travel_id)
 
         travels_delete_one(train_id, travel_id)
+        fare_products.invalidate(existing_travel)
 
         return
 
@@ -192,15 +287,16 @@ def hard_delete_travel(train_id: int, travel_id: int, current_user: TokenData =
 @router.delete("/{travel_id}/delete", status_code=status.HTTP_200_OK)
 def soft_delete_travel(train_id: int, travel_id: int, current_user: TokenData = Depends(get_current_user)):
     try:
-        validate_required_roles(current_user.role, ["user", "admin"])
+        validate_required_roles(current_user.role, ["admin"])
 
-        existing_train = trains_find_one(train_id)
+        existing_train = trains_find_one(train_id, EXISTS)
         validate_train_exists(existing_train, train_id)
 
         existing_travel = travels_find_one(train_id, travel_id)
         validate_travel_exists(existing_travel, travel_id)
 
         travels_update_one(train_id, travel_id, {"is_deleted": True})
+        fare_products.invalidate(existing_travel)
 
         return {"detail": f"Travel with id {travel_id} softly deleted"}
 
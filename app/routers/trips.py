@@ -0,0 +1,188 @@
+from fastapi import APIRouter, status, HTTPException, Depends, Query
+from ..body import Trip, Reservation, TokenData
+from ..updates import TripPatch
+from ..response import TripResponse, TripAdminResponse, DepartureResponse, ReservationResponse
+from typing import List, Optional, Union
+from datetime import datetime, timedelta
+from ..queries import trips, seat_counters, reservations, trips_find, trips_find_one, trips_update_one, trains_find_one, reservations_find_one
+from ..status_codes import (
+    validate_required_roles, validate_logged_in_user, validate_train_exists, validate_trip_exists, validate_trip_route, validate_stop_minutes,
+    validate_trip_segments, validate_seats_available, validate_reservation_exists, validate_reservation_held
+)
+from ..oauth2 import get_current_user
+from ..rate_limit import limit_by_user
+from ..projections import EXISTS
+from .. import station_index, timetable, reservations as seats
+
+router = APIRouter(
+    prefix="/trips",
+    tags=["Trips"]
+)
+
+trips.create_index("trip_id", unique=True)
+trips.create_index([("train_id", 1), ("departs_at", 1)])     #also loads the timetables
+seat_counters.create_index([("trip_id", 1), ("shard", 1)], unique=True)
+reservations.create_index("reservation_id", unique=True)
+reservations.create_index([("trip_id", 1), ("reservation_id", 1)])
+
+@router.get("/", response_model=List[Union[TripResponse, TripAdminResponse]])
+def get_trips(
+    train_id: Optional[int] = None,
+    departs_from: Optional[datetime] = None,
+    departs_to: Optional[datetime] = None,
+    current_user: TokenData = Depends(get_current_user)
+):
+    validate_required_roles(current_user.role, ["user", "admin"])
+
+    if current_user.role == "user":
+        model = TripResponse
+    else:
+        model = TripAdminResponse
+
+    filters = {}
+    if train_id is not None:
+        filters["train_id"] = train_id
+    if departs_from or departs_to:
+        filters["departs_at"] = {k: v for k, v in (("$gte", departs_from), ("$lte", departs_to)) if v}
+
+    return [model(**i) for i in trips_find(filters)]
+
+@router.post("/", status_code=status.HTTP_201_CREATED, response_model=TripAdminResponse)
+def create_trip(trip: Trip, current_user: TokenData = Depends(get_current_user)):
+    try:
+        validate_required_roles(current_user.role, ["admin"])
+
+        train = trains_find_one(trip.train_id, EXISTS)
+        validate_train_exists(train, trip.train_id)
+
+        stations = station_index.ordered(trip.train_id)
+        validate_trip_route(stations)
+        validate_stop_minutes(trip.stop_minutes, len(stations))
+
+        created_trip = seats.create_trip(trip.train_id, trip.departs_at, trip.capacity, trip.stop_minutes)
+
+        return {**created_trip, "available": seats.available(created_trip)}
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
+#answered from the in-process timetable, see app/timetable.py
+@router.get("/departures", response_model=List[DepartureResponse])
+def get_departures(
+    departure_id: int,
+    arrival_id: int,
+    after: Optional[datetime] = None,
+    limit: int = Query(5, ge=1, le=50),
+    current_user: TokenData = Depends(get_current_user)
+):
+    validate_required_roles(current_user.role, ["user", "admin"])
+
+    return [
+        {"trip_id": trip_id, "train_id": train_id, "departure_id": departure_id, "arrival_id": arrival_id, "departs_at": departs_at, "arrives_at": arrives_at}
+        for trip_id, train_id, departs_at, arrives_at in timetable.next_departures(departure_id, arrival_id, after, limit)
+    ]
+
+#with the seats still free per segment
+@router.get("/{trip_id}", response_model=Union[TripResponse, TripAdminResponse])
+def get_trip(trip_id: int, current_user: TokenData = Depends(get_current_user)):
+    validate_required_roles(current_user.role, ["user", "admin"])
+
+    if current_user.role == "user":
+        model = TripResponse
+    else:
+        model = TripAdminResponse
+
+    trip = trips_find_one(trip_id)
+    validate_trip_exists(trip, trip_id)
+
+    return model(**trip, available=seats.available(trip))
+
+#moves the whole trip (departs_at) or sets new stop times
+@router.patch("/{trip_id}", response_model=TripAdminResponse)
+def patch_trip(trip_id: int, trip: TripPatch, current_user: TokenData = Depends(get_current_user)):
+    try:
+        validate_required_roles(current_user.role, ["admin"])
+
+        existing_trip = trips_find_one(trip_id)
+        validate_trip_exists(existing_trip, trip_id)
+        validate_stop_minutes(trip.stop_minutes, len(existing_trip["stops"]))
+
+        departs_at = trip.departs_at or existing_trip["departs_at"]
+        if trip.stop_minutes is not None:
+            stop_times = [departs_at + timedelta(minutes=i) for i in trip.stop_minutes]
+        else:
+            shift = departs_at - existing_trip["departs_at"]
+            stop_times = [i + shift for i in timetable.stop_times(existing_trip)]
+
+        updated_data = {"departs_at": departs_at, "stop_times": stop_times, "updated_at": datetime.utcnow()}
+        trips_update_one(trip_id, updated_data)
+
+        updated_trip = {**existing_trip, **updated_data}
+        timetable.add_trip(updated_trip)
+
+        return {**updated_trip, "available": seats.available(updated_trip)}
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
+#holds the seats on every segment between the two stations until the hold expires
+@router.post("/{trip_id}/reservations", status_code=status.HTTP_201_CREATED, response_model=ReservationResponse, dependencies=[Depends(limit_by_user("reservations"))])
+def create_reservation(trip_id: int, reservation: Reservation, current_user: TokenData = Depends(get_current_user)):
+    try:
+        validate_required_roles(current_user.role, ["user"])
+
+        trip = trips_find_one(trip_id)
+        validate_trip_exists(trip, trip_id)
+
+        segments = seats.segments(trip, reservation.departure_id, reservation.arrival_id)
+        validate_trip_segments(segments, reservation.departure_id, reservation.arrival_id)
+
+        created_reservation = seats.reserve(trip, current_user.id, reservation.departure_id, reservation.arrival_id, reservation.seats, *segments)
+        validate_seats_available(created_reservation)
+
+        return created_reservation
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
+@router.get("/{trip_id}/reservations/{reservation_id}", response_model=ReservationResponse)
+def get_reservation(trip_id: int, reservation_id: int, current_user: TokenData = Depends(get_current_user)):
+    validate_required_roles(current_user.role, ["user", "admin"])
+
+    reservation = reservations_find_one(trip_id, reservation_id)
+    validate_reservation_exists(reservation, reservation_id)
+    if current_user.role == "user":
+        validate_logged_in_user(current_user.id, reservation["user_id"])
+
+    return reservation
+
+#gives the seats of a held reservation back; paid ones stay booked
+@router.delete("/{trip_id}/reservations/{reservation_id}", response_model=ReservationResponse)
+def cancel_reservation(trip_id: int, reservation_id: int, current_user: TokenData = Depends(get_current_user)):
+    try:
+        validate_required_roles(current_user.role, ["user", "admin"])
+
+        reservation = reservations_find_one(trip_id, reservation_id)
+        validate_reservation_exists(reservation, reservation_id)
+        if current_user.role == "user":
+            validate_logged_in_user(current_user.id, reservation["user_id"])
+
+        cancelled = seats.cancel(reservation_id)
+        validate_reservation_held(cancelled, reservation_id)
+
+        return cancelled
+
+    except HTTPException:
+        raise
+
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
@@ -1,14 +1,16 @@
 from datetime import datetime
 from pymongo import errors
 from fastapi import HTTPException, status, APIRouter, Depends
-from typing import List, Union
+from typing import List, Optional, Union
 from ..updates import UserPatch, UserPut
 from ..status_codes import validate_user_exists, validate_logged_in_user, validate_required_roles
-from ..response import UserAdminResponse, UserBalanceResponse, UserResponse
+from ..response import UserAdminResponse, UserBalanceResponse, UserResponse, TaskAcceptedResponse
 from ..body import User, get_next_sequence, TokenData
 from ..utils import hash
-from ..queries import users, balances, balances_delete_one, balances_update_one, transactions_update_many, transactions_delete_many, users_find_one, users_delete_one, users_update_one, payments_delete_many, payments_update_many
+from ..queries import users, users_find_one, users_delete_one, users_update_one
 from ..oauth2 import get_current_user
+from ..projections import EXISTS, parse_fields, projection, sparse_response
+from .. import revocation, sessions, balance_store, tasks
 
 
 router = APIRouter(
@@ -20,20 +22,25 @@ users.create_index("email", unique=True)
 users.create_index("user_id", unique=True)
 
 @router.get("/", response_model=List[Union[UserResponse, UserAdminResponse]])
-def get_all(current_user: TokenData = Depends(get_current_user)):
+def get_all(fields: Optional[str] = None, current_user: TokenData = Depends(get_current_user)):
     validate_required_roles(current_user.role, ["user", "admin"])
-    
-    user = users.find({"is_deleted": False})
-    
+
     if current_user.role == "user":
-        return [UserResponse(**i) for i in user]
+        model = UserResponse
     else:
-        return [UserAdminResponse(**i) for i in user]
+        model = UserAdminResponse
+    fields = parse_fields(model, fields)
+    
+    user = users.find({"is_deleted": False}, projection(model, fields))
+
+    if fields:
+        return sparse_response(model, user, fields)
+    return [model(**i) for i in user]
 
 @router.post("/", response_model=UserBalanceResponse, status_code=status.HTTP_201_CREATED)
 def create_user(user: User):
     try:
-        existing_user = users.find_one({"email": user.email})
+        existing_user = users.find_one({"email": user.email}, EXISTS)
         if existing_user:
             raise HTTPException(
                 status_code=status.HTTP_409_CONFLICT, 
@@ -51,26 +58,17 @@ def create_user(user: User):
             "is_deleted": False
         }
 
-        result = users.insert_one(doc)
-        created_user = users.find_one({"_id": result.inserted_id})
-
         #Creates balances upon creation of account
-        balance_id = get_next_sequence("balance_id")
-        balance_doc = {
-            "user_id": user_id, 
-            "balance_id": balance_id, 
-            "total": 0, 
-            "created_at": datetime.utcnow(),
-            "updated_at": None, 
-            "is_deleted": False
-        }
+        balance_doc = balance_store.new_balance(user_id, get_next_sequence("balance_id"))
+        balance_store.embed(doc, balance_doc)
 
-        balance_result = balances.insert_one(balance_doc)
-        created_balance = balances.find_one({"_id": balance_result.inserted_id})
+        result = users.insert_one(doc)
+        created_user = users.find_one({"_id": result.inserted_id})
+        balance_store.insert(balance_doc)
 
         return {
             "user":created_user, 
-            "balance":created_balance
+            "balance":balance_doc
         }
     
     except HTTPException:
@@ -84,18 +82,23 @@ def create_user(user: User):
 
 
 @router.get("/{user_id}", response_model=Union[UserResponse, UserAdminResponse])
-def get_one_user(user_id: int, current_user: TokenData = Depends(get_current_user)):
+def get_one_user(user_id: int, fields: Optional[str] = None, current_user: TokenData = Depends(get_current_user)):
     validate_required_roles(current_user.role, ["user", "admin"])
     if current_user.role == "user":
         validate_logged_in_user(current_user.id, user_id)
 
-    user = users_find_one(user_id)
-    validate_user_exists(user, user_id)
-    
     if current_user.role == "user":
-        return UserResponse(**user)
+        model = UserResponse
     else:
-        return UserAdminResponse(**user)
+        model = UserAdminResponse
+    fields = parse_fields(model, fields)
+
+    user = users_find_one(user_id, projection(model, fields))
+    validate_user_exists(user, user_id)
+
+    if fields:
+        return sparse_response(model, user, fields)
+    return model(**user)
 
 @router.put("/{user_id}", response_model=Union[UserResponse, UserAdminResponse])
 def put_user(user_id: int, user: UserPut, current_user: TokenData = Depends(get_current_user)):
@@ -105,7 +108,7 @@ def put_user(user_id: int, user: UserPut, current_user: TokenData = Depends(get_
             validate_logged_in_user(current_user.id, user_id)
         
         user.password = hash(user.password)
-        existing_user = users_find_one(user_id)
+        existing_user = users_find_one(user_id, EXISTS)
         validate_user_exists(existing_user, user_id)
 
         put_data = user.dict()
@@ -114,6 +117,10 @@ def put_user(user_id: int, user: UserPut, current_user: TokenData = Depends(get_
         users_update_one(user_id, put_data)
         updated_user = users_find_one(user_id)
 
+        #a new password ends every session and token issued with the old one
+        sessions.revoke_user(user_id)
+        revocation.revoke_user(user_id)
+
         if current_user.role == "user":
             return UserResponse(**updated_user)
         else:
@@ -136,7 +143,7 @@ def patch_user(user_id: int, user: UserPatch, current_user: TokenData = Depends(
         if user.password:
             user.password = hash(user.password)
             
-        existing_user = users_find_one(user_id)
+        existing_user = users_find_one(user_id, EXISTS)
         validate_user_exists(existing_user, user_id)
 
         patch_data = user.dict(exclude_unset=True)
@@ -145,6 +152,10 @@ def patch_user(user_id: int, user: UserPatch, current_user: TokenData = Depends(
         users_update_one(user_id, patch_data)
         updated_user = users_find_one(user_id)
 
+        if "password" in patch_data:
+            sessions.revoke_user(user_id)
+            revocation.revoke_user(user_id)
+
         if current_user.role == "user":
             return UserResponse(**updated_user)
         else:
@@ -157,20 +168,21 @@ def patch_user(user_id: int, user: UserPatch, current_user: TokenData = Depends(
     except Exception:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
 
-@router.delete("/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
+#the user is gone right away; balance, transactions and payments follow in a task
+@router.delete("/{user_id}", status_code=status.HTTP_202_ACCEPTED, response_model=TaskAcceptedResponse)
 def hard_delete_user(user_id: int, current_user: TokenData = Depends(get_current_user)):
     try:
         validate_required_roles(current_user.role, ["admin"])
 
-        user = users_find_one(user_id)
+        user = users_find_one(user_id, EXISTS)
         validate_user_exists(user, user_id)
 
         users_delete_one(user_id)
-        balances_delete_one(user_id)
-        transactions_delete_many(user_id)
-        payments_delete_many(user_id)
+        sessions.revoke_user(user_id)
+        revocation.revoke_user(user_id)
+        task = tasks.enqueue("hard_delete_user_records", {"user_id": user_id}, f"hard_delete_user:{user_id}", current_user.id)
 
-        return
+        return {"detail": f"User with id {user_id} deleted, related records are being deleted", "task_id": task["task_id"]}
     
     except HTTPException:
         raise 
@@ -178,24 +190,24 @@ def hard_delete_user(user_id: int, current_user: TokenData = Depends(get_current
     except Exception:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
     
-@router.delete("/{user_id}/delete", status_code=status.HTTP_200_OK)
+@router.delete("/{user_id}/delete", status_code=status.HTTP_202_ACCEPTED, response_model=TaskAcceptedResponse)
 def soft_delete_user(user_id: int, current_user: TokenData = Depends(get_current_user)):
     try:
         validate_required_roles(current_user.role, ["user", "admin"])
         if current_user.role == "user":
             validate_logged_in_user(current_user.id, user_id)
 
-        user = users_find_one(user_id)
+        user = users_find_one(user_id, EXISTS)
 
         validate_user_exists(user, user_id)
 
-        #Update users, balances, transactions is_deleted
+        #the user and their tokens now; balances, transactions and payments in a task
         users_update_one(user_id, {"is_deleted": True})
-        balances_update_one(user_id, {"is_deleted": True})
-        transactions_update_many(user_id, {"is_deleted": True})
-        payments_update_many(user_id, {"is_deleted": True})
+        sessions.revoke_user(user_id)
+        revocation.revoke_user(user_id)
+        task = tasks.enqueue("soft_delete_user_records", {"user_id": user_id}, f"soft_delete_user:{user_id}", current_user.id)
 
-        return {"detail": f"User with id {user_id} and related records softly deleted"}
+        return {"detail": f"User with id {user_id} softly deleted, related records are being deleted", "task_id": task["task_id"]}
     
     except HTTPException:
         raise 
@@ -0,0 +1,100 @@
+import hashlib
+import secrets
+from datetime import datetime, timedelta
+from typing import Optional
+from pymongo import ReturnDocument
+from .body import get_next_sequence
+from .config import settings
+from .database import sessions
+
+#Login sessions renewed with opaque refresh tokens. A session is one document holding
+#the sha256 of its current refresh token; the token itself is only ever given to the
+#client. POST /login/refresh swaps the hash for a new token's in a single indexed
+#find_one_and_update, so renewing costs no password verification.
+#
+#Hashes of the tokens a session already rotated past are kept (the last
+#PREVIOUS_HASHES of them). Presenting one of those means the token was copied: the
+#whole session is revoked, so neither the thief nor the owner can renew it.
+#
+#sha256 is enough here since tokens are 256 random bits, not guessable passwords.
+
+TOKEN_BYTES = 32
+PREVIOUS_HASHES = 20
+SESSION_LIFETIME = timedelta(days=settings.refresh_token_days)
+
+SESSION_PROJECTION = {"_id": 0, "session_id": 1, "user_id": 1, "role": 1, "user_agent": 1, "created_at": 1, "last_used_at": 1, "expires_at": 1}
+
+
+def _hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _new_token() -> tuple[str, str]:
+    token = secrets.token_urlsafe(TOKEN_BYTES)
+    return token, _hash(token)
+
+#returns the session and its first refresh token
+def create(user_id: int, role: str, user_agent: Optional[str] = None) -> tuple[dict, str]:
+    token, token_hash = _new_token()
+    now = datetime.utcnow()
+
+    session = {
+        "session_id": get_next_sequence("session_id"),
+        "user_id": user_id,
+        "role": role,
+        "token_hash": token_hash,
+        "previous_hashes": [],
+        "user_agent": user_agent,
+        "created_at": now,
+        "last_used_at": now,
+        "expires_at": now + SESSION_LIFETIME,
+        "revoked_at": None
+    }
+    sessions.insert_one(dict(session))
+    return session, token
+
+#the session and a new refresh token, or (None, None) for an unknown, expired,
+#revoked or reused token; a reused token revokes its session
+def rotate(token: str) -> tuple[Optional[dict], Optional[str]]:
+    token_hash = _hash(token)
+    new_token, new_hash = _new_token()
+    now = datetime.utcnow()
+
+    session = sessions.find_one_and_update(
+        {"token_hash": token_hash, "revoked_at": None, "expires_at": {"$gt": now}},
+        {
+            "$set": {"token_hash": new_hash, "last_used_at": now},
+            "$push": {"previous_hashes": {"$each": [token_hash], "$slice": -PREVIOUS_HASHES}}
+        },
+        projection=SESSION_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+    if session is not None:
+        return session, new_token
+
+    #only reached for bad tokens, so the reuse check stays off the hot path
+    sessions.update_one(
+        {"previous_hashes": token_hash, "revoked_at": None},
+        {"$set": {"revoked_at": now, "revoked_reason": "reuse"}}
+    )
+    return None, None
+
+#active sessions of a user, newest first
+def list_sessions(user_id: int) -> list[dict]:
+    return list(sessions.find(
+        {"user_id": user_id, "revoked_at": None, "expires_at": {"$gt": datetime.utcnow()}},
+        SESSION_PROJECTION
+    ).sort("session_id", -1))
+
+#returns False if the user has no such active session
+def revoke(user_id: int, session_id: int) -> bool:
+    result = sessions.update_one(
+        {"session_id": session_id, "user_id": user_id, "revoked_at": None},
+        {"$set": {"revoked_at": datetime.utcnow(), "revoked_reason": "logout"}}
+    )
+    return result.modified_count == 1
+
+def revoke_user(user_id: int):
+    sessions.update_many(
+        {"user_id": user_id, "revoked_at": None},
+        {"$set": {"revoked_at": datetime.utcnow(), "revoked_reason": "logout"}}
+    )
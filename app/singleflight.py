@@ -0,0 +1,64 @@
+from threading import Event, Lock
+from pydantic import TypeAdapter
+
+#Collapses concurrent identical reads: the first caller for a key runs the query,
+#callers arriving while it is in flight wait and share its result (including
+#errors). Nothing is cached once the call completes.
+class Call:
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+class Group:
+    def __init__(self):
+        self.calls: dict[tuple, Call] = {}
+        self.counts: dict[str, dict[str, int]] = {}
+        self.lock = Lock()
+
+    #key[0] names the read path the call is counted under
+    def do(self, key: tuple, fn):
+        with self.lock:
+            counts = self.counts.setdefault(key[0], {"calls": 0, "executions": 0})
+            counts["calls"] += 1
+
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                counts["executions"] += 1
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as error:
+                call.error = error
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                name: {**counts, "collapsed": counts["calls"] - counts["executions"]}
+                for name, counts in self.counts.items()
+            }
+
+
+reads = Group()
+
+_adapters: dict[type, TypeAdapter] = {}
+
+#JSON body for a list of documents, serialized once and shared by every waiter
+def serialize_list(model: type, docs) -> bytes:
+    adapter = _adapters.get(model)
+    if adapter is None:
+        adapter = _adapters[model] = TypeAdapter(list[model])
+    return adapter.dump_json([model(**i) for i in docs], by_alias=True)
@@ -0,0 +1,157 @@
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Optional
+from pydantic import ValidationError
+from .body import Station, get_next_sequence_block
+from .database import client
+from .queries import stations_insert_many, stations_delete_many, stations_positions_taken, travels_update_many, trains_bump_stations_version
+
+#Bulk station import for one train from an uploaded CSV (header row: name,position,
+#interchange_group) or NDJSON file. Rows are parsed and validated as the file is
+#read; valid rows go out in insert_many batches with IDs reserved a block at a time.
+#Replace mode validates the whole file first and then swaps the train's stations
+#in one transaction, or changes nothing if any row is invalid. Every write bumps the
+#train's stations_version in its transaction, like single station writes do.
+
+BATCH_SIZE = 500
+MAX_ERRORS = 1000   #stop collecting errors past this, the file is clearly wrong
+
+FORMATS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+
+def detect_format(filename: Optional[str]) -> Optional[str]:
+    for extension, file_format in FORMATS.items():
+        if filename and filename.lower().endswith(extension):
+            return file_format
+    return None
+
+#yields (row number, data, error) without reading the whole file into memory
+def read_rows(file, file_format: str):
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+
+    if file_format == "csv":
+        for number, row in enumerate(csv.DictReader(text), start=1):
+            if None in row:
+                yield number, None, "Too many columns"
+            else:
+                yield number, {k: v for k, v in row.items() if v not in (None, "")}, None
+        return
+
+    for number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            yield number, None, "Invalid JSON"
+            continue
+        if isinstance(data, dict):
+            yield number, data, None
+        else:
+            yield number, None, "Expected a JSON object"
+
+#checks each row against the train's stations and the rows before it
+class RowValidator:
+    def __init__(self, positions: set[int], names: set[str]):
+        self.positions = positions
+        self.names = names
+
+    def validate(self, data: dict) -> Station:
+        station = Station(**data)
+
+        if station.position in self.positions:
+            raise ValueError(f"Position {station.position} is already used by another station of this train")
+        if station.name.casefold() in self.names:
+            raise ValueError(f"Station name {station.name} is already used on this train")
+
+        self.positions.add(station.position)
+        self.names.add(station.name.casefold())
+        return station
+
+def _error_detail(error: Exception) -> str:
+    if isinstance(error, ValidationError):
+        return "; ".join(f'{".".join(str(i) for i in e["loc"])}: {e["msg"]}' for e in error.errors())
+    return str(error)
+
+def _docs(train_id: int, valid: list[tuple[int, Station]]) -> list[dict]:
+    first_id = get_next_sequence_block("station_id", len(valid))
+    now = datetime.utcnow()
+
+    return [
+        {
+            "train_id": train_id,
+            "station_id": first_id + offset,
+            **station.dict(),
+            "created_at": now,
+            "updated_at": None,
+            "is_deleted": False
+        }
+        for offset, (_, station) in enumerate(valid)
+    ]
+
+#one append batch; rows whose position another writer took since validation become errors
+def _append(train_id: int, batch: list[tuple[int, Station]], errors: list[dict]) -> int:
+    docs = _docs(train_id, batch)
+
+    def check_and_insert(session):
+        trains_bump_stations_version(train_id, session)
+        taken = stations_positions_taken(train_id, [i["position"] for i in docs], session)
+        free = [i for i in docs if i["position"] not in taken]
+        if free:
+            stations_insert_many(free, session)
+        return taken
+
+    with client.start_session() as session:
+        taken = session.with_transaction(check_and_insert)
+
+    for number, station in batch:
+        if station.position in taken:
+            errors.append({"row": number, "detail": f"Position {station.position} is already used by another station of this train"})
+    return len(batch) - sum(1 for _, station in batch if station.position in taken)
+
+
+def import_stations(train_id: int, file, file_format: str, mode: str, positions: set[int], names: set[str]) -> dict:
+    validator = RowValidator(positions, names)
+    errors = []
+    batch = []
+    inserted = 0
+
+    for number, data, error in read_rows(file, file_format):
+        if error is None:
+            try:
+                batch.append((number, validator.validate(data)))
+            except (ValidationError, ValueError) as e:
+                error = _error_detail(e)
+
+        if error is not None:
+            errors.append({"row": number, "detail": error})
+            if len(errors) >= MAX_ERRORS:
+                break
+
+        if mode == "append" and len(batch) >= BATCH_SIZE:
+            inserted += _append(train_id, batch, errors)
+            batch = []
+
+    if mode == "replace":
+        if errors or not batch:
+            return {"mode": mode, "inserted": 0, "errors": errors}
+
+        docs = _docs(train_id, batch)
+        with client.start_session() as session:
+            session.with_transaction(lambda s: _swap(train_id, docs, s))
+        return {"mode": mode, "inserted": len(docs), "errors": errors}
+
+    if batch:
+        inserted += _append(train_id, batch, errors)
+
+    return {"mode": mode, "inserted": inserted, "errors": errors}
+
+#fare products of the old stations go with them
+def _swap(train_id: int, docs: list[dict], session):
+    trains_bump_stations_version(train_id, session)
+    stations_delete_many(train_id, session)
+    travels_update_many(train_id, {"is_deleted": True, "updated_at": datetime.utcnow()}, session)
+
+    for start in range(0, len(docs), BATCH_SIZE):
+        stations_insert_many(docs[start:start + BATCH_SIZE], session)
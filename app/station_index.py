@@ -0,0 +1,74 @@
+from bisect import bisect_left, bisect_right
+from threading import Lock
+from time import monotonic
+from .queries import stations_find_sorted
+
+#Per-train stations sorted by position, kept in memory so ordered listings and
+#range lookups are answered by binary search instead of unsorted collection scans.
+#Entries are rebuilt on station writes in this process and expire after
+#INDEX_TTL seconds so other workers' writes are picked up; a caller that knows the
+#train's stations_version gets an entry loaded at that version or later.
+INDEX_TTL = 30
+
+class TrainStations:
+    def __init__(self, docs: list[dict], version: int = None):
+        self.stations = docs
+        self.version = version
+        self.positions = [i["position"] for i in docs]
+        self.by_id = {i["station_id"]: i for i in docs}
+        self.loaded_at = monotonic()
+
+_index: dict[int, TrainStations] = {}
+_lock = Lock()
+
+
+def rebuild(train_id: int, version: int = None) -> TrainStations:
+    entry = TrainStations(list(stations_find_sorted(train_id)), version)
+    with _lock:
+        _index[train_id] = entry
+    return entry
+
+def invalidate(train_id: int):
+    with _lock:
+        _index.pop(train_id, None)
+
+def get(train_id: int, version: int = None) -> TrainStations:
+    entry = _index.get(train_id)
+    if entry is None or monotonic() - entry.loaded_at > INDEX_TTL or (version is not None and (entry.version is None or entry.version < version)):
+        entry = rebuild(train_id, version)
+    return entry
+
+
+def ordered(train_id: int, version: int = None) -> list[dict]:
+    return get(train_id, version).stations
+
+def find(train_id: int, station_id: int):
+    return get(train_id).by_id.get(station_id)
+
+#stations from one position to another (inclusive), in the direction of travel
+def between(train_id: int, from_position: int, to_position: int) -> list[dict]:
+    entry = get(train_id)
+    low, high = sorted((from_position, to_position))
+
+    result = entry.stations[bisect_left(entry.positions, low):bisect_right(entry.positions, high)]
+
+    if from_position > to_position:
+        result = result[::-1]
+    return result
+
+#closest stations to a position, nearest first (ties go to the lower position)
+def nearest(train_id: int, position: int, limit: int = 1) -> list[dict]:
+    entry = get(train_id)
+    right = bisect_left(entry.positions, position)
+    left = right - 1
+    result = []
+
+    while len(result) < limit and (left >= 0 or right < len(entry.positions)):
+        if right >= len(entry.positions) or (left >= 0 and position - entry.positions[left] <= entry.positions[right] - position):
+            result.append(entry.stations[left])
+            left -= 1
+        else:
+            result.append(entry.stations[right])
+            right += 1
+
+    return result
@@ -1,3 +1,4 @@
+import math
 from fastapi import status, HTTPException
 
 def validate_user_exists(user, user_id: int = None):
@@ -24,6 +25,14 @@ def validate_balance_exists(balance, balance_id: int = None):
             detail=detail
         )
     
+#a conditional balance update found the total changed since it was read
+def validate_balance_unchanged(balance):
+    if balance is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Balance was changed by another request, please retry"
+        )
+
 def validate_transaction_exists(transaction, transaction_id: int = None):
     if not transaction:
         if transaction_id:
@@ -84,6 +93,133 @@ def validate_payment_exists(payment, payment_id: int = None):
             detail=detail
         )
 
+def validate_fare_timezone(valid: bool, name: str):
+    if not valid:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown timezone {name}"
+        )
+
+def validate_repricing_job_exists(job, job_id: int):
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Repricing job with id {job_id} was not found"
+        )
+
+def validate_repricing_job_resumable(job):
+    if job["status"] == "done":
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Repricing job with id {job['job_id']} is already done"
+        )
+
+def validate_task_exists(task, task_id: int):
+    if not task:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Task with id {task_id} was not found"
+        )
+
+def validate_task_dead(task):
+    if not task:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Only dead tasks can be retried"
+        )
+
+def validate_trip_exists(trip, trip_id: int):
+    if not trip:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Trip with id {trip_id} was not found"
+        )
+
+def validate_trip_route(stops: list):
+    if len(stops) < 2:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="A trip needs a train with at least two stations"
+        )
+
+def validate_stop_minutes(stop_minutes, stop_count: int):
+    if stop_minutes is not None and (len(stop_minutes) != stop_count or stop_minutes[0] != 0 or stop_minutes != sorted(stop_minutes)):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"stop_minutes needs {stop_count} non-decreasing values starting at 0, one per station"
+        )
+
+def validate_trip_segments(segments, departure_id: int, arrival_id: int):
+    if segments is None:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Trip doesn't run from station {departure_id} to station {arrival_id}"
+        )
+
+def validate_seats_available(reservation):
+    if not reservation:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Not enough seats left on this trip"
+        )
+
+def validate_reservation_exists(reservation, reservation_id: int):
+    if not reservation:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Reservation with id {reservation_id} was not found"
+        )
+
+def validate_reservation_held(reservation, reservation_id: int):
+    if not reservation:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Reservation with id {reservation_id} is not held (paid, cancelled or expired)"
+        )
+
+def validate_reservation_travel(reservation: dict, travel: dict):
+    if (reservation["train_id"], reservation["departure_id"], reservation["arrival_id"]) != (travel["train_id"], travel["departure_id"], travel["arrival_id"]):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Reservation is for a different travel"
+        )
+
+def validate_journey_exists(journey, departure_id: int, arrival_id: int):
+    if not journey:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No journey found from station {departure_id} to station {arrival_id}"
+        )
+
+def validate_station_position_available(taken: bool, position: int):
+    if taken:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Position {position} is already used by another station of this train"
+        )
+
+def validate_import_format(file_format):
+    if file_format is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Unknown file format; upload a .csv or .ndjson file or pass format=csv|ndjson"
+        )
+
+def validate_fields(requested, allowed: list[str]):
+    unknown = [i for i in requested if i not in allowed]
+    if unknown or not requested:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Invalid fields {', '.join(unknown)}; allowed fields are {', '.join(allowed)}"
+        )
+
+def validate_history_filters(supported: bool, sort_field: str):
+    if not supported:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unsupported filter combination; range filters are only allowed on the sort field ({sort_field})"
+        )
+
 #Token and logged in IDs
 def validate_logged_in_user(current_user: int, user_id: int):
     if current_user != user_id:
@@ -98,3 +234,11 @@ def validate_required_roles(current_user_role: str, allowed_roles: list[str]):
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"Only {', '.join(allowed_roles)} authorized to perform this action"
         )
+
+def validate_rate_limit(retry_after: float):
+    if retry_after > 0:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
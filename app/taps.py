@@ -0,0 +1,270 @@
+from collections import deque
+from itertools import chain
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from typing import Callable, Optional
+from pymongo import DeleteOne, ReplaceOne, UpdateOne, errors
+from .config import settings
+from .database import client, open_taps, tap_checkpoints, tap_charges
+from .queries import fares_spent_between
+from .response import BalanceResponse
+from . import balance_store, events, fare_engine, journey, timetable
+
+#Tap-in/tap-out ingestion for card gates. Gates post batches of tap events; each
+#event carries the gate's own increasing seq, and the highest seq settled per gate is
+#checkpointed, so a batch sent again after a timeout is skipped instead of charged
+#twice. Charges are keyed by their tap, so one already stored (a batch settled by
+#another worker) is skipped rather than failing the batch.
+#
+#Open journeys (a user's tap-in waiting for its tap-out) are kept in memory and
+#paired per user in event-time order. A tap-out closes the open journey and is
+#charged the fare between the two stations (the compiled fare table, in the time
+#band of the tap-in; a ride across trains is charged its cheapest journey plan),
+#within the daily cap counted over the user's payments and tap fares of that day. A
+#journey without a tap-out (another tap-in, or nothing for TAP_MAX_JOURNEY_MINUTES
+#of event time) and a tap-out without a tap-in are charged TAP_PENALTY_FARE.
+#
+#Each batch is settled in one transaction: the charges, one $inc per user on the
+#balances (the sum of the user's charges in the batch), the changed open journeys
+#and the gate checkpoints. Memory is updated only after it commits. Balances may go
+#negative; the rides already happened. Taps of users without a live balance are
+#rejected, not charged. Every debited user gets a balance event once it commits.
+#
+#The open journeys live in one process: send every gate's taps to the same worker.
+
+class Settlement:
+    def __init__(self):
+        self.charges: list[dict] = []
+        self.opened: dict[int, Optional[dict]] = {}     #user_id -> open journey, None once closed
+        self.checkpoints: dict[str, int] = {}
+        self.swept = 0          #entries of the sweep queue this batch went through
+        self.tap_ins: list[tuple[datetime, int]] = []
+        self.watermark: Optional[datetime] = None
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+    #amount per user, to settle with one write each
+    def debits(self, charges: list[dict] = None) -> dict[int, float]:
+        debits = {}
+        for charge in self.charges if charges is None else charges:
+            debits[charge["user_id"]] = round(debits.get(charge["user_id"], 0) + charge["amount"], 2)
+        return debits
+
+    def summary(self) -> dict:
+        return {
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "fares": sum(1 for i in self.charges if i["type"] == "fare"),
+            "penalties": sum(1 for i in self.charges if i["type"] == "penalty"),
+            "amount": round(sum(i["amount"] for i in self.charges), 2)
+        }
+
+
+class TapState:
+    def __init__(self, journeys: dict[int, dict], checkpoints: dict[str, int]):
+        self.open = journeys
+        self.checkpoints = checkpoints
+        #tap-ins in arrival order, for expiring journeys that never tapped out
+        self.pending = deque(sorted((tap["at"], user_id) for user_id, tap in journeys.items()))
+        self.watermark = self.pending[-1][0] if self.pending else None
+
+    #pairs a batch without changing the state; apply() the result once it is settled.
+    #fare(tap_in, tap_out) returns None for a ride it can't price; taps of users not
+    #in `users` (when given) are rejected
+    def pair(self, events: list[dict], fare: Callable[[dict, dict], Optional[float]], penalty: float, max_journey: timedelta, users: set[int] = None) -> Settlement:
+        result = Settlement()
+        result.received = len(events)
+        result.watermark = self.watermark
+
+        def current(user_id: int) -> Optional[dict]:
+            return result.opened[user_id] if user_id in result.opened else self.open.get(user_id)
+
+        def charge(user_id: int, key: str, kind: str, amount: float, tap_in: Optional[dict], tap_out: Optional[dict], reason: str = None):
+            result.charges.append({
+                "_id": key,
+                "user_id": user_id,
+                "type": kind,
+                "reason": reason,
+                "amount": amount,
+                "tap_in": tap_in,
+                "tap_out": tap_out,
+                "created_at": datetime.utcnow()
+            })
+
+        seen = set()
+        for event in sorted(events, key=lambda i: (i["at"], i["gate_id"], i["seq"])):
+            gate_id, seq = event["gate_id"], event["seq"]
+            if seq <= self.checkpoints.get(gate_id, 0) or (gate_id, seq) in seen:
+                result.duplicates += 1
+                continue
+            seen.add((gate_id, seq))
+            result.checkpoints[gate_id] = max(seq, result.checkpoints.get(gate_id, 0))
+
+            if event["train_id"] is None or (users is not None and event["user_id"] not in users):
+                result.rejected += 1        #unknown station, or no balance to charge
+                continue
+
+            user_id = event["user_id"]
+            tap = {k: event[k] for k in ("gate_id", "seq", "station_id", "train_id", "at")}
+            open_journey = current(user_id)
+
+            if event["type"] == "in":
+                if open_journey is not None:
+                    charge(user_id, f'{open_journey["gate_id"]}:{open_journey["seq"]}', "penalty", penalty, open_journey, None, "no_tap_out")
+                result.opened[user_id] = tap
+                result.tap_ins.append((tap["at"], user_id))
+            elif open_journey is None:
+                charge(user_id, f"{gate_id}:{seq}", "penalty", penalty, None, tap, "no_tap_in")
+            else:
+                amount = fare(open_journey, tap)
+                if amount is None:
+                    charge(user_id, f"{gate_id}:{seq}", "penalty", penalty, open_journey, tap, "unpriced")
+                else:
+                    charge(user_id, f"{gate_id}:{seq}", "fare", amount, open_journey, tap)
+                result.opened[user_id] = None
+
+            if result.watermark is None or tap["at"] > result.watermark:
+                result.watermark = tap["at"]
+
+        #journeys still open max_journey after they started, by event time
+        if result.watermark is not None:
+            cutoff = result.watermark - max_journey
+            for at, user_id in chain(self.pending, result.tap_ins):
+                if at >= cutoff:
+                    break
+                result.swept += 1
+                open_journey = current(user_id)
+                if open_journey is not None and open_journey["at"] == at:
+                    charge(user_id, f'{open_journey["gate_id"]}:{open_journey["seq"]}', "penalty", penalty, open_journey, None, "no_tap_out")
+                    result.opened[user_id] = None
+
+        return result
+
+    def apply(self, result: Settlement):
+        for user_id, tap in result.opened.items():
+            if tap is None:
+                self.open.pop(user_id, None)
+            else:
+                self.open[user_id] = tap
+        self.checkpoints.update(result.checkpoints)
+
+        self.pending.extend(result.tap_ins)
+        for i in range(result.swept):
+            self.pending.popleft()
+        self.watermark = result.watermark
+
+
+#naive UTC, like everything stored
+def _utc(at: datetime) -> datetime:
+    return at.astimezone(timezone.utc).replace(tzinfo=None) if at.tzinfo else at
+
+def fare(tap_in: dict, tap_out: dict) -> Optional[float]:
+    band = fare_engine.current_band(tap_in["at"])
+    if tap_in["train_id"] == tap_out["train_id"]:
+        return fare_engine.quote(tap_in["train_id"], tap_in["station_id"], tap_out["station_id"], band)
+    plan = journey.plan(tap_in["station_id"], tap_out["station_id"])
+    return plan["total"] if plan else None
+
+#lowers fares to what is left of each user's daily cap, in event order; penalties
+#are not capped
+def _apply_daily_cap(result: Settlement):
+    daily_cap = fare_engine.current_config().get("daily_cap")
+    fares = [i for i in result.charges if i["type"] == "fare"]
+    if daily_cap is None or not fares:
+        return
+
+    days: dict[datetime, list[dict]] = {}
+    for charge in fares:
+        days.setdefault(fare_engine.local_day_start(charge["tap_in"]["at"]), []).append(charge)
+
+    for day, charges in days.items():
+        spent = fares_spent_between(list({i["user_id"] for i in charges}), day, day + timedelta(days=1))
+        for charge in charges:
+            used = spent.get(charge["user_id"], 0)
+            charge["amount"] = max(0, min(charge["amount"], round(daily_cap - used, 2)))
+            spent[charge["user_id"]] = round(used + charge["amount"], 2)
+
+def _publish_balances(user_ids: list[int]):
+    for user_id, balance in balance_store.find_many(user_ids).items():
+        events.publish(user_id, "balance", BalanceResponse(**balance))
+
+def _settle(result: Settlement):
+    journeys = [
+        DeleteOne({"_id": user_id}) if tap is None else ReplaceOne({"_id": user_id}, tap, upsert=True)
+        for user_id, tap in result.opened.items()
+    ]
+    checkpoints = [UpdateOne({"_id": gate_id}, {"$max": {"seq": seq}}, upsert=True) for gate_id, seq in result.checkpoints.items()]
+
+    #returns the ids of charges that were already stored, with their debit
+    def write(session) -> set[str]:
+        settled = set()
+        if result.charges:
+            settled = {i["_id"] for i in tap_charges.find({"_id": {"$in": [i["_id"] for i in result.charges]}}, {"_id": 1}, session=session)}
+            charges = [i for i in result.charges if i["_id"] not in settled]
+            if charges:
+                tap_charges.insert_many(charges, ordered=False, session=session)
+                balance_store.debit_many(result.debits(charges), session)
+        if journeys:
+            open_taps.bulk_write(journeys, ordered=False, session=session)
+        if checkpoints:
+            tap_checkpoints.bulk_write(checkpoints, ordered=False, session=session)
+        return settled
+
+    #a duplicate key means another worker stored the same charges after our read; the
+    #second attempt sees and skips them
+    for attempt in range(2):
+        try:
+            with client.start_session() as session:
+                settled = session.with_transaction(write)
+            break
+        except errors.BulkWriteError as e:
+            if attempt or any(i["code"] != 11000 for i in e.details["writeErrors"]):
+                raise
+
+    if settled:
+        result.charges = [i for i in result.charges if i["_id"] not in settled]
+        result.duplicates += len(settled)
+
+#checkpoints moved on by other workers since this one loaded them
+def _refresh_checkpoints(state: TapState, events: list[dict]):
+    gate_ids = list({i["gate_id"] for i in events})
+    for checkpoint in tap_checkpoints.find({"_id": {"$in": gate_ids}}):
+        if checkpoint["seq"] > state.checkpoints.get(checkpoint["_id"], 0):
+            state.checkpoints[checkpoint["_id"]] = checkpoint["seq"]
+
+def _load() -> TapState:
+    journeys = {i.pop("_id"): i for i in open_taps.find()}
+    checkpoints = {i["_id"]: i["seq"] for i in tap_checkpoints.find()}
+    return TapState(journeys, checkpoints)
+
+_state: Optional[TapState] = None
+_lock = Lock()
+
+#events are dicts of TapEvent fields; returns the batch summary
+def ingest(events: list[dict]) -> dict:
+    global _state
+
+    for event in events:
+        event["at"] = _utc(event["at"])
+        event["train_id"] = timetable.train_of(event["station_id"])
+    users = balance_store.with_balance(list({i["user_id"] for i in events}))
+
+    #one batch at a time: pairing, settling and applying must not interleave
+    with _lock:
+        if _state is None:
+            _state = _load()
+        else:
+            _refresh_checkpoints(_state, events)
+
+        result = _state.pair(events, fare, settings.tap_penalty_fare, timedelta(minutes=settings.tap_max_journey_minutes), users)
+        _apply_daily_cap(result)
+        if result.charges or result.opened or result.checkpoints:
+            _settle(result)
+        _state.apply(result)
+
+    if result.charges:
+        _publish_balances(list(result.debits()))
+
+    return result.summary()
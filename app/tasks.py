@@ -0,0 +1,179 @@
+import random
+import socket
+import sys
+import traceback
+from datetime import datetime, timedelta
+from threading import Condition, Event, Thread
+from typing import Callable, Optional
+from uuid import uuid4
+from pymongo import ReturnDocument, errors
+from .body import get_next_sequence
+from .config import settings
+from .database import tasks
+from .queries import tasks_find_active, tasks_claim, tasks_update_leased
+
+#Durable background tasks. Handlers enqueue follow-up work as a named task with
+#JSON-like args; the task document in the tasks collection is the queue entry, so
+#pending work survives restarts. Each API process runs TASK_WORKERS worker threads
+#(or run `python -m app.tasks worker` separately) that claim due tasks with a lease
+#and renew it while the task runs; a task whose worker died is claimed again once
+#its lease runs out. Handlers must therefore be idempotent.
+#
+#A failing task is retried with exponential backoff and moved to status "dead"
+#(the dead letters, kept with their last error) after max_attempts.
+#
+#Tasks are registered with @task("name") at import time of the module defining
+#them (app/cascades.py, app/reservations.py).
+
+LEASE = 60              #seconds
+POLL_INTERVAL = 1.0     #seconds between polls of an idle worker
+BACKOFF_BASE = 2        #seconds, doubled per attempt
+BACKOFF_MAX = 600
+MAX_ATTEMPTS = 5
+
+_handlers: dict[str, tuple[Callable, int]] = {}
+_wakeup = Condition()
+_workers: list[Thread] = []
+_stop = Event()
+
+WORKER_PREFIX = f"{socket.gethostname()}:{uuid4().hex[:8]}"
+
+
+def task(name: str, max_attempts: int = MAX_ATTEMPTS):
+    def register(handler: Callable):
+        _handlers[name] = (handler, max_attempts)
+        return handler
+    return register
+
+#returns the task; with a dedupe_key, an unfinished task with the same key is
+#returned instead of queueing a second one
+def enqueue(name: str, args: dict = None, dedupe_key: Optional[str] = None, created_by: Optional[int] = None, delay: float = 0) -> dict:
+    if name not in _handlers:
+        raise ValueError(f"Unknown task {name}")
+
+    now = datetime.utcnow()
+    doc = {
+        "task_id": get_next_sequence("task_id"),
+        "name": name,
+        "args": args or {},
+        "status": "pending",
+        "attempts": 0,
+        "max_attempts": _handlers[name][1],
+        "run_at": now + timedelta(seconds=delay),
+        "lease_until": None,
+        "worker": None,
+        "error": None,
+        "created_by": created_by,
+        "created_at": now,
+        "updated_at": None,
+        "finished_at": None
+    }
+    if dedupe_key is not None:
+        doc["active_key"] = dedupe_key
+
+    try:
+        tasks.insert_one(dict(doc))
+    except errors.DuplicateKeyError:
+        existing = tasks_find_active(dedupe_key)
+        if existing is not None:
+            return existing
+        tasks.insert_one(dict(doc))     #the other one finished in between
+
+    with _wakeup:
+        _wakeup.notify()
+    return doc
+
+def backoff(attempts: int) -> float:
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _renew_lease(task_id: int, worker: str, done: Event):
+    while not done.wait(LEASE / 3):
+        tasks_update_leased(task_id, worker, {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=LEASE)}})
+
+#claims and runs one due task; False if there was none
+def run_one(worker: str) -> bool:
+    now = datetime.utcnow()
+    claimed = tasks_claim(now, now + timedelta(seconds=LEASE), worker)
+    if claimed is None:
+        return False
+
+    task_id = claimed["task_id"]
+    done = Event()
+    Thread(target=_renew_lease, args=(task_id, worker, done), daemon=True).start()
+
+    try:
+        if claimed["name"] not in _handlers:
+            raise RuntimeError(f'No handler registered for task {claimed["name"]}')
+        handler, _ = _handlers[claimed["name"]]
+        handler(**claimed["args"])
+
+    except Exception as error:
+        done.set()
+        now = datetime.utcnow()
+        message = "".join(traceback.format_exception_only(type(error), error)).strip()
+
+        if claimed["attempts"] >= claimed["max_attempts"]:
+            update = {"$set": {"status": "dead", "error": message, "updated_at": now, "finished_at": now}, "$unset": {"active_key": ""}}
+        else:
+            update = {"$set": {"status": "pending", "error": message, "updated_at": now, "run_at": now + timedelta(seconds=backoff(claimed["attempts"]))}}
+        tasks_update_leased(task_id, worker, update)
+        return True
+
+    done.set()
+    now = datetime.utcnow()
+    tasks_update_leased(task_id, worker, {
+        "$set": {"status": "done", "error": None, "updated_at": now, "finished_at": now},
+        "$unset": {"active_key": ""}
+    })
+    return True
+
+def _work(worker: str):
+    while not _stop.is_set():
+        try:
+            if run_one(worker):
+                continue
+        except Exception:
+            pass    #database unavailable; try again after the poll interval
+
+        with _wakeup:
+            _wakeup.wait(POLL_INTERVAL)
+
+def start_workers(count: int = None):
+    count = settings.task_workers if count is None else count
+    for i in range(len(_workers), count):
+        thread = Thread(target=_work, args=(f"{WORKER_PREFIX}:{i}",), daemon=True)
+        thread.start()
+        _workers.append(thread)
+
+def stop_workers():
+    _stop.set()
+    with _wakeup:
+        _wakeup.notify_all()
+
+
+#puts a dead task back in the queue for another max_attempts; None unless it was dead
+def retry(task_id: int) -> Optional[dict]:
+    now = datetime.utcnow()
+    return tasks.find_one_and_update(
+        {"task_id": task_id, "status": "dead"},
+        {"$set": {"status": "pending", "attempts": 0, "run_at": now, "updated_at": now, "finished_at": None}},
+        {"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+if __name__ == "__main__":
+    #handlers register on app.tasks, not on this __main__ copy of the module
+    from . import cascades, reservations, tasks as queue
+
+    if len(sys.argv) != 2 or sys.argv[1] != "worker":
+        sys.exit("usage: python -m app.tasks worker")
+
+    queue.start_workers()
+    print(f"{settings.task_workers} task workers running, ctrl-c to stop")
+    try:
+        queue._stop.wait()
+    except KeyboardInterrupt:
+        queue.stop_workers()
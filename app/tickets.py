@@ -0,0 +1,186 @@
+import base64
+import binascii
+import hashlib
+import secrets
+import struct
+from datetime import datetime, timedelta
+from threading import Lock
+from time import time
+from typing import Optional
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from pymongo import UpdateOne, errors
+from .config import settings
+from .database import used_tickets
+
+#Signed tickets that a fare gate can check without the database. A payment issues
+#one: an Ed25519 signature over a fixed 41-byte body, base64url-encoded (140 chars,
+#fits a QR code):
+#
+#  version  1 byte   TICKET_VERSION
+#  key_id   4 bytes  first bytes of sha256(public key), for key rotation
+#  payment_id, travel_id, user_id   8 bytes each, big-endian
+#  nonce    4 bytes  random per issue, so a reissued ticket never matches an old one
+#  valid_from, valid_until          4 bytes each, epoch seconds
+#
+#Gates fetch the public key from GET /gates/key. POST /gates/validate verifies
+#batches of scans here. Used and revoked tickets are stored in a TTL collection keyed
+#by payment_id:nonce until they expire; marking a batch used is one insert_many, and
+#a duplicate key is a replay, whichever worker saw the first scan. Each process also
+#remembers the keys it has seen, to reject repeats without the database.
+#
+#The signing key is TICKET_SIGNING_KEY (base64 of a 32-byte seed), or one derived
+#from SECRET_KEY when unset so every worker signs with the same key.
+
+TICKET_VERSION = 1
+BODY = struct.Struct(">B4sQQQIII")
+SIGNATURE_SIZE = 64
+TOKEN_SIZE = BODY.size + SIGNATURE_SIZE
+PRUNE_EVERY = 60    #seconds between sweeps of expired tickets out of the local used set
+
+def _seed() -> bytes:
+    if settings.ticket_signing_key:
+        return base64.b64decode(settings.ticket_signing_key)
+    return hashlib.sha256(f"tickets:{settings.secret_key}".encode()).digest()
+
+_private_key = Ed25519PrivateKey.from_private_bytes(_seed())
+public_key_bytes = _private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+_public_key = Ed25519PublicKey.from_public_bytes(public_key_bytes)
+key_id = hashlib.sha256(public_key_bytes).digest()[:4]
+
+def _epoch(at: datetime) -> int:
+    return int((at - datetime(1970, 1, 1)).total_seconds())
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(token: str) -> bytes:
+    return base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+
+
+def issue(payment: dict) -> str:
+    valid_from = payment["created_at"]
+    valid_until = valid_from + timedelta(hours=settings.ticket_valid_hours)
+    nonce = secrets.randbits(32)
+    body = BODY.pack(TICKET_VERSION, key_id, payment["payment_id"], payment["travel_id"], payment["user_id"], nonce, _epoch(valid_from), _epoch(valid_until))
+    return b64encode(body + _private_key.sign(body))
+
+#(claims, None) for a well-formed ticket of the current key, else (None, reason);
+#the signature is checked by verify()
+def parse(token: str) -> tuple[Optional[dict], Optional[str]]:
+    try:
+        raw = _b64decode(token)
+    except (binascii.Error, ValueError):
+        return None, "malformed"
+    if len(raw) != TOKEN_SIZE:
+        return None, "malformed"
+
+    version, ticket_key_id, payment_id, travel_id, user_id, nonce, valid_from, valid_until = BODY.unpack_from(raw)
+    if version != TICKET_VERSION or ticket_key_id != key_id:
+        return None, "unknown_key"
+
+    return {
+        "payment_id": payment_id, "travel_id": travel_id, "user_id": user_id, "valid_from": valid_from, "valid_until": valid_until,
+        "key": f"{payment_id}:{nonce}", "raw": raw
+    }, None
+
+def verify(claims: dict) -> bool:
+    raw = claims["raw"]
+    try:
+        _public_key.verify(raw[BODY.size:], raw[:BODY.size])
+        return True
+    except InvalidSignature:
+        return False
+
+#payment_id:nonce -> (valid_until, reason) of tickets this process knows are used or revoked
+_used: dict[str, tuple[int, str]] = {}
+_lock = Lock()
+_pruned_at = time()
+
+def _prune(now: int):
+    global _pruned_at
+    for key in [k for k, (valid_until, _) in _used.items() if valid_until < now]:
+        del _used[key]
+    _pruned_at = now
+
+def _entry(claims: dict, kind: str) -> dict:
+    return {"_id": claims["key"], "payment_id": claims["payment_id"], "kind": kind, "expires_at": datetime.utcfromtimestamp(claims["valid_until"])}
+
+#a deleted or changed payment's old ticket stops working at every gate
+def revoke(token: Optional[str]):
+    revoke_many([token])
+
+def revoke_many(tokens: list[Optional[str]]):
+    revoked = [claims for claims in (parse(i)[0] if i else None for i in tokens) if claims is not None]
+    if not revoked:
+        return
+    used_tickets.bulk_write([UpdateOne({"_id": claims["key"]}, {"$set": _entry(claims, "revoked")}, upsert=True) for claims in revoked], ordered=False)
+    with _lock:
+        for claims in revoked:
+            _used[claims["key"]] = (claims["valid_until"], "revoked")
+
+def _rejection(claims: dict, now: int) -> Optional[str]:
+    if now < claims["valid_from"]:
+        return "not_yet_valid"
+    if now > claims["valid_until"]:
+        return "expired"
+    if claims["key"] in _used:
+        return _used[claims["key"]][1]
+    return None
+
+#inserts the tickets as used; returns the reason for the ones already stored
+def _mark_used(accepted: list[dict]) -> dict[str, str]:
+    try:
+        used_tickets.insert_many([_entry(claims, "used") for claims in accepted], ordered=False)
+        return {}
+    except errors.BulkWriteError as e:
+        if any(i["code"] != 11000 for i in e.details["writeErrors"]):
+            raise
+        taken = {accepted[i["index"]]["key"] for i in e.details["writeErrors"]}
+
+    reasons = {i["_id"]: "revoked" if i["kind"] == "revoked" else "already_used" for i in used_tickets.find({"_id": {"$in": list(taken)}}, {"kind": 1})}
+    return {key: reasons.get(key, "already_used") for key in taken}
+
+#one result per token, in order; a valid ticket is marked used, so a second scan
+#(in this batch, a later one or on another worker) is a replay. Rejecting never lets
+#anyone through, so only tickets that pass the cheap checks have their signature
+#verified, and only those are written
+def validate_batch(tokens: list[str], now: int = None) -> list[dict]:
+    now = int(time()) if now is None else now
+    checked = []
+    for token in tokens:
+        claims, reason = parse(token)
+        if claims is not None:
+            reason = _rejection(claims, now)
+            if reason is None and not verify(claims):
+                reason = "bad_signature"
+        checked.append((claims, reason))
+
+    #the first scan of a ticket in the batch is the one inserted, later ones are replays
+    accepted = list({claims["key"]: claims for claims, reason in reversed(checked) if reason is None}.values())
+    taken = _mark_used(accepted) if accepted else {}
+
+    results = []
+    with _lock:
+        if now - _pruned_at > PRUNE_EVERY:
+            _prune(now)
+
+        first = set()
+        for claims, reason in checked:
+            if reason is None:
+                key = claims["key"]
+                if key in first:
+                    reason = "already_used"
+                else:
+                    first.add(key)
+                    reason = taken.get(key)
+                _used.setdefault(key, (claims["valid_until"], reason or "already_used"))
+
+            results.append({
+                "valid": reason is None,
+                "reason": reason,
+                "payment_id": claims["payment_id"] if claims and reason != "bad_signature" else None,
+                "travel_id": claims["travel_id"] if claims and reason != "bad_signature" else None
+            })
+    return results
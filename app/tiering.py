@@ -0,0 +1,282 @@
+import mmap
+import os
+import sys
+import zlib
+from datetime import datetime
+from threading import Lock
+from time import monotonic
+from typing import Callable, Iterable, Optional
+import numpy as np
+from bson import json_util
+from .config import settings
+from .database import transactions, transaction_buckets, payments
+
+#Cold storage for transactions and payments. `python -m app.tiering run` exports
+#every month older than COLD_AFTER_MONTHS to local files and then deletes it from
+#Mongo, so the hot collections only hold recent history.
+#
+#A month of a collection is one or more part files under
+#<COLD_DIR>/<collection>/<YYYY-MM>/ (a re-run adds a part):
+#  part-NNNN.ndjson.z  per user, one zlib-compressed frame of extended-JSON lines,
+#                      users in ascending user_id order
+#  part-NNNN.idx       sidecar index: (user_id, offset, length) per frame
+#Reading a user's month is a binary search in the index and one decompress of a
+#slice of the memory-mapped data file.
+#
+#History endpoints merge cold records in when the request's created_at range starts or
+#ends before the oldest hot month (cold_cutoff); without a range they list hot records
+#only. Single record GETs fall back to cold storage; cold records are read-only, so
+#PUT and DELETE only reach hot ones.
+
+ID_FIELDS = {"transactions": "transaction_id", "payments": "payment_id"}
+INDEX_DTYPE = np.dtype([("user_id", "<i8"), ("offset", "<u8"), ("length", "<u8")])
+LISTING_TTL = 60    #seconds before the cold months on disk are listed again
+
+
+def month_start(at: datetime) -> datetime:
+    return datetime(at.year, at.month, 1)
+
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def _month_name(month: datetime) -> str:
+    return f"{month.year:04d}-{month.month:02d}"
+
+def _month_dir(collection: str, month: datetime) -> str:
+    return os.path.join(settings.cold_dir, collection, _month_name(month))
+
+def _parts(directory: str) -> list[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, i[:-len(".idx")]) for i in os.listdir(directory) if i.endswith(".idx"))
+
+
+#writing
+def _write_atomic(path: str, data: bytes):
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+#docs sorted by user_id; returns how many were written
+def write_part(collection: str, month: datetime, docs) -> int:
+    directory = _month_dir(collection, month)
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, f"part-{len(_parts(directory)):04d}")
+
+    written = 0
+    entries = []
+    frame_user, lines = None, []
+    with open(base + ".ndjson.z.tmp", "wb") as data:
+        def flush_frame():
+            frame = zlib.compress("".join(lines).encode())
+            entries.append((frame_user, data.tell(), len(frame)))
+            data.write(frame)
+
+        for doc in docs:
+            if doc["user_id"] != frame_user and lines:
+                flush_frame()
+                lines = []
+            frame_user = doc["user_id"]
+            lines.append(json_util.dumps(doc, json_options=json_util.CANONICAL_JSON_OPTIONS) + "\n")
+            written += 1
+        if lines:
+            flush_frame()
+
+        data.flush()
+        os.fsync(data.fileno())
+
+    if not written:
+        os.remove(base + ".ndjson.z.tmp")
+        return 0
+
+    #the index is renamed last; a part without one isn't read
+    os.replace(base + ".ndjson.z.tmp", base + ".ndjson.z")
+    _write_atomic(base + ".idx", np.array(entries, dtype=INDEX_DTYPE).tobytes())
+    _invalidate()
+    return written
+
+
+#reading
+class ColdPart:
+    def __init__(self, base: str):
+        self.index = np.fromfile(base + ".idx", dtype=INDEX_DTYPE)
+        with open(base + ".ndjson.z", "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    def read(self, user_id: int) -> list[dict]:
+        i = int(np.searchsorted(self.index["user_id"], user_id))
+        if i == len(self.index) or self.index["user_id"][i] != user_id:
+            return []
+        offset, length = int(self.index["offset"][i]), int(self.index["length"][i])
+        text = zlib.decompress(self.data[offset:offset + length]).decode()
+        return [json_util.loads(line) for line in text.splitlines()]
+
+_open_parts: dict[str, ColdPart] = {}
+_months: dict[str, tuple[float, list[datetime]]] = {}
+_lock = Lock()
+
+def _invalidate():
+    with _lock:
+        _months.clear()
+
+def _part(base: str) -> ColdPart:
+    part = _open_parts.get(base)
+    if part is None:
+        part = ColdPart(base)
+        with _lock:
+            _open_parts[base] = part
+    return part
+
+#months of a collection in cold storage, oldest first
+def cold_months(collection: str) -> list[datetime]:
+    listed = _months.get(collection)
+    if listed is None or monotonic() - listed[0] > LISTING_TTL:
+        directory = os.path.join(settings.cold_dir, collection)
+        names = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+        listed = (monotonic(), [datetime.strptime(i, "%Y-%m") for i in names if _parts(os.path.join(directory, i))])
+        with _lock:
+            _months[collection] = listed
+    return listed[1]
+
+#start of the oldest month still in Mongo, None if nothing was tiered
+def cold_cutoff(collection: str) -> Optional[datetime]:
+    months = cold_months(collection)
+    return add_months(months[-1], 1) if months else None
+
+def read_user(collection: str, user_id: int, first: datetime = None, last: datetime = None) -> list[dict]:
+    docs = {}
+    for month in cold_months(collection):
+        if (first is not None and add_months(month, 1) <= first) or (last is not None and month > last):
+            continue
+        for base in _parts(_month_dir(collection, month)):
+            for doc in _part(base).read(user_id):
+                docs[doc[ID_FIELDS[collection]]] = doc     #a re-run after a crash may repeat records
+    return list(docs.values())
+
+
+#history fallback
+def _matches(doc: dict, filters: dict) -> bool:
+    for field, condition in filters.items():
+        value = doc.get(field)
+        if isinstance(condition, dict):
+            if "$gte" in condition and (value is None or value < condition["$gte"]):
+                return False
+            if "$lte" in condition and (value is None or value > condition["$lte"]):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+def _project(doc: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return doc
+    included = {k for k, v in projection.items() if v}
+    if projection.get("_id", 1):
+        included.add("_id")
+    return {k: v for k, v in doc.items() if k in included}
+
+#the hot records as is, or merged with cold records when the range crosses the cutoff.
+#find(projection) runs the hot query; the merge reads the sort fields even when the
+#projection leaves them out, and drops them again afterwards
+def with_cold(collection: str, user_id: int, find: Callable[[Optional[dict]], Iterable[dict]], filters: dict, sort: list, projection: dict = None):
+    created_at = filters.get("created_at") or {}
+    if "$gte" not in created_at and "$lte" not in created_at:
+        return find(projection)
+    cutoff = cold_cutoff(collection)
+    if cutoff is None or not any(created_at.get(i, cutoff) < cutoff for i in ("$gte", "$lte")):
+        return find(projection)
+
+    added = [field for field, direction in sort or [] if projection and not projection.get(field)]
+    merge_projection = {**projection, **{field: 1 for field in added}} if added else projection
+
+    filters = {"is_deleted": False, **filters}
+    cold = [
+        _project(doc, merge_projection)
+        for doc in read_user(collection, user_id, created_at.get("$gte"), created_at.get("$lte"))
+        if _matches(doc, filters)
+    ]
+    docs = cold + list(find(merge_projection))
+
+    for field, direction in reversed(sort or []):
+        docs.sort(key=lambda i: (i.get(field) is None, i.get(field)), reverse=direction == -1)
+    for doc in docs:
+        for field in added:
+            doc.pop(field, None)
+    return docs
+
+#a record no longer in Mongo, looked up in every cold month of the user
+def find_one(collection: str, user_id: int, record_id: int, filters: dict = None, projection: dict = None) -> Optional[dict]:
+    filters = {"is_deleted": False, ID_FIELDS[collection]: record_id, **(filters or {})}
+    for doc in read_user(collection, user_id):
+        if _matches(doc, filters):
+            return _project(doc, projection)
+    return None
+
+#tiering job
+def _month_docs(collection: str, month: datetime):
+    end = add_months(month, 1)
+
+    if collection == "transactions" and settings.transaction_layout == "buckets":
+        return transaction_buckets.aggregate([
+            {"$match": {"month": month}},
+            {"$unwind": "$entries"},
+            {"$replaceRoot": {"newRoot": {"$mergeObjects": [{"user_id": "$user_id", "balance_id": "$balance_id"}, "$entries"]}}},
+            {"$sort": {"user_id": 1, "created_at": 1}}
+        ], allowDiskUse=True)
+
+    source = transactions if collection == "transactions" else payments
+    return source.aggregate([
+        {"$match": {"created_at": {"$gte": month, "$lt": end}}},
+        {"$sort": {"user_id": 1, "created_at": 1}}
+    ], allowDiskUse=True)
+
+def _delete_month(collection: str, month: datetime):
+    if collection == "transactions" and settings.transaction_layout == "buckets":
+        transaction_buckets.delete_many({"month": month})
+        return
+    source = transactions if collection == "transactions" else payments
+    source.delete_many({"created_at": {"$gte": month, "$lt": add_months(month, 1)}})
+
+def _oldest_month(collection: str) -> Optional[datetime]:
+    if collection == "transactions" and settings.transaction_layout == "buckets":
+        bucket = transaction_buckets.find_one({}, {"month": 1}, sort=[("month", 1)])
+        return bucket["month"] if bucket else None
+    source = transactions if collection == "transactions" else payments
+    doc = source.find_one({}, {"created_at": 1}, sort=[("created_at", 1)])
+    return month_start(doc["created_at"]) if doc else None
+
+#exports and removes every month before the cutoff; returns {collection: {month: count}}
+def run(now: datetime = None, report=None) -> dict:
+    cutoff = add_months(month_start(now or datetime.utcnow()), -settings.cold_after_months)
+    transactions.create_index("created_at")
+    payments.create_index("created_at")
+    transaction_buckets.create_index("month")
+
+    result = {}
+    for collection in ID_FIELDS:
+        result[collection] = {}
+        month = _oldest_month(collection)
+        while month is not None and month < cutoff:
+            count = write_part(collection, month, _month_docs(collection, month))
+            if count:
+                _delete_month(collection, month)     #only once the files are durable
+                result[collection][_month_name(month)] = count
+                if report:
+                    report(collection, _month_name(month), count)
+            month = add_months(month, 1)
+    return result
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2 and sys.argv[1] == "run":
+        totals = run(report=lambda collection, month, count: print(f"{collection} {month}: {count} records moved to cold storage"))
+        print(f'done: {sum(len(i) for i in totals.values())} months tiered')
+    elif len(sys.argv) == 4 and sys.argv[1] == "read":
+        collection, user_id = sys.argv[2], int(sys.argv[3])
+        for doc in sorted(read_user(collection, user_id), key=lambda i: i["created_at"]):
+            print(json_util.dumps(doc))
+    else:
+        sys.exit("usage: python -m app.tiering run | read <transactions|payments> <user_id>")
@@ -0,0 +1,157 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from threading import Lock
+from time import monotonic
+from typing import Optional
+from .config import settings
+from .queries import trips_find, stations_find_train
+from . import station_index
+
+#Per-train timetables compiled from the trips collection, so "next departures from
+#X towards Y" is a binary search instead of a collection scan. For every station a
+#train serves, the departure times (epoch seconds) of its trips are kept sorted in
+#one list, with the trip_ids in a parallel list; each trip also maps station_id to
+#its time there, which gives the arrival at Y.
+#
+#A trip stops at its stations in position order; its time at a stop is stored in
+#"stop_times", or derived as departs_at + MINUTES_PER_POSITION per position from
+#the first stop for trips scheduled without them.
+#
+#Trip writes in this process update the timetable in place (add_trip) and station
+#writes drop the train's entry; entries expire after TIMETABLE_TTL seconds so other
+#workers' writes are picked up. Only trips that departed within the last LOOKBACK (still on their way) or later
+#are loaded.
+TIMETABLE_TTL = 30
+LOOKBACK = timedelta(days=1)
+EPOCH = datetime(1970, 1, 1)
+
+def seconds(at: datetime) -> int:
+    return int((at - EPOCH).total_seconds())
+
+def stop_times(trip: dict, stations: list[dict] = None) -> list[datetime]:
+    if trip.get("stop_times"):
+        return trip["stop_times"]
+    positions = {i["station_id"]: i["position"] for i in (stations or station_index.ordered(trip["train_id"]))}
+    first = positions.get(trip["stops"][0], 0)
+    return [
+        trip["departs_at"] + timedelta(minutes=(positions.get(i, first) - first) * settings.minutes_per_position)
+        for i in trip["stops"]
+    ]
+
+class TrainTimetable:
+    def __init__(self, trips: list[dict], stations: list[dict] = None):
+        self.loaded_at = monotonic()
+        self.times: dict[int, dict[int, int]] = {}                  #trip_id -> {station_id: seconds}
+        self.departures: dict[int, tuple[list, list]] = {}          #station_id -> (seconds, trip_ids)
+        self.order: dict[int, int] = {}                             #station_id -> index in the trips' stops
+
+        rows: dict[int, list[tuple[int, int]]] = {}
+        for trip in trips:
+            times = self._trip_times(trip, stations)
+            self.times[trip["trip_id"]] = times
+            self.order.update((station_id, i) for i, station_id in enumerate(trip["stops"]))
+            for station_id, at in times.items():
+                rows.setdefault(station_id, []).append((at, trip["trip_id"]))
+
+        for station_id, departures in rows.items():
+            departures.sort()
+            self.departures[station_id] = ([i[0] for i in departures], [i[1] for i in departures])
+
+    @staticmethod
+    def _trip_times(trip: dict, stations: list[dict] = None) -> dict[int, int]:
+        return {station_id: seconds(at) for station_id, at in zip(trip["stops"], stop_times(trip, stations))}
+
+    #edits replace a station's lists instead of changing them, so a concurrent
+    #reader sees either the old or the new pair
+    def add_trip(self, trip: dict):
+        self.remove_trip(trip["trip_id"])
+        times = self._trip_times(trip)
+        self.order.update((station_id, i) for i, station_id in enumerate(trip["stops"]))
+        for station_id, at in times.items():
+            at_list, trip_ids = self.departures.get(station_id, ([], []))
+            i = bisect_right(at_list, at)
+            self.departures[station_id] = (at_list[:i] + [at] + at_list[i:], trip_ids[:i] + [trip["trip_id"]] + trip_ids[i:])
+        self.times[trip["trip_id"]] = times
+
+    def remove_trip(self, trip_id: int):
+        times = self.times.pop(trip_id, None)
+        if times is None:
+            return
+        for station_id, at in times.items():
+            at_list, trip_ids = self.departures[station_id]
+            i = bisect_left(at_list, at)
+            while trip_ids[i] != trip_id:
+                i += 1
+            self.departures[station_id] = (at_list[:i] + at_list[i + 1:], trip_ids[:i] + trip_ids[i + 1:])
+
+    #[(trip_id, departs seconds, arrives seconds)] of the next trips from one station
+    #to a later one, departing at or after `after`
+    def next_departures(self, departure_id: int, arrival_id: int, after: int, limit: int) -> list[tuple[int, int, int]]:
+        #no trip gets there, or the pair runs against the line: nothing to scan for
+        if arrival_id not in self.departures:
+            return []
+        if self.order.get(arrival_id, 0) <= self.order.get(departure_id, 0):
+            return []
+
+        at_list, trip_ids = self.departures.get(departure_id, ((), ()))
+        result = []
+        i = bisect_left(at_list, after)
+        while i < len(at_list) and len(result) < limit:
+            arrives = self.times.get(trip_ids[i], {}).get(arrival_id)
+            if arrives is not None and arrives > at_list[i]:
+                result.append((trip_ids[i], at_list[i], arrives))
+            i += 1
+        return result
+
+
+_timetables: dict[int, TrainTimetable] = {}
+_station_trains: dict[int, int] = {}
+_lock = Lock()
+
+
+def rebuild(train_id: int) -> TrainTimetable:
+    trips = list(trips_find({"train_id": train_id, "departs_at": {"$gte": datetime.utcnow() - LOOKBACK}}))
+    entry = TrainTimetable(trips, station_index.ordered(train_id))
+    with _lock:
+        _timetables[train_id] = entry
+    return entry
+
+def invalidate(train_id: int):
+    with _lock:
+        _timetables.pop(train_id, None)
+
+def get(train_id: int) -> TrainTimetable:
+    entry = _timetables.get(train_id)
+    if entry is None or monotonic() - entry.loaded_at > TIMETABLE_TTL:
+        entry = rebuild(train_id)
+    return entry
+
+def add_trip(trip: dict):
+    entry = _timetables.get(trip["train_id"])
+    if entry is not None:
+        with _lock:
+            entry.add_trip(trip)
+
+#a station never moves to another train, so this is cached for good
+def train_of(station_id: int) -> Optional[int]:
+    train_id = _station_trains.get(station_id)
+    if train_id is None:
+        station = stations_find_train(station_id)
+        if station is None:
+            return None
+        train_id = station["train_id"]
+        with _lock:
+            _station_trains[station_id] = train_id
+    return train_id
+
+#[(trip_id, train_id, departs_at, arrives_at)], empty unless both stations are on one train
+def next_departures(departure_id: int, arrival_id: int, after: datetime = None, limit: int = 5) -> list[tuple[int, int, datetime, datetime]]:
+    train_id = train_of(departure_id)
+    if train_id is None or train_of(arrival_id) != train_id:
+        return []
+
+    after = after or datetime.utcnow()
+    return [
+        (trip_id, train_id, EPOCH + timedelta(seconds=departs), EPOCH + timedelta(seconds=arrives))
+        for trip_id, departs, arrives in get(train_id).next_departures(departure_id, arrival_id, seconds(after), limit)
+    ]
@@ -0,0 +1,124 @@
+from datetime import datetime
+from typing import Optional
+from bson import ObjectId
+from .database import transaction_buckets
+
+#Bucket layout of transactions (settings.transaction_layout = "buckets"): one
+#document per (user_id, balance_id, month) holding up to BUCKET_SIZE entries, with
+#a further bucket for the same month once one is full. The collection carries one
+#index entry per bucket instead of several per transaction, and a user's history is
+#a handful of documents read together.
+#
+#Entries keep the transaction fields (and an _id) minus user_id and balance_id,
+#which are merged back on read, so callers of the transactions_* queries see the
+#same documents in both layouts.
+
+BUCKET_SIZE = 200
+
+INDEX = [("user_id", 1), ("balance_id", 1), ("month", 1)]
+
+def month_start(at: datetime) -> datetime:
+    return datetime(at.year, at.month, 1)
+
+def _entry(doc: dict) -> dict:
+    entry = {k: v for k, v in doc.items() if k not in ("user_id", "balance_id")}
+    entry.setdefault("_id", ObjectId())
+    return entry
+
+def _flatten(bucket: dict, entry: dict) -> dict:
+    return {"user_id": bucket["user_id"], "balance_id": bucket["balance_id"], **entry}
+
+def _project(doc: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return doc
+    included = {k for k, v in projection.items() if v}
+    if projection.get("_id", 1):
+        included.add("_id")
+    return {k: v for k, v in doc.items() if k in included}
+
+#buckets for the transactions of one user and balance, in created_at order
+def bucket_docs(user_id: int, balance_id: int, docs: list[dict]) -> list[dict]:
+    buckets = []
+    for doc in sorted(docs, key=lambda i: i["created_at"]):
+        month = month_start(doc["created_at"])
+        if not buckets or buckets[-1]["month"] != month or buckets[-1]["count"] == BUCKET_SIZE:
+            buckets.append({"user_id": user_id, "balance_id": balance_id, "month": month, "count": 0, "entries": []})
+        buckets[-1]["entries"].append(_entry(doc))
+        buckets[-1]["count"] += 1
+    return buckets
+
+#aggregation returning a user's transactions like a find on the documents layout
+def history_pipeline(user_id: int, balance_id: int, projection: dict = None, filters: dict = None, sort: list = None) -> list[dict]:
+    filters = filters or {}
+    match = {"user_id": user_id, "balance_id": balance_id}
+
+    #a created_at range also skips whole months
+    created_at = filters.get("created_at")
+    if created_at:
+        months = {}
+        if "$gte" in created_at:
+            months["$gte"] = month_start(created_at["$gte"])
+        if "$lte" in created_at:
+            months["$lte"] = created_at["$lte"]
+        match["month"] = months
+
+    pipeline = [
+        {"$match": match},
+        {"$unwind": "$entries"},
+        {"$replaceRoot": {"newRoot": {"$mergeObjects": [{"user_id": "$user_id", "balance_id": "$balance_id"}, "$entries"]}}},
+        {"$match": {"is_deleted": False, **filters}}
+    ]
+    if sort:
+        pipeline.append({"$sort": dict(sort)})
+    if projection:
+        pipeline.append({"$project": projection})
+    return pipeline
+
+
+def insert_one(doc: dict) -> dict:
+    entry = _entry(doc)
+    transaction_buckets.update_one(
+        {"user_id": doc["user_id"], "balance_id": doc["balance_id"], "month": month_start(doc["created_at"]), "count": {"$lt": BUCKET_SIZE}},
+        {"$push": {"entries": entry}, "$inc": {"count": 1}},
+        upsert=True
+    )
+    return _flatten(doc, entry)
+
+def find(user_id: int, balance_id: int, projection: dict = None, filters: dict = None, sort: list = None):
+    return transaction_buckets.aggregate(history_pipeline(user_id, balance_id, projection, filters, sort))
+
+#key is {"transaction_id"} plus "user_id" and "balance_id" where known
+def _key_query(key: dict, deleted: Optional[bool]) -> dict:
+    query = {k: key[k] for k in ("user_id", "balance_id") if k in key}
+    element = {"transaction_id": key["transaction_id"]}
+    if deleted is not None:
+        element["is_deleted"] = deleted
+    query["entries"] = {"$elemMatch": element}
+    return query
+
+def find_one(key: dict, projection: dict = None, deleted: Optional[bool] = False) -> Optional[dict]:
+    bucket = transaction_buckets.find_one(_key_query(key, deleted), {"user_id": 1, "balance_id": 1, "entries.$": 1})
+    if bucket is None:
+        return None
+    return _project(_flatten(bucket, bucket["entries"][0]), projection)
+
+def update_one(key: dict, data: dict):
+    return transaction_buckets.update_one(
+        _key_query(key, None),
+        {"$set": {f"entries.$.{k}": v for k, v in data.items()}}
+    )
+
+def delete_one(key: dict):
+    return transaction_buckets.update_one(
+        _key_query(key, None),
+        {"$pull": {"entries": {"transaction_id": key["transaction_id"]}}, "$inc": {"count": -1}}
+    )
+
+def update_many(user_id: int, data: dict):
+    return transaction_buckets.update_many(
+        {"user_id": user_id},
+        {"$set": {f"entries.$[].{k}": v for k, v in data.items()}}
+    )
+
+def delete_many(user_id: int):
+    return transaction_buckets.delete_many({"user_id": user_id})
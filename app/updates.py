@@ -1,5 +1,6 @@
 from pydantic import BaseModel, EmailStr
 from typing import Optional, Literal
+from datetime import datetime
 
 class UserPut(BaseModel):
     email: EmailStr
@@ -20,6 +21,7 @@ class TrainPut(BaseModel):
 class StationPut(BaseModel):
     name: str
     position: int
+    interchange_group: Optional[str] = None
 
 class TravelPut(BaseModel):
     departure_id: int
@@ -48,11 +50,16 @@ class TransactionPatch(BaseModel):
 class StationPatch(BaseModel):
     name: Optional[str] = None
     position: Optional[int] = None
+    interchange_group: Optional[str] = None
 
 class TravelPatch(BaseModel):
     departure_id: Optional[int] = None
     arrival_id: Optional[int] = None
 
+class TripPatch(BaseModel):
+    departs_at: Optional[datetime] = None
+    stop_minutes: Optional[list[int]] = None
+
 # class PaymentPatch(BaseModel):
 #     travel_id: Optional[int] = None
 
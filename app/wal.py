@@ -0,0 +1,283 @@
+import fcntl
+import os
+import struct
+import sys
+import zlib
+from uuid import uuid4
+from threading import Condition
+import bson
+from .config import settings
+
+#Append-only, segmented write-ahead log of balance-affecting operations.
+#Handlers append an "intent" record (the document write plus the balance change
+#from -> to) before touching Mongo and a "commit" record afterwards ("abort" if
+#the conditional balance update found the total changed), so an
+#operation interrupted halfway can be re-applied or verified with
+#`python -m app.wal replay|verify`.
+#
+#Each record is <length:u32><crc32:u32><bson payload>. Intents are group
+#committed: concurrent appends share one write + fsync, and the caller returns
+#once its record is durable. Segments rotate once they exceed WAL_SEGMENT_BYTES.
+#
+#Each process writes its own segments, in the first WAL_DIR/writer-<n> directory
+#whose lock file it can flock, so uvicorn workers never truncate or rotate each
+#other's files; a restarted worker takes over a free directory and drops its torn
+#tail. The log is opened at app startup (open_log), or on first use, not at import.
+
+HEADER = struct.Struct("<II")
+
+class WALError(Exception):
+    pass
+
+def _segment_name(number: int) -> str:
+    return f"wal-{number:010d}.log"
+
+def _own_segments(directory: str) -> list[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, i) for i in os.listdir(directory) if i.startswith("wal-") and i.endswith(".log"))
+
+#every writer's segments (and ones written before per-writer directories)
+def segments(directory: str) -> list[str]:
+    if not os.path.isdir(directory):
+        return []
+    writers = sorted(os.path.join(directory, i) for i in os.listdir(directory) if i.startswith("writer-"))
+    return _own_segments(directory) + [path for writer in writers for path in _own_segments(writer)]
+
+#(directory, open lock file) of the first writer directory no other process holds;
+#the lock lasts as long as the file stays open
+def _claim_writer(directory: str):
+    number = 0
+    while True:
+        path = os.path.join(directory, f"writer-{number}")
+        os.makedirs(path, exist_ok=True)
+        lock = open(os.path.join(path, "lock"), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return path, lock
+        except BlockingIOError:
+            lock.close()
+            number += 1
+
+#yields (record, end offset) until the end of the file or the first torn/corrupt record
+def read_segment(path: str):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, crc = HEADER.unpack_from(data, offset)
+        payload = data[offset + HEADER.size:offset + HEADER.size + length]
+
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        offset += HEADER.size + length
+        yield bson.decode(payload), offset
+
+
+class WriteAheadLog:
+    def __init__(self, directory: str, segment_bytes: int):
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.directory, self.lock = _claim_writer(directory)
+
+        existing = _own_segments(self.directory)
+        if existing:
+            self.segment_number = int(os.path.basename(existing[-1])[4:-4])
+            #drop a torn tail left by a crash mid-write
+            valid_end = 0
+            for _, valid_end in read_segment(existing[-1]):
+                pass
+            with open(existing[-1], "r+b") as f:
+                f.truncate(valid_end)
+        else:
+            self.segment_number = 1
+
+        self.file = open(os.path.join(self.directory, _segment_name(self.segment_number)), "ab")
+        self.size = self.file.tell()
+
+        self.cond = Condition()
+        self.buffer: list[bytes] = []
+        self.appended = 0      #records handed to append()
+        self.durable = 0       #records written and fsynced
+        self.flushing = False
+        self.error = None
+
+    def append(self, record: dict, sync: bool = True) -> int:
+        payload = bson.encode(record)
+        frame = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+        with self.cond:
+            self.buffer.append(frame)
+            self.appended += 1
+            number = self.appended
+
+            if sync:
+                self._wait_durable(number)
+
+        return number
+
+    #expects self.cond to be held; the first waiter flushes everything buffered so far
+    def _wait_durable(self, number: int):
+        while self.durable < number:
+            if self.error is not None:
+                raise WALError("write-ahead log is not writable") from self.error
+
+            if self.flushing:
+                self.cond.wait()
+                continue
+
+            self.flushing = True
+            batch, self.buffer = self.buffer, []
+            target = self.appended
+
+            self.cond.release()
+            try:
+                self._write(batch)
+            except OSError as error:
+                self.error = error
+            finally:
+                self.cond.acquire()
+                self.flushing = False
+                if self.error is None:
+                    self.durable = target
+                self.cond.notify_all()
+
+    def _write(self, batch: list[bytes]):
+        data = b"".join(batch)
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size += len(data)
+
+        if self.size >= self.segment_bytes:
+            self.file.close()
+            self.segment_number += 1
+            self.file = open(os.path.join(self.directory, _segment_name(self.segment_number)), "ab")
+            self.size = 0
+
+    #flushes records appended with sync=False
+    def flush(self):
+        with self.cond:
+            self._wait_durable(self.appended)
+
+
+log: WriteAheadLog = None
+
+def open_log() -> WriteAheadLog:
+    global log
+    if log is None:
+        log = WriteAheadLog(settings.wal_dir, settings.wal_segment_bytes)
+    return log
+
+
+#records the document write and balance change of an operation before it is applied
+def begin(collection: str, key: dict, balance_filter: dict, balance_before: float, balance_after: float, insert: dict = None, update: dict = None) -> str:
+    op_id = f"{collection}:{uuid4().hex}"
+    open_log().append({
+        "type": "intent",
+        "op_id": op_id,
+        "collection": collection,
+        "key": key,
+        "insert": insert,
+        "update": update,
+        "balance": {"filter": balance_filter, "before": balance_before, "after": balance_after}
+    })
+    return op_id
+
+#commit markers don't need their own fsync; the next group commit carries them
+def commit(op_id: str):
+    open_log().append({"type": "commit", "op_id": op_id}, sync=False)
+
+#for an intent that was given up before any write (e.g. the balance changed under it)
+def abort(op_id: str):
+    open_log().append({"type": "abort", "op_id": op_id}, sync=False)
+
+
+#(exists, insert, update) for the document an intent writes; transactions may be
+#stored in buckets, see app/transaction_buckets.py
+def _document_writes(collection_name: str, key: dict):
+    from .database import db
+    from . import transaction_buckets
+
+    if collection_name == "transactions" and settings.transaction_layout == "buckets":
+        return (
+            lambda: transaction_buckets.find_one(key, deleted=None) is not None,
+            transaction_buckets.insert_one,
+            lambda data: transaction_buckets.update_one(key, data)
+        )
+
+    collection = db[collection_name]
+    return (
+        lambda: collection.find_one(key, {"_id": 1}) is not None,
+        lambda doc: collection.insert_one(doc),
+        lambda data: collection.update_one(key, {"$set": data})
+    )
+
+#re-applies (or with apply=False only reports) intents that have no commit record
+def replay(directory: str = None, apply: bool = True) -> dict:
+    from . import balance_store
+
+    intents = {}
+    committed = set()
+    for path in segments(directory or settings.wal_dir):
+        for record, _ in read_segment(path):
+            if record["type"] == "intent":
+                intents[record["op_id"]] = record
+            else:
+                committed.add(record["op_id"])
+
+    report = {"intents": len(intents), "committed": len(committed), "applied": [], "consistent": [], "conflicts": []}
+
+    for op_id, record in intents.items():
+        if op_id in committed:
+            continue
+
+        #the balance decides: a total that is neither side of the intent means the
+        #operation was given up (its abort lost) or overtaken, so nothing is written
+        balance = record["balance"]
+        current = balance_store.find_total(balance["filter"]["balance_id"])
+        if current is None or current not in (balance["before"], balance["after"]):
+            report["conflicts"].append(op_id)
+            continue
+
+        exists, insert, update = _document_writes(record["collection"], record["key"])
+        changes = []
+
+        if record["insert"] is not None and not exists():
+            changes.append("insert")
+            if apply:
+                insert(dict(record["insert"]))
+        if record["update"] is not None:
+            changes.append("update")
+            if apply:
+                update(record["update"])
+
+        if current == balance["before"] and balance["before"] != balance["after"]:
+            changes.append("balance")
+            if apply:
+                balance_store.change_total(balance["filter"]["balance_id"], balance["before"], balance["after"])
+
+        if changes:
+            report["applied"].append({"op_id": op_id, "changes": changes})
+        else:
+            report["consistent"].append(op_id)
+
+        if apply:
+            commit(op_id)
+
+    if apply:
+        open_log().flush()
+    return report
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in ("replay", "verify"):
+        sys.exit("usage: python -m app.wal [replay|verify]")
+
+    result = replay(apply=sys.argv[1] == "replay")
+    print(f'{result["intents"]} intents, {result["committed"]} committed')
+    for i in result["applied"]:
+        print(f'{"applied" if sys.argv[1] == "replay" else "pending"}: {i["op_id"]} ({", ".join(i["changes"])})')
+    for i in result["conflicts"]:
+        print(f"conflict: {i} (balance changed since, needs manual review)")
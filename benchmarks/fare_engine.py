@@ -0,0 +1,40 @@
+#Quote throughput of a compiled fare table with zones, a line base fare, two peak bands
+#and a cap, run with `python -m benchmarks.fare_engine` (needs the same .env as the app)
+import random
+from time import perf_counter
+from app.fare_engine import CompiledFares, band_map
+
+N = 1_000_000
+STATIONS = 300
+
+config = {
+    "version": 1,
+    "base_fare": 13,
+    "per_station_rate": 1.3,
+    "line_base_fares": [{"train_id": 1, "base_fare": 15}],
+    "zones": [{"train_id": 1, "from_position": 1, "zone": 1}, {"train_id": 1, "from_position": 100, "zone": 2}, {"train_id": 1, "from_position": 200, "zone": 3}],
+    "per_zone_rate": 5,
+    "peak_bands": [
+        {"name": "morning", "start": "07:00", "end": "09:30", "days": [0, 1, 2, 3, 4], "multiplier": 1.25},
+        {"name": "evening", "start": "17:00", "end": "19:30", "days": [0, 1, 2, 3, 4], "multiplier": 1.2}
+    ],
+    "max_fare": 300
+}
+
+stations = [{"station_id": 1000 + i, "position": i + 1} for i in range(STATIONS)]
+
+start = perf_counter()
+fares = CompiledFares(1, stations, config)
+bands = band_map(config["peak_bands"])
+compile_ms = (perf_counter() - start) * 1000
+
+random.seed(1)
+pairs = [(random.randrange(1000, 1000 + STATIONS), random.randrange(1000, 1000 + STATIONS), random.randrange(3)) for _ in range(N)]
+
+start = perf_counter()
+for departure_id, arrival_id, band in pairs:
+    fares.quote(departure_id, arrival_id, band)
+elapsed = perf_counter() - start
+
+print(f"compile {STATIONS} stations x {len(fares.cents)} bands: {compile_ms:.1f} ms")
+print(f"{N} quotes: {elapsed / N * 1e9:.0f} ns per quote, {N / elapsed:,.0f} quotes/s")
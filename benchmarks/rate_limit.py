@@ -0,0 +1,16 @@
+#Per-request cost of the in-memory token bucket, run with `python -m benchmarks.rate_limit`
+#(needs the same .env as the app)
+from time import perf_counter
+from app.rate_limit import MemoryBackend, parse_limit
+
+N = 200_000
+
+backend = MemoryBackend()
+capacity, rate = parse_limit("1000000/second")
+
+start = perf_counter()
+for i in range(N):
+    backend.take(f"payments:user:{i % 5000}", capacity, rate)
+elapsed = perf_counter() - start
+
+print(f"{N} checks over 5000 buckets: {elapsed / N * 1e6:.2f} us per check")
@@ -0,0 +1,25 @@
+#CPU cost of renewing a session: verifying the password with bcrypt (a new /login)
+#against hashing a refresh token with sha256 for the indexed lookup of /login/refresh.
+#Run with `python -m benchmarks.refresh` (needs the same .env as the app; no database access).
+import hashlib
+import secrets
+from time import perf_counter
+from app.utils import hash, verify
+
+N_BCRYPT = 20
+N_SHA256 = 100_000
+
+hashed_password = hash("correct horse battery staple")
+start = perf_counter()
+for i in range(N_BCRYPT):
+    verify("correct horse battery staple", hashed_password)
+bcrypt_time = (perf_counter() - start) / N_BCRYPT
+
+tokens = [secrets.token_urlsafe(32) for i in range(1000)]
+start = perf_counter()
+for i in range(N_SHA256):
+    hashlib.sha256(tokens[i % 1000].encode()).hexdigest()
+sha256_time = (perf_counter() - start) / N_SHA256
+
+print(f"bcrypt verify: {bcrypt_time * 1e3:.2f} ms per login")
+print(f"sha256 hash:   {sha256_time * 1e6:.2f} us per refresh ({bcrypt_time / sha256_time:,.0f}x less CPU, plus one indexed find_one_and_update)")
@@ -0,0 +1,27 @@
+#Compute cost of the repricing job's batches against a compiled fare table (no database
+#writes), run with `python -m benchmarks.repricing` (needs the same .env as the app)
+from time import perf_counter
+import numpy as np
+from app.fare_engine import CompiledFares
+from app.repricing import BATCH_SIZE, repricing_updates
+
+TRAVELS = 2_000_000
+STATIONS = 300
+
+rng = np.random.default_rng(1)
+stations = [{"station_id": 1000 + i, "position": i + 1} for i in range(STATIONS)]
+fares = CompiledFares(1, stations, {"version": 2, "base_fare": 15, "per_station_rate": 1.5})
+
+station_ids = [i["station_id"] for i in stations]
+travels = [
+    {"travel_id": i, "departure_id": int(d), "arrival_id": int(a), "total": 13.0}
+    for i, (d, a) in enumerate(zip(rng.choice(station_ids, TRAVELS), rng.choice(station_ids, TRAVELS)))
+]
+
+start = perf_counter()
+repriced = 0
+for i in range(0, TRAVELS, BATCH_SIZE):
+    repriced += len(repricing_updates(fares, travels[i:i + BATCH_SIZE]))
+elapsed = perf_counter() - start
+
+print(f"{TRAVELS} travels in batches of {BATCH_SIZE}: {elapsed:.2f} s, {TRAVELS / elapsed:,.0f} travels/s ({repriced} changed)")
@@ -0,0 +1,65 @@
+#Concurrent reservations on one trip: THREADS threads reserve random rides until
+#the trip is sold out, once with a single seat counter and once sharded, on a
+#scratch collection that is dropped afterwards. Checks that no segment was sold
+#past capacity. Run with `python -m benchmarks.reservations` (needs the same .env as
+#the app and a reachable database).
+import random
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from app.database import db
+from app.reservations import seat_counter_docs, take_seats
+
+THREADS = 64
+CAPACITY = 20_000
+SEGMENTS = 12
+SHARDS = (1, 4, 16, 64)
+
+counters = db["bench_seat_counters"]
+
+def ride(rng: random.Random) -> tuple[int, int]:
+    first = rng.randrange(SEGMENTS)
+    return first, rng.randint(first + 1, min(SEGMENTS, first + 4))
+
+def run(shards: int) -> tuple[float, list[int]]:
+    counters.drop()
+    counters.insert_many(seat_counter_docs(1, CAPACITY, shards, SEGMENTS))
+    counters.create_index([("trip_id", 1), ("shard", 1)], unique=True)
+
+    def client(seed: int) -> list[tuple[int, int]]:
+        rng = random.Random(seed)
+        sold, misses = [], 0
+        #a sold-out segment only rejects the rides crossing it, so stop after a run of misses
+        while misses < 50:
+            first, last = ride(rng)
+            if take_seats(1, shards, first, last, 1, counters) is None:
+                misses += 1
+            else:
+                sold.append((first, last))
+                misses = 0
+        return sold
+
+    started = perf_counter()
+    with ThreadPoolExecutor(THREADS) as pool:
+        results = list(pool.map(client, range(THREADS)))
+    elapsed = perf_counter() - started
+
+    sold = [0] * SEGMENTS
+    for first, last in (i for result in results for i in result):
+        for segment in range(first, last):
+            sold[segment] += 1
+    reservations = sum(len(i) for i in results)
+
+    free = [0] * SEGMENTS
+    for counter in counters.find({"trip_id": 1}):
+        assert min(counter["free"]) >= 0, "shard went below zero"
+        free = [a + b for a, b in zip(free, counter["free"])]
+    assert all(s <= CAPACITY for s in sold), "segment oversold"
+    assert all(s + f == CAPACITY for s, f in zip(sold, free)), "seats lost or duplicated"
+
+    return reservations / elapsed, sold
+
+for shards in SHARDS:
+    rate, sold = run(shards)
+    print(f"{shards:>3} shards: {rate:>8,.0f} reservations/s  {min(sold):,}-{max(sold):,} of {CAPACITY:,} seats sold per segment, none oversold")
+
+counters.drop()
@@ -0,0 +1,77 @@
+#Tap ingestion: pairs EVENTS synthetic tap events (USERS commuters, some missing a
+#tap) in batches of BATCH, in process, then settles the batches' debits on a scratch
+#balances collection, one bulk write of per-user sums per batch vs one update per
+#charge. The collection is dropped afterwards. Run with `python -m benchmarks.taps`
+#(needs the same .env as the app and a reachable database).
+import random
+from datetime import datetime, timedelta
+from time import perf_counter
+from pymongo import UpdateOne
+from app.database import db
+from app.taps import TapState
+
+USERS = 50_000
+EVENTS = 400_000
+BATCH = 5_000
+STATIONS = 60
+MISSED_TAPS = 0.02
+
+rng = random.Random(1)
+start_at = datetime(2025, 3, 3, 6)
+
+def synthetic_events() -> list[dict]:
+    events, seq = [], 0
+    at = start_at
+    while len(events) < EVENTS:
+        user_id = rng.randint(1, USERS)
+        departure, arrival = rng.sample(range(1, STATIONS + 1), 2)
+        at += timedelta(milliseconds=rng.randint(0, 200))
+        for kind, station_id, when in (("in", departure, at), ("out", arrival, at + timedelta(minutes=abs(arrival - departure) * 2))):
+            seq += 1
+            if rng.random() < MISSED_TAPS:
+                continue
+            events.append({"gate_id": f"g{station_id}", "seq": seq, "user_id": user_id, "station_id": station_id, "train_id": 1, "type": kind, "at": when})
+    return events[:EVENTS]
+
+def fare(tap_in: dict, tap_out: dict) -> float:
+    return round(15 + abs(tap_out["station_id"] - tap_in["station_id"]) * 2.5, 2)
+
+events = synthetic_events()
+batches = [events[i:i + BATCH] for i in range(0, EVENTS, BATCH)]
+
+state = TapState({}, {})
+results = []
+started = perf_counter()
+for batch in batches:
+    result = state.pair(batch, fare, 50.0, timedelta(minutes=180))
+    state.apply(result)
+    results.append(result)
+elapsed = perf_counter() - started
+
+summaries = [i.summary() for i in results]
+print(
+    f"pairing: {EVENTS / elapsed:,.0f} events/s  "
+    f"({sum(i['fares'] for i in summaries):,} fares, {sum(i['penalties'] for i in summaries):,} penalties, {len(state.open):,} journeys still open)"
+)
+
+balances = db["bench_tap_balances"]
+balances.drop()
+balances.insert_many([{"user_id": i, "total": 1000.0, "is_deleted": False} for i in range(1, USERS + 1)])
+balances.create_index("user_id")
+
+started = perf_counter()
+for result in results:
+    debits = result.debits()
+    if debits:
+        balances.bulk_write([UpdateOne({"user_id": k, "is_deleted": False}, {"$inc": {"total": -v}}) for k, v in debits.items()], ordered=False)
+grouped = perf_counter() - started
+
+started = perf_counter()
+for result in results[:10]:
+    for charge in result.charges:
+        balances.update_one({"user_id": charge["user_id"], "is_deleted": False}, {"$inc": {"total": -charge["amount"]}})
+single = (perf_counter() - started) * len(results) / 10
+
+print(f"settlement: grouped bulk writes {EVENTS / grouped:,.0f} events/s, one update per charge {EVENTS / single:,.0f} events/s (estimated from 10 batches)")
+
+balances.drop()
@@ -0,0 +1,38 @@
+#Gate validation throughput in one process: signs TICKETS tickets, then checks them in
+#batches of BATCH like POST /gates/validate does, and once more to measure replay
+#rejection. Each batch marks its tickets used with one insert; the entries are
+#deleted afterwards. Run with `python -m benchmarks.tickets` (needs the same .env as
+#the app and a reachable database).
+from datetime import datetime
+from time import perf_counter
+from app import tickets
+from app.database import used_tickets
+
+TICKETS = 20_000
+BATCH = 500
+
+now = datetime.utcnow()
+started = perf_counter()
+tokens = [
+    tickets.issue({"payment_id": 10_000_000 + i, "travel_id": i % 300 + 1, "user_id": i % 5000 + 1, "created_at": now})
+    for i in range(TICKETS)
+]
+print(f"issue: {(perf_counter() - started) / TICKETS * 1e6:.1f} µs per ticket, {len(tokens[0])} chars")
+
+def check(label: str, expected_valid: bool):
+    started = perf_counter()
+    for i in range(0, TICKETS, BATCH):
+        results = tickets.validate_batch(tokens[i:i + BATCH])
+        assert all(r["valid"] == expected_valid for r in results)
+    elapsed = perf_counter() - started
+    print(f"{label}: {TICKETS / elapsed:,.0f} scans/s ({elapsed / TICKETS * 1e6:.1f} µs per scan)")
+
+check("first scans", True)
+check("replays", False)
+
+#a fresh ticket with its travel_id changed after signing
+raw = bytearray(tickets._b64decode(tickets.issue({"payment_id": 1, "travel_id": 1, "user_id": 1, "created_at": now})))
+raw[20] ^= 1
+assert tickets.validate_batch([tickets.b64encode(bytes(raw))])[0]["reason"] == "bad_signature"
+
+used_tickets.delete_many({"payment_id": {"$gte": 10_000_000}})
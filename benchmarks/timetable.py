@@ -0,0 +1,57 @@
+#Next-departure queries against a compiled timetable, in process: a line of
+#STATIONS stations with a trip every HEADWAY minutes for a week. No database
+#writes. Run with `python -m benchmarks.timetable` (needs the same .env as the app).
+import random
+from datetime import datetime, timedelta
+from time import perf_counter
+from app.timetable import TrainTimetable, seconds
+
+STATIONS = 40
+HEADWAY = 4         #minutes
+DAYS = 7
+QUERIES = 200_000
+LIMIT = 5
+
+rng = random.Random(1)
+start_at = datetime(2025, 3, 3, 5)
+stations = [{"station_id": i, "position": i * 3} for i in range(1, STATIONS + 1)]
+stops = [i["station_id"] for i in stations]
+
+trips = []
+for i in range(DAYS * 24 * 60 // HEADWAY):
+    departs_at = start_at + timedelta(minutes=i * HEADWAY)
+    trips.append({
+        "trip_id": i + 1,
+        "train_id": 1,
+        "departs_at": departs_at,
+        "stops": stops,
+        "stop_times": [departs_at + timedelta(minutes=2 * k + rng.randint(0, 1)) for k in range(STATIONS)]
+    })
+
+started = perf_counter()
+table = TrainTimetable(trips, stations)
+print(f"compiled {len(trips):,} trips x {STATIONS} stations in {(perf_counter() - started) * 1e3:.0f} ms")
+
+queries = []
+for i in range(QUERIES):
+    departure, arrival = sorted(rng.sample(stops, 2))
+    queries.append((departure, arrival, seconds(start_at + timedelta(minutes=rng.randrange(DAYS * 24 * 60)))))
+
+started = perf_counter()
+for departure, arrival, after in queries:
+    table.next_departures(departure, arrival, after, LIMIT)
+elapsed = perf_counter() - started
+print(f"next {LIMIT} departures: {elapsed / QUERIES * 1e6:.1f} µs per query")
+
+#incremental edits, e.g. a reschedule
+started = perf_counter()
+for trip in rng.sample(trips, 200):
+    table.add_trip({**trip, "stop_times": [i + timedelta(minutes=1) for i in trip["stop_times"]]})
+print(f"reschedule one trip: {(perf_counter() - started) / 200 * 1e3:.2f} ms")
+
+#a scan of every trip per query, for comparison
+started = perf_counter()
+for departure, arrival, after in queries[:200]:
+    i, j = stops.index(departure), stops.index(arrival)
+    sorted((t for t in trips if seconds(t["stop_times"][i]) >= after), key=lambda t: t["stop_times"][i])[:LIMIT]
+print(f"scan: {(perf_counter() - started) / 200 * 1e6:.0f} µs per query")
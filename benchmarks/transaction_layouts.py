@@ -0,0 +1,72 @@
+#Index size and history-read latency of the two transaction layouts (one document
+#per transaction vs monthly buckets), on scratch collections that are dropped
+#afterwards. Run with `python -m benchmarks.transaction_layouts` (needs the same .env
+#as the app and a reachable database).
+import random
+from datetime import datetime, timedelta
+from time import perf_counter
+from bson import ObjectId
+from app.database import db
+from app.filters import TRANSACTION_INDEXES
+from app.transaction_buckets import INDEX, bucket_docs, history_pipeline
+
+USERS = 2000
+TRANSACTIONS_PER_USER = 300     #a year of commuting top-ups and withdrawals
+READS = 500
+
+documents = db["bench_transactions"]
+buckets = db["bench_transaction_buckets"]
+documents.drop()
+buckets.drop()
+
+rng = random.Random(1)
+start_at = datetime(2024, 1, 1)
+transaction_id = 0
+
+for user_id in range(1, USERS + 1):
+    docs = []
+    for i in range(TRANSACTIONS_PER_USER):
+        transaction_id += 1
+        docs.append({
+            "_id": ObjectId(),
+            "user_id": user_id,
+            "balance_id": user_id,
+            "transaction_id": transaction_id,
+            "type": rng.choice(("deposit", "withdraw")),
+            "amount": round(rng.uniform(1, 50), 2),
+            "created_at": start_at + timedelta(minutes=rng.randrange(365 * 24 * 60)),
+            "updated_at": None,
+            "is_deleted": False
+        })
+    documents.insert_many(docs)
+    buckets.insert_many(bucket_docs(user_id, user_id, [dict(i) for i in docs]))
+
+documents.create_index("transaction_id", unique=True)
+for index in TRANSACTION_INDEXES.values():
+    documents.create_index(index)
+buckets.create_index(INDEX)
+
+def report(name, collection):
+    stats = db.command("collStats", collection.name)
+    print(f'{name:<10} {stats["count"]:>9,} docs  {stats["size"] / 2**20:8.1f} MiB data  {stats["totalIndexSize"] / 2**20:8.1f} MiB indexes')
+
+report("documents", documents)
+report("buckets", buckets)
+
+sort = [("created_at", -1)]
+user_ids = [rng.randint(1, USERS) for i in range(READS)]
+
+started = perf_counter()
+for user_id in user_ids:
+    list(documents.find({"user_id": user_id, "balance_id": user_id, "is_deleted": False}).sort(sort).hint(TRANSACTION_INDEXES[(frozenset(), "created_at")]))
+documents_time = (perf_counter() - started) / READS
+
+started = perf_counter()
+for user_id in user_ids:
+    list(buckets.aggregate(history_pipeline(user_id, user_id, sort=sort)))
+buckets_time = (perf_counter() - started) / READS
+
+print(f"full history read ({TRANSACTIONS_PER_USER} transactions): documents {documents_time * 1e3:.2f} ms, buckets {buckets_time * 1e3:.2f} ms")
+
+documents.drop()
+buckets.drop()
@@ -0,0 +1,29 @@
+#Cost of logging a payment intent + commit with concurrent writers sharing fsyncs,
+#run with `python -m benchmarks.wal` (needs the same .env as the app; writes to a temp dir)
+import tempfile
+from datetime import datetime
+from threading import Thread
+from time import perf_counter
+from app import wal
+
+N = 20_000
+WRITERS = 16
+
+wal.log = wal.WriteAheadLog(tempfile.mkdtemp(prefix="wal-bench-"), 64 * 1024 * 1024)
+payment = {"user_id": 1, "payment_id": 1, "travel_id": 1, "amount": 26.0, "created_at": datetime.utcnow(), "updated_at": None, "is_deleted": False}
+
+def writer():
+    for i in range(N // WRITERS):
+        op_id = wal.begin("payments", {"payment_id": i}, {"balance_id": 1}, 100.0, 74.0, insert=payment)
+        wal.commit(op_id)
+
+start = perf_counter()
+threads = [Thread(target=writer) for _ in range(WRITERS)]
+for i in threads:
+    i.start()
+for i in threads:
+    i.join()
+wal.log.flush()
+elapsed = perf_counter() - start
+
+print(f"{N} operations from {WRITERS} writers: {elapsed / N * 1e6:.2f} us per operation")